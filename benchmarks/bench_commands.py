@@ -0,0 +1,250 @@
+# End-to-end benchmark of the bot's command handlers and paginators against the fake
+# Google backend in fakegoogle.py, on synthetic trade sheets of several sizes. Reports
+# p50/p99 latency, Google round trips per call and peak Python memory per scenario.
+# Needs the bot's own dependencies (discord.py, gspread, google-api-python-client,
+# oauth2client) but no network, credentials or Discord connection.
+# Run with: python benchmarks/bench_commands.py [--rows 10000,100000,1000000] [--repeat 20]
+#           [--latency 0.05] [--row-latency 0.01] [--quota-errors 0.02] [--real-quotas]
+import argparse
+import asyncio
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import discord
+import gspread
+from discord import app_commands
+from oauth2client.service_account import ServiceAccountCredentials
+
+import googleio
+import gscheduler
+from tradequery import TradeQuery
+from fakegoogle import FakeGoogle, FakeSheet
+
+TRADE_TITLES = ["buyer", "user id", "message id", "items(s)", "price", "category", "date"]
+ITEMS = ["sword", "shield", "gem", "pet egg", "potion", "bow", "ring", "amulet"]
+CATEGORIES = ["weapons", "armour", "pets", "consumables", "jewellery"]
+TALENT_TYPES = ["Speed", "Power", "Defense", "Luck", "Utility"]
+USER_ID = 1234
+GUILD_ID = 5678
+
+
+def trade_rows(count, seed=1):
+    rng = random.Random(seed)
+    rows = [list(TRADE_TITLES)]
+    for index in range(count):
+        day = 738000 + index * 730 // max(count, 1)  # Two years, in date order
+        rows.append([
+            f"Buyer{rng.randint(1, 500)}",
+            str(rng.randint(10 ** 17, 10 ** 18)),
+            str(rng.randint(10 ** 17, 10 ** 18)),
+            " + ".join(rng.sample(ITEMS, rng.randint(1, 3))),
+            str(rng.choice([rng.randint(1, 100), rng.randint(100, 5000)])),
+            rng.choice(CATEGORIES),
+            time.strftime("%d %B %Y", time.gmtime((day - 719163) * 86400)),
+        ])
+    return rows
+
+
+def pool_sheet(count=400):
+    rows = [["Priority", "Talent", "Rarity", "Info", "Link", "Type", "Retired"]] * 3
+    links = {}
+    for index in range(count):
+        rows.append([str(index + 1), f"Talent {index}", TALENT_TYPES[index % len(TALENT_TYPES)], f"info {index}",
+                     "FALSE", TALENT_TYPES[index % len(TALENT_TYPES)], "FALSE"])
+        links[(len(rows), 2)] = f"https://example.com/talent/{index}"
+    return FakeSheet("Pet Talents Priority List", rows, links)
+
+
+# Interaction with just what the handlers touch; everything they send is kept in `sent`
+class FakeInteraction:
+    def __init__(self):
+        self.user = SimpleNamespace(id=USER_ID, name="bench")
+        self.guild = None
+        self.guild_id = GUILD_ID
+        self.command = None
+        self.extras = {}
+        self.created_at = discord.utils.utcnow()
+        self.sent = []
+        self.response = FakeResponse(self)
+        self.followup = SimpleNamespace(send=self._send)
+
+    async def _send(self, content=None, **kwargs):
+        self.response.done = True
+        self.sent.append((content, kwargs))
+
+    async def edit_original_response(self, **kwargs):
+        self.sent.append((kwargs.get("content"), kwargs))
+
+    def view(self):
+        return next((kwargs["view"] for _, kwargs in reversed(self.sent) if kwargs.get("view") is not None), None)
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+
+    def is_done(self):
+        return self.done
+
+    async def defer(self, **kwargs):
+        self.done = True
+
+    async def send_message(self, content=None, **kwargs):
+        await self.interaction._send(content, **kwargs)
+
+    async def edit_message(self, **kwargs):
+        await self.interaction._send(kwargs.get("content"), **kwargs)
+
+
+# Open the paginator of a broad query and click through it like a user would
+async def browse_pages(bot):
+    interaction = FakeInteraction()
+    await bot.fetch_trade_by_item.callback(interaction, items="sword")
+    view = interaction.view()
+    for label in ["Next"] * 10 + ["Previous"] * 3 + ["Toggle View"] + ["Next"] * 5 + ["Jump to Start"]:
+        # The buttons hold the page in their custom_id, so each click answers with new ones
+        item = next((item for item in view.children if getattr(getattr(item, "item", item), "label", None) == label), None)
+        if item is not None:
+            click = FakeInteraction()
+            await item.callback(click)
+            view = click.view() or view
+
+
+def scenarios(bot, row_count):
+    choice = app_commands.Choice
+    return {
+        "fetch_trade": lambda i: bot.fetch_trade.callback(i, row=row_count // 2),
+        "fetch_all_trades": lambda i: bot.fetch_all_trades.callback(i),
+        "fetch_trades": lambda i: bot.fetch_trades.callback(i, buyer="Buyer1", price="100..500", category="!pets"),
+        "fetch_trades count_only": lambda i: bot.fetch_trades.callback(i, item="sword", count_only=True),
+        "fetch_trade_by_user": lambda i: bot.fetch_trade_by_user.callback(i, user_ids="12345"),
+        "fetch_trade_by_buyer": lambda i: bot.fetch_trade_by_buyer.callback(i, buyers="Buyer12, Buyer7"),
+        "fetch_trade_by_item": lambda i: bot.fetch_trade_by_item.callback(i, items="gem"),
+        "fetch_trade_by_category": lambda i: bot.fetch_trade_by_category.callback(i, categories="weapons"),
+        "fetch_trade_by_price (broad)": lambda i: bot.fetch_trade_by_price.callback(i, price="1"),
+        "fetch_trade_by_price_range": lambda i: bot.fetch_trade_by_price_range.callback(i, min_price=100, max_price=200),
+        "fetch_trade_by_date": lambda i: bot.fetch_trade_by_date.callback(i, dates="2022-06-01"),
+        "fetch_trade_by_date_range": lambda i: bot.fetch_trade_by_date_range.callback(i, start="2021-01", end="2022-12", granularity=choice(name="month", value="month")),
+        "price_stats": lambda i: bot.price_stats.callback(i, group_by=choice(name="buyer", value="buyer"), top=10),
+        "add_record": lambda i: bot.add_record.callback(i, buyer="Buyer1", user_id="1", message_id="2", item="sword", price="10", category="weapons", date="01/06/2022"),
+        "poolfind": lambda i: bot.poolfind.callback(i, required_input="talent 7", optional_input_1="Talent-12", optional_input_2="nope"),
+        "talenttype": lambda i: bot.talenttype.callback(i, talent_type="speed"),
+        "sheet_link": lambda i: bot.sheet_link.callback(i, sheet_name="Trade Records"),
+        "paginator (20 clicks)": lambda i: browse_pages(bot),
+    }
+
+
+# /fetch_trades count_only must agree with the rows the same query returns
+COUNT_CHECKS = [
+    {"item": "sword"},
+    {"item": "sword, gem"},
+    {"item": "!sword, gem"},
+    {"category": "=weapons, pets"},
+    {"price": "!100..500"},
+    {"date": "2021"},
+    {"date": "!2021-09-03, 2021"},
+    {"date": "!2021-09-03, 2021-09-03"},
+]
+
+
+def check_counts(bot):
+    trades = bot.sheets.trade("tradesheetid")
+    snapshot = trades.index.wait()
+    for fields in COUNT_CHECKS:
+        query = TradeQuery.from_fields(**fields)
+        count, rows = query.count(trades.index, snapshot), len(query.run(trades.index, snapshot))
+        if count != rows:
+            raise RuntimeError(f"count_only {fields}: {count} counted, {rows} returned")
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def measure(google, name, scenario, repeat):
+    latencies = []
+    before = Counter(google.calls)
+    for _ in range(repeat):
+        interaction = FakeInteraction()
+        started = time.perf_counter()
+        await scenario(interaction)
+        latencies.append(time.perf_counter() - started)
+        errors = [content for content, _ in interaction.sent if content and content.startswith("An error occurred")]
+        if errors:
+            raise RuntimeError(f"{name}: {errors[0]}")
+    calls = sum((Counter(google.calls) - before).values()) / repeat
+
+    # One more run under tracemalloc, which slows everything down, just for the peak
+    tracemalloc.start()
+    await scenario(FakeInteraction())
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(latencies), percentile(latencies, 0.99), calls, peak
+
+
+def patch_google(google, real_quotas):
+    ServiceAccountCredentials.from_json_keyfile_name = classmethod(lambda cls, *args, **kwargs: SimpleNamespace())
+    gspread.authorize = lambda creds: google.client()
+    googleio.get_service = google.get_service
+    import poolfinder
+    poolfinder.get_service = google.get_service
+    if not real_quotas:
+        # Measure the code, not the rate limiter
+        gscheduler.scheduler.buckets = {bucket: gscheduler.TokenBucket(10 ** 9) for bucket in gscheduler.QUOTAS}
+
+
+async def run(args):
+    google = FakeGoogle(latency=args.latency, row_latency=args.row_latency, quota_error_rate=args.quota_errors)
+    trade_sheet = FakeSheet("Sheet1", [list(TRADE_TITLES)])
+    google.add_spreadsheet("Trade Records", [trade_sheet], file_id="tradesheetid")
+    google.add_spreadsheet("Pet Talents Priority List", [pool_sheet()], file_id="sheetid")
+    patch_google(google, args.real_quotas)
+    import bot
+
+    for row_count in args.rows:
+        trade_sheet.values[:] = trade_rows(row_count)
+        started = time.perf_counter()
+        trades = bot.sheets.trade("tradesheetid")
+        trades.store.refresh(force=True)
+        trades.index.wait()  # The indexes are built in the background
+        bot.sheets.pool("sheetid").check()
+        check_counts(bot)
+        print(f"\n{row_count:,} trade rows: full load and index build {time.perf_counter() - started:.2f} s")
+        print(f"{'scenario':<30} {'p50 ms':>9} {'p99 ms':>9} {'API calls':>10} {'peak KiB':>10}")
+        for name, scenario in scenarios(bot, row_count).items():
+            p50, p99, calls, peak = await measure(google, name, scenario, args.repeat)
+            print(f"{name:<30} {p50 * 1000:>9.2f} {p99 * 1000:>9.2f} {calls:>10.2f} {peak / 1024:>10.0f}")
+        print(f"peak RSS so far: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MiB, "
+              f"quota errors injected: {google.calls['quota_errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the command handlers against a fake Google backend")
+    parser.add_argument("--rows", type=lambda text: [int(count) for count in text.split(",")], default=[10000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per Google round trip")
+    parser.add_argument("--row-latency", type=float, default=0.0, help="Extra seconds per 1,000 rows downloaded")
+    parser.add_argument("--quota-errors", type=float, default=0.0, help="Share of round trips refused with a 429")
+    parser.add_argument("--real-quotas", action="store_true", help="Keep the scheduler's per-minute quotas")
+    args = parser.parse_args()
+    # The bot keeps its local snapshot and metrics in the working directory
+    os.chdir(tempfile.mkdtemp(prefix="bench-commands-"))
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# Rendering benchmark on wide rows: the old per-term str.replace highlighter and
+# unbounded field concatenation against render.py's single-pass highlighter and packer.
+# Run with: python benchmarks/bench_render.py
+import os
+import random
+import string
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from render import EMBED_LIMIT, FIELD_VALUE_LIMIT, highlighter, render_rows, rows_per_page
+
+COLUMN_TITLES = ["buyer", "user id", "message id", "items(s)", "price", "category", "date"]
+SEARCH_TERMS = ["1", "12", "sword", "gem", "a"]
+
+
+def old_bold_search_terms(text, search_terms):
+    for term in search_terms:
+        text = text.replace(term, f"**{term}**")
+    return text
+
+
+def old_render(rows_data, row_nums, search_terms):
+    table = ""
+    for row_num, row_data in zip(row_nums, rows_data):
+        row_content = " | ".join(f"{title}: {old_bold_search_terms(data, search_terms) or 'N/A'}" for title, data in zip(COLUMN_TITLES, row_data))
+        table += f"Row {row_num}\n{row_content}\n\n"
+    return [("Records", table)]
+
+
+def wide_row(width):
+    words = lambda n: " ".join(random.choice(["sword", "gem", "shield", "pet", "".join(random.choices(string.ascii_lowercase, k=6))]) for _ in range(n))
+    return [f"buyer{random.randint(1, 999)}", str(random.randint(10 ** 17, 10 ** 18)), str(random.randint(10 ** 17, 10 ** 18)),
+            words(width), str(random.randint(1, 5000)), "category " + words(2), "12 January 2024"]
+
+
+def check_limits(fields):
+    total = sum(len(name) + len(value) for name, value in fields)
+    return all(len(value) <= FIELD_VALUE_LIMIT for _, value in fields) and total <= EMBED_LIMIT
+
+
+def main():
+    random.seed(1)
+    for width in (5, 50, 200):
+        rows = [wide_row(width) for _ in range(5)]
+        row_nums = list(range(2, 7))
+        old = timeit.timeit(lambda: old_render(rows, row_nums, SEARCH_TERMS), number=2000) / 2000
+        new = timeit.timeit(lambda: render_rows(rows, COLUMN_TITLES, row_nums, SEARCH_TERMS), number=2000) / 2000
+        adaptive = rows_per_page(rows, COLUMN_TITLES)
+        print(f"{width:>4} words/item: old {old * 1e6:8.1f} us (fits limits: {check_limits(old_render(rows, row_nums, SEARCH_TERMS))}), "
+              f"new {new * 1e6:8.1f} us (fits limits: {check_limits(render_rows(rows, COLUMN_TITLES, row_nums, SEARCH_TERMS))}), "
+              f"adaptive rows/page: {adaptive}")
+    print("double bolding, old:", old_bold_search_terms("12", ["1", "12"]), " new:", highlighter(["1", "12"])("12"))
+
+
+if __name__ == "__main__":
+    main()
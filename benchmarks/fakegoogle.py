@@ -0,0 +1,345 @@
+# In-process stand-in for the Google services the bot talks to: the gspread client,
+# spreadsheet and worksheet methods used by TradeStore and TradeWriter, and the Sheets v4
+# and Drive v3 endpoints used by poolfinder and the share-link helpers. Every round trip
+# is counted per endpoint and can be given a latency and a rate of 429 quota errors.
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+import httplib2
+from googleapiclient.errors import HttpError
+from gspread.utils import a1_to_rowcol
+
+
+def quota_error():
+    return HttpError(httplib2.Response({'status': 429}), b'{"error": {"code": 429, "message": "Quota exceeded"}}')
+
+
+def not_found_error():
+    return HttpError(httplib2.Response({'status': 404}), b'{"error": {"code": 404, "message": "Not found"}}')
+
+
+# (first row, last row, first column, last column) of an A1 range, 1-based and inclusive;
+# open ends ("A:G", "A2:G") are None
+def parse_a1(range_name):
+    start, _, end = range_name.partition(":")
+    end = end or start
+
+    def bound(a1):
+        match = re.fullmatch(r"([A-Z]*)(\d*)", a1)
+        letters, digits = match.groups()
+        column = a1_to_rowcol(f"{letters}1")[1] if letters else None
+        return (int(digits) if digits else None), column
+
+    (first_row, first_column), (last_row, last_column) = bound(start), bound(end)
+    return first_row, last_row, first_column, last_column
+
+
+def split_range(full_range):
+    sheet_name, _, range_name = full_range.rpartition("!")
+    return sheet_name.strip("'"), range_name
+
+
+class FakeSheet:
+    def __init__(self, title, values, links=None):
+        self.title = title
+        self.values = values
+        self.links = links or {}  # (row, column) -> hyperlink, 1-based
+
+    # Rows of the range, trimmed like the Sheets API trims them
+    def read(self, range_name):
+        first_row, last_row, first_column, last_column = parse_a1(range_name)
+        first_row = first_row or 1
+        last_row = min(last_row or len(self.values), len(self.values))
+        first_column = first_column or 1
+        rows = []
+        for row in self.values[first_row - 1:last_row]:
+            row = list(row[first_column - 1:last_column])
+            while row and row[-1] == "":
+                row.pop()
+            rows.append(row)
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows, first_row, first_column
+
+
+class FakeFile:
+    def __init__(self, file_id, name, sheets):
+        self.id = file_id
+        self.name = name
+        self.sheets = {sheet.title: sheet for sheet in sheets}
+        self.version = 1
+        self.permissions = {}
+
+    def sheet(self, title=None):
+        return self.sheets[title] if title else next(iter(self.sheets.values()))
+
+
+class FakeGoogle:
+    def __init__(self, latency=0.0, row_latency=0.0, quota_error_rate=0.0, seed=0):
+        self.latency = latency
+        self.row_latency = row_latency  # Extra seconds per 1,000 rows returned
+        self.quota_error_rate = quota_error_rate
+        self.random = random.Random(seed)
+        self.files = {}
+        self.calls = Counter()
+        self._lock = threading.Lock()
+
+    def add_spreadsheet(self, name, sheets, file_id=None):
+        file_id = file_id or f"file{len(self.files) + 1}"
+        self.files[file_id] = FakeFile(file_id, name, sheets)
+        return file_id
+
+    def file_by_name(self, name):
+        return next((file for file in self.files.values() if file.name == name), None)
+
+    # One round trip to `endpoint`: counted, delayed and possibly refused with a 429
+    # before it has any effect
+    def request(self, endpoint, rows=0):
+        with self._lock:
+            self.calls[endpoint] += 1
+            refused = self.quota_error_rate and self.random.random() < self.quota_error_rate
+            if refused:
+                self.calls["quota_errors"] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if refused:
+            raise quota_error()
+        self.transfer(rows)
+
+    # Time to download `rows` rows
+    def transfer(self, rows):
+        if self.row_latency and rows:
+            time.sleep(self.row_latency * rows / 1000)
+
+    def client(self):
+        return FakeClient(self)
+
+    # Drop-in for googleio.get_service
+    def get_service(self, api, version, creds):
+        return FakeSheetsService(self) if api == 'sheets' else FakeDriveService(self)
+
+
+# gspread
+
+class FakeSession:
+    def __init__(self):
+        self.hooks = {"response": []}
+
+
+class FakeClient:
+    def __init__(self, google):
+        self.google = google
+        self.session = FakeSession()
+
+    def open(self, name):
+        self.google.request("drive.files.list")
+        file = self.google.file_by_name(name)
+        if file is None:
+            raise KeyError(name)
+        self.google.request("sheets.spreadsheets.get")
+        return FakeSpreadsheet(self.google, file)
+
+    def open_by_key(self, key):
+        file = self.google.files.get(key)
+        if file is None:
+            raise KeyError(key)
+        self.google.request("sheets.spreadsheets.get")
+        return FakeSpreadsheet(self.google, file)
+
+
+class FakeSpreadsheet:
+    def __init__(self, google, file):
+        self.google = google
+        self.file = file
+        self.id = file.id
+        self.sheet1 = FakeWorksheet(self, file.sheet())
+
+    def batch_update(self, body):
+        self.google.request("sheets.spreadsheets.batchUpdate")
+        self.file.version += 1
+        return {"replies": [{} for _ in body.get("requests", [])]}
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, sheet):
+        self.spreadsheet = spreadsheet
+        self.sheet = sheet
+        self.id = 0
+        self.title = sheet.title
+
+    def get_all_values(self):
+        self.spreadsheet.google.request("sheets.values.get", rows=len(self.sheet.values))
+        width = max((len(row) for row in self.sheet.values), default=0)
+        return [list(row) + [""] * (width - len(row)) for row in self.sheet.values]
+
+    def get(self, range_name):
+        rows, _, _ = self.sheet.read(range_name)
+        self.spreadsheet.google.request("sheets.values.get", rows=len(rows))
+        return rows
+
+    def row_values(self, row):
+        self.spreadsheet.google.request("sheets.values.get", rows=1)
+        values = list(self.sheet.values[row - 1]) if row <= len(self.sheet.values) else []
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    def append_row(self, values, value_input_option='RAW'):
+        return self.append_rows([values], value_input_option)
+
+    def append_rows(self, values, value_input_option='RAW', include_values_in_response=None):
+        self.spreadsheet.google.request("sheets.values.append")
+        first = len(self.sheet.values) + 1
+        written = [[str(cell) for cell in row] for row in values]
+        self.sheet.values.extend(written)
+        self.spreadsheet.file.version += 1
+        last = len(self.sheet.values)
+        updates = {"updatedRange": f"{self.title}!A{first}:G{last}", "updatedRows": len(values)}
+        if include_values_in_response:
+            updates["updatedData"] = {"range": updates["updatedRange"], "values": [list(row) for row in written]}
+        return {"updates": updates}
+
+
+# googleapiclient
+
+class FakeRequest:
+    def __init__(self, google, endpoint, func, rows=lambda result: 0):
+        self.google = google
+        self.endpoint = endpoint
+        self.func = func
+        self.rows = rows
+
+    def execute(self):
+        self.google.request(self.endpoint)
+        result = self.func()
+        self.google.transfer(self.rows(result))
+        return result
+
+
+class FakeBatch:
+    def __init__(self, google, callback):
+        self.google = google
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, request_id=None):
+        self.requests.append((request, request_id or str(len(self.requests))))
+
+    # One round trip for the whole batch; each request's error is reported to its callback
+    def execute(self):
+        self.google.request("batch")
+        for request, request_id in self.requests:
+            try:
+                self.callback(request_id, request.func(), None)
+            except HttpError as error:
+                self.callback(request_id, None, error)
+
+
+class FakeSheetsService:
+    def __init__(self, google):
+        self.google = google
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return FakeValues(self.google)
+
+    def get(self, spreadsheetId, ranges=(), fields=None, **kwargs):
+        file = self.google.files[spreadsheetId]
+        ranges = [ranges] if isinstance(ranges, str) else list(ranges)
+
+        def grids():
+            data = []
+            for full_range in ranges:
+                sheet_name, range_name = split_range(full_range)
+                sheet = file.sheet(sheet_name)
+                rows, first_row, first_column = sheet.read(range_name)
+                data.append({"rowData": [
+                    {"values": [
+                        {"formattedValue": value, **({"hyperlink": sheet.links[(first_row + r, first_column + c)]} if (first_row + r, first_column + c) in sheet.links else {})}
+                        for c, value in enumerate(row)
+                    ]}
+                    for r, row in enumerate(rows)
+                ]})
+            return {"sheets": [{"data": data}]}
+
+        return FakeRequest(self.google, "sheets.spreadsheets.get", grids, rows=lambda result: sum(len(data["rowData"]) for data in result["sheets"][0]["data"]))
+
+
+class FakeValues:
+    def __init__(self, google):
+        self.google = google
+
+    def get(self, spreadsheetId, range, **kwargs):
+        sheet_name, range_name = split_range(range)
+        sheet = self.google.files[spreadsheetId].sheet(sheet_name)
+        return FakeRequest(self.google, "sheets.values.get", lambda: {"values": sheet.read(range_name)[0]}, rows=lambda result: len(result["values"]))
+
+
+class FakeDriveService:
+    def __init__(self, google):
+        self.google = google
+
+    def files(self):
+        return FakeFiles(self.google)
+
+    def permissions(self):
+        return FakePermissions(self.google)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self.google, callback)
+
+
+class FakeFiles:
+    def __init__(self, google):
+        self.google = google
+
+    def _file(self, file_id):
+        file = self.google.files.get(file_id)
+        if file is None:
+            raise not_found_error()
+        return file
+
+    def get(self, fileId, fields=None, **kwargs):
+        def get():
+            file = self._file(fileId)
+            return {"id": file.id, "name": file.name, "version": str(file.version),
+                    "webViewLink": f"https://docs.google.com/spreadsheets/d/{file.id}/edit"}
+        return FakeRequest(self.google, "drive.files.get", get)
+
+    def list(self, q="", **kwargs):
+        # Only the name = '...' form the bot uses, with \' and \\ escapes
+        match = re.search(r"name\s*=\s*'((?:[^'\\]|\\.)*)'", q)
+        name = re.sub(r"\\(.)", r"\1", match.group(1)) if match else None
+        return FakeRequest(self.google, "drive.files.list",
+                           lambda: {"files": [{"id": file.id, "name": file.name} for file in self.google.files.values() if file.name == name]})
+
+
+class FakePermissions:
+    def __init__(self, google):
+        self.google = google
+
+    def create(self, fileId, body, **kwargs):
+        def create():
+            file = FakeFiles(self.google)._file(fileId)
+            permission_id = "anyoneWithLink" if body.get("type") == "anyone" else f"perm{len(file.permissions) + 1}"
+            file.permissions[permission_id] = {"id": permission_id, **body}
+            return {"id": permission_id}
+        return FakeRequest(self.google, "drive.permissions.create", create)
+
+    def list(self, fileId, **kwargs):
+        return FakeRequest(self.google, "drive.permissions.list",
+                           lambda: {"permissions": list(FakeFiles(self.google)._file(fileId).permissions.values())})
+
+    def delete(self, fileId, permissionId, **kwargs):
+        def delete():
+            permissions = FakeFiles(self.google)._file(fileId).permissions
+            if permissionId not in permissions:
+                raise not_found_error()
+            del permissions[permissionId]
+            return {}
+        return FakeRequest(self.google, "drive.permissions.delete", delete)
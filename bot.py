@@ -7,18 +7,50 @@ from discord import app_commands
 from discord.ext import commands, tasks
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 import asyncio
+import atexit
+import io
+import logging
+import os
+import threading
 import time
+from array import array
+from collections import OrderedDict
 from typing import Optional, List
-from datetime import datetime
-import gspread_formatting as gf
-from gspread.utils import rowcol_to_a1
-from poolfinder import get_data_based_on_selection, get_data_by_talent_type
+from prefixindex import normalize_input
+from poolfinder import check_pool_revisions
+from sheetregistry import GuildSheets, SheetRegistry, TradeSheet, load_allowlist, row_bytes
+from tradeindex import GRANULARITIES, parse_period
+from tradeimport import MAX_REPORTED_ERRORS, format_trade_date, read_trade_rows
+from tradeexport import FORMATS as EXPORT_FORMATS, export_parts
+from tradepool import start_workers
+from tradewriter import PartialImport
+from render import EMBED_LIMIT, FIELD_VALUE_LIMIT, highlighter, render_detail, render_rows, rows_per_page, truncate
+from snapshotdb import SnapshotDB
+from viewregistry import ViewRegistry, view_key
+from resultcache import ResultCache
+from tradequery import FIELDS, DateRange, PriceRange, Substring, TradeQuery, dates_or_text
+from googleio import AutoDefer, ThreadLocalService, execute_batch, run_blocking
+from gscheduler import BACKGROUND, DRIVE, scheduler
+from telemetry import count_session_bytes, setup_logging, telemetry
 
 
 SPREADSHEET_ID = 'sheetid'
+TRADE_SHEET_NAME = 'Trade Records'
+SHEET_ALLOWLIST_PATH = 'sheet_allowlist.json'
+METRICS_PATH = 'bot_metrics.prom'
+# Worker processes for broad trade queries; 0 runs every query on the event loop
+QUERY_WORKERS = (os.cpu_count() or 1) - 1
+
+# Fork the query workers first: the log listener below is the process's first thread
+start_workers(QUERY_WORKERS)
+# Log through a queue so writing a log line never blocks the event loop
+log_listener = setup_logging()
+# Exit handlers run in reverse order, so what the ones registered later log is still written
+atexit.register(log_listener.stop)
+log = logging.getLogger("bot")
+
 # Google Sheets and Drive setup
 scope = [
     "https://spreadsheets.google.com/feeds",
@@ -27,34 +59,129 @@ scope = [
 ]
 creds = ServiceAccountCredentials.from_json_keyfile_name('creds.json', scope)
 client = gspread.authorize(creds)
-drive_service = build('drive', 'v3', credentials=creds)
+count_session_bytes(getattr(client, 'session', None) or client.http_client.session, 'sheets')
+drive_service = ThreadLocalService('drive', 'v3', creds)
+# Sheets of the guilds that were not given their own with /configure_sheets: the original
+# trade spreadsheet, looked up by name once, and the shared pool finder sheet
+DEFAULT_SHEETS = GuildSheets(client.open(TRADE_SHEET_NAME).id, SPREADSHEET_ID)
+
+# Local snapshot of every sheet; a sheet loaded again starts from it and the refresh tasks
+# reconcile it with the live sheet in the background
+snapshot_db = SnapshotDB('snapshot.db')
+# Trade and pool sheets of each guild, loaded on first use and evicted, least recently used
+# first, when together they go over the memory budget; they all share the client and credentials
+sheets = SheetRegistry(snapshot_db, lambda sheet_id: client.open_by_key(sheet_id).sheet1, drive_service, creds, DEFAULT_SHEETS,
+                       load_allowlist(SHEET_ALLOWLIST_PATH))
+# What each paginator and button shows, so they work without per-message state
+view_registry = ViewRegistry(snapshot_db)
+# Results of repeated lookups, for as long as the data they came from is unchanged
+result_cache = ResultCache()
+
+# Cached pages of an evicted trade sheet would keep all of its rows in memory
+def forget_sheet(sheet):
+    if isinstance(sheet, TradeSheet):
+        from_sheet = lambda state: isinstance(state, PageState) and state.source == sheet.sheet_id
+        view_registry.pages.discard(from_sheet)
+        result_cache.discard(from_sheet)
 
-# Fetch the column titles from the first row of the sheet
-trade_sheet = client.open("Trade Records").sheet1
-trade_column_titles = trade_sheet.row_values(1)
+sheets.add_listener(forget_sheet)
+
+# Cached query results only hit on the version they were computed from, so a change makes
+# the sheet's older ones dead weight; after a full reload its cached pages also point at
+# rows nothing else uses any more, so they go as well and are rebuilt when clicked
+def forget_stale_pages(sheet, snapshot, start):
+    from_sheet = lambda state: isinstance(state, PageState) and state.source == sheet.sheet_id
+    result_cache.discard(lambda state: from_sheet(state) and state.snapshot.version != snapshot.version)
+    if start == 0:
+        view_registry.pages.discard(lambda state: from_sheet(state) and state.snapshot.rows is not snapshot.rows)
+
+sheets.add_change_listener(forget_stale_pages)
 
 # Discord bot setup
 intents = discord.Intents.default()
 intents.message_content = True  # Enable Message Content Intent
-bot = commands.Bot(command_prefix='!', intents=intents)
+
+# Command tree that times every app command from the moment it is dispatched
+class InstrumentedTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction):
+        interaction.extras['started'] = time.perf_counter()
+        return True
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
+        command = interaction.command.name if interaction.command else 'unknown'
+        telemetry.inc("command_errors_total", command=command)
+        log.error(f"Command {command} failed", exc_info=error)
+
+bot = commands.Bot(command_prefix='!', intents=intents, tree_cls=InstrumentedTree)
+
+@bot.event
+async def setup_hook():
+    bot.add_dynamic_items(TradePageButton, TalentPageButton, RevertPermissionButton)
+    # Start reconciling with Google before the gateway connection is up
+    refresh_trade_store.start()
+    refresh_pool_index.start()
+    write_metrics.start()
+    expire_views.start()
 
 @bot.event
 async def on_ready():
-    print(f'Bot is ready. Logged in as {bot.user}')
+    log.info(f'Bot is ready. Logged in as {bot.user}')
     await bot.tree.sync()  # Sync commands globally
 
+# Pick up rows appended to the loaded trade sheets; commands keep serving the current
+# snapshots meanwhile. Sheets grow as rows come in, so the memory budget is checked after.
+@tasks.loop(seconds=20)
+async def refresh_trade_store():
+    for sheet in sheets.loaded():
+        if isinstance(sheet, TradeSheet):
+            try:
+                await run_blocking(sheet.store.refresh, timeout=120, lane=BACKGROUND)
+            except Exception as e:
+                log.warning(f"Failed to refresh the trade snapshot of {sheet.sheet_id}: {str(e)}")
+    try:
+        await run_blocking(sheets.enforce, lane=BACKGROUND)
+    except Exception as e:
+        log.warning(f"Failed to enforce the sheet memory budget: {str(e)}")
+
+# Check the Drive revision of the loaded pool sheets and rebuild an index only when it changed
+@tasks.loop(seconds=60)
+async def refresh_pool_index():
+    try:
+        await run_blocking(check_pool_revisions, timeout=60, lane=BACKGROUND)
+    except Exception as e:
+        log.warning(f"Failed to refresh the pool index: {str(e)}")
+
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    started = interaction.extras.get('started')
+    if started is not None:
+        telemetry.observe("command_seconds", time.perf_counter() - started, command=command.name)
+
+# Forget saved view specs nobody has asked for in a while; their buttons then say so
+@tasks.loop(hours=6)
+async def expire_views():
+    try:
+        await asyncio.to_thread(view_registry.expire)
+    except Exception as e:
+        log.warning(f"Failed to expire saved views: {str(e)}")
+
+# Export the metrics for a Prometheus textfile collector
+@tasks.loop(seconds=60)
+async def write_metrics():
+    try:
+        await run_blocking(telemetry.write_prometheus, METRICS_PATH, lane=BACKGROUND)
+    except Exception as e:
+        log.warning(f"Failed to write {METRICS_PATH}: {str(e)}")
+
 # Function to create an embed for multiple rows of data
-def create_embed(rows_data, column_titles, start_row_num, current_page, total_pages, search_terms):
+def create_embed(rows_data, column_titles, row_nums, current_page, total_pages, search_terms):
     embed = discord.Embed(title=f"Details", color=discord.Color.blue())
 
-    # Formatting each row
-    table = ""
-    for row_num, row_data in enumerate(rows_data, start=start_row_num):
-        row_content = " | ".join(f"{title}: {bold_search_terms(data, search_terms) or 'N/A'}" for title, data in zip(column_titles, row_data))
-        table += f"Row {row_num}\n{row_content}\n\n"
-
-    # Adding the table to the embed
-    embed.add_field(name="Records", value=table, inline=False)
+    # Formatting each row and packing the rows into fields that fit Discord's limits
+    with telemetry.timer("render_seconds", view="rows"):
+        fields = render_rows(rows_data, column_titles, row_nums, search_terms)
+    for name, value in fields:
+        embed.add_field(name=name, value=value, inline=False)
     embed.set_footer(text=f"Page {current_page + 1}/{total_pages + 1}")
     return embed
 
@@ -63,264 +190,581 @@ def create_detailed_embed(row_data, column_titles, row_num, current_page, total_
     embed = discord.Embed(title=f"Details for Row {row_num}", color=discord.Color.green())
 
     # Formatting the row
-    for title, data in zip(column_titles, row_data):
-        embed.add_field(name=title, value=data or 'N/A', inline=True)
+    with telemetry.timer("render_seconds", view="detail"):
+        fields = render_detail(row_data, column_titles)
+    for title, data in fields:
+        embed.add_field(name=title, value=data, inline=True)
 
     embed.set_footer(text=f"Page {current_page + 1}/{total_pages + 1}")
     return embed
 
 # Function to bold search terms in the text
 def bold_search_terms(text, search_terms):
-    if text is None:
-        return text
-    for term in search_terms:
-        text = text.replace(term, f"**{term}**")
-    return text
+    return highlighter(search_terms)(text)
+
+VIEW_EXPIRED = "These buttons have expired. Please run the command again."
+VIEW_CHANGED = "The results have changed since these buttons were sent. Please run the command again."
+
+# The paginator and /sheet_link buttons below are dynamic items: everything a click needs
+# is in the button's custom_id (a view key from the registry, the page, the users allowed
+# to click), so their views are fully dynamic, discord.py keeps no object per message and
+# the buttons keep working after a restart.
+
+# Previous/Next of a talent type paginator: tt:<view key>:<p|n>:<page>
+class TalentPageButton(discord.ui.DynamicItem[discord.ui.Button], template=r"tt:(?P<key>[0-9a-f]+):(?P<action>[pn]):(?P<page>\d+)"):
+    def __init__(self, key, action, page):
+        label = "Previous" if action == "p" else "Next"
+        super().__init__(discord.ui.Button(label=label, style=discord.ButtonStyle.secondary, custom_id=f"tt:{key}:{action}:{page}"))
+        self.key = key
+        self.action = action
+        self.page = page
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls(match["key"], match["action"], int(match["page"]))
+
+    async def callback(self, interaction: discord.Interaction):
+        spec = await asyncio.to_thread(view_registry.spec, self.key)
+        if spec is None:
+            await interaction.response.send_message(VIEW_EXPIRED, ephemeral=True)
+            return
+        # The pool index is in memory, so the page is simply built again
+        index = await run_blocking(load_pool, spec[2], spec[3])
+        data, exact_talent_type = index.talent_type(spec[1])
+        page = self.page - 1 if self.action == "p" else self.page + 1
+        paginator = TalentTypePaginator(self.key, data, exact_talent_type or spec[1], current_page=page)
+        await interaction.response.edit_message(embed=paginator.embed, view=paginator)
 
-# Function to create a paginator for talent types
+# Function to create a paginator for talent types; only the page on show is built
 class TalentTypePaginator(discord.ui.View):
-    def __init__(self, data: List[str], exact_talent_type: str, color=discord.Color.green()):
+    def __init__(self, key, data: List[str], exact_talent_type: str, current_page=0, color=discord.Color.green()):
         super().__init__(timeout=None)
         self.data = data
         self.title = f"Talent Type Finder Results for '{exact_talent_type}'"
         self.color = color
-        self.current_page = 0
-        self.embeds = self.create_embeds()
+        self.total_pages = max(1, (len(data) + 9) // 10)
+        self.current_page = min(max(current_page, 0), self.total_pages - 1)
+        self.embed = self.create_embed()
+        self.add_item(TalentPageButton(key, "p", self.current_page))
+        self.add_item(TalentPageButton(key, "n", self.current_page))
 
-    def create_embeds(self):
-        embeds = []
+    def create_embed(self):
         embed = discord.Embed(title=self.title, color=self.color)
-        
-        for index, item in enumerate(self.data):
-            if index > 0 and index % 10 == 0:
-                embed.set_footer(text=f"Page {len(embeds) + 1} of {len(self.data) // 10 + 1}\nUse /poolfind to know more about specific talents.")
-                embeds.append(embed)
-                embed = discord.Embed(title=self.title, color=self.color)
+        for item in self.data[self.current_page * 10:(self.current_page + 1) * 10]:
             embed.add_field(name="Talent Name", value=item, inline=False)
-        
-        embed.set_footer(text=f"Page {len(embeds) + 1} of {len(self.data) // 10 + 1}\nUse /poolfind to know more about specific talents.")
-        embeds.append(embed)
-        return embeds
-
-    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary)
-    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.current_page > 0:
-            self.current_page -= 1
-            await interaction.response.edit_message(embed=self.embeds[self.current_page], view=self)
-
-    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary)
-    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.current_page < len(self.embeds) - 1:
-            self.current_page += 1
-            await interaction.response.edit_message(embed=self.embeds[self.current_page], view=self)
+        embed.set_footer(text=f"Page {self.current_page + 1} of {self.total_pages}\nUse /poolfind to know more about specific talents.")
+        return embed
 
     async def send_initial_message(self, interaction: discord.Interaction):
-        await interaction.followup.send(embed=self.embeds[self.current_page], view=self)
+        await interaction.followup.send(embed=self.embed, view=self)
 
-class Paginator(discord.ui.View):
-    def __init__(self, data, column_titles, rows_per_embed, search_terms, user_id, allowed_user_id=None, timeout=180):
-        super().__init__(timeout=timeout)
-        self.data = data
-        self.column_titles = column_titles
+# Result set behind a trade paginator: row indices into a shared, immutable trade snapshot
+# (a range when every row is shown) and a small LRU of pages that were already rendered.
+# It is shared by every message showing the same query and kept in the view registry;
+# `source` is the ID of the trade spreadsheet it comes from.
+class PageState:
+    __slots__ = ("source", "snapshot", "indices", "rows_per_embed", "search_terms", "rendered")
+    max_rendered = 8
+
+    def __init__(self, source, snapshot, indices, rows_per_embed, search_terms):
+        self.source = source
+        self.snapshot = snapshot
+        self.indices = indices if isinstance(indices, range) else array('I', indices)
+        if rows_per_embed is None:
+            # Size pages from a sample of the rows so a page fits in one embed
+            step = max(1, len(self.indices) // 20)
+            sample = [snapshot.rows[index] for index in self.indices[::step][:20]]
+            rows_per_embed = rows_per_page(sample, snapshot.schema)
         self.rows_per_embed = rows_per_embed
         self.search_terms = search_terms
+        self.rendered = OrderedDict()
+
+    def __len__(self):
+        return len(self.indices)
+
+    # Bytes counted against the view cache budget: the indices, a full page cache and, for
+    # a snapshot a full reload already replaced, the rows only the cached state keeps alive
+    def size(self):
+        indices = 0 if isinstance(self.indices, range) else len(self.indices) * self.indices.itemsize
+        size = 256 + indices + self.max_rendered * EMBED_LIMIT
+        trades = sheets.trade(self.source, load=False)
+        current = trades.store.peek() if trades else None
+        if len(self.snapshot) and (current is None or current.rows is not self.snapshot.rows):
+            size += int(len(self.snapshot) * row_bytes(self.snapshot))
+        return size
+
+    def page(self, key, render):
+        embed = self.rendered.get(key)
+        telemetry.cache("rendered_pages", embed is not None)
+        if embed is None:
+            embed = self.rendered[key] = render()
+            if len(self.rendered) > self.max_rendered:
+                self.rendered.popitem(last=False)
+        else:
+            self.rendered.move_to_end(key)
+        return embed
+
+PAGE_BUTTONS = {
+    "s": ("Jump to Start", discord.ButtonStyle.secondary),
+    "p": ("Previous", discord.ButtonStyle.primary),
+    "n": ("Next", discord.ButtonStyle.primary),
+    "l": ("Jump to Last", discord.ButtonStyle.secondary),
+    "t": ("Toggle View", discord.ButtonStyle.secondary),
+}
+
+# A button of a trade paginator:
+# tp:<view key>:<action>:<page>:<detailed view>:<snapshot version>:<user id>:<allowed user id>
+class TradePageButton(discord.ui.DynamicItem[discord.ui.Button], template=r"tp:(?P<key>[0-9a-f]+):(?P<action>[spnlt]):(?P<page>\d+):(?P<detailed>[01]):(?P<version>\d+):(?P<user_id>\d+):(?P<allowed_user_id>\d*)"):
+    def __init__(self, key, action, page, detailed, version, user_id, allowed_user_id=None):
+        label, style = PAGE_BUTTONS[action]
+        custom_id = f"tp:{key}:{action}:{page}:{int(detailed)}:{version}:{user_id}:{allowed_user_id or ''}"
+        super().__init__(discord.ui.Button(label=label, style=style, custom_id=custom_id))
+        self.key = key
+        self.action = action
+        self.page = page
+        self.detailed = detailed
+        self.version = version
         self.user_id = user_id
         self.allowed_user_id = allowed_user_id
-        self.current_page = 0
-        self.rows_per_page_index = 0  # Index to track the current rows per page option
-        self.detailed_view = False  # Flag to toggle between views
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        allowed_user_id = int(match["allowed_user_id"]) if match["allowed_user_id"] else None
+        return cls(match["key"], match["action"], int(match["page"]), match["detailed"] == "1", int(match["version"]), int(match["user_id"]), allowed_user_id)
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        return interaction.user.id == self.user_id or (self.allowed_user_id and interaction.user.id == self.allowed_user_id)
+
+    async def callback(self, interaction: discord.Interaction):
+        state = await trade_pages(self.key)
+        if state is None:
+            await interaction.response.send_message(VIEW_EXPIRED, ephemeral=True)
+            return
+        # Pages rebuilt on a newer snapshot would not line up with the page in the button
+        if state.snapshot.version != self.version:
+            await interaction.response.send_message(VIEW_CHANGED, ephemeral=True)
+            return
+        paginator = Paginator(self.key, state, self.user_id, self.allowed_user_id, self.page, self.detailed)
+        paginator.apply(self.action)
+        await interaction.response.edit_message(embed=paginator.embed, view=paginator)
+
+class Paginator(discord.ui.View):
+    def __init__(self, key, state, user_id, allowed_user_id=None, current_page=0, detailed_view=False):
+        super().__init__(timeout=None)
+        self.key = key
+        self.state = state
+        self.user_id = user_id
+        self.allowed_user_id = allowed_user_id
+        self.detailed_view = detailed_view  # Flag to toggle between views
+        self.current_page = min(current_page, self.total_pages)
+        self.refresh_buttons()
 
     @property
     def total_pages(self):
         if self.detailed_view:
-            return len(self.data) - 1
+            return max(len(self.state) - 1, 0)
         else:
-            return (len(self.data) + self.rows_per_embed - 1) // self.rows_per_embed - 1
+            return max((len(self.state) + self.state.rows_per_embed - 1) // self.state.rows_per_embed - 1, 0)
 
-    def check(self, interaction: discord.Interaction):
-        return interaction.user.id == self.user_id or (self.allowed_user_id and interaction.user.id == self.allowed_user_id)
+    # Move to the page a button leads to and point the buttons at the pages next to it
+    def apply(self, action):
+        if action == "s":
+            self.current_page = 0
+        elif action == "p":
+            self.current_page = max(self.current_page - 1, 0)
+        elif action == "n":
+            self.current_page = min(self.current_page + 1, self.total_pages)
+        elif action == "l":
+            self.current_page = self.total_pages
+        elif action == "t":
+            self.detailed_view = not self.detailed_view
+            self.current_page = 0  # Reset to the first page
+        self.refresh_buttons()
+
+    def refresh_buttons(self):
+        self.clear_items()
+        version = self.state.snapshot.version
+        for action in PAGE_BUTTONS:
+            self.add_item(TradePageButton(self.key, action, self.current_page, self.detailed_view, version, self.user_id, self.allowed_user_id))
 
     @property
     def embed(self):
+        return self.state.page((self.detailed_view, self.current_page), self.render)
+
+    def render(self):
+        state = self.state
+        snapshot = state.snapshot
+        if not len(state):
+            return discord.Embed(title="Details", description="No matching trades.", color=discord.Color.blue())
         if self.detailed_view:
-            row_num = self.current_page + 1
-            row_data = self.data[self.current_page]
-            return create_detailed_embed(row_data, self.column_titles, row_num, self.current_page, self.total_pages)
+            index = state.indices[self.current_page]
+            return create_detailed_embed(snapshot.rows[index], snapshot.schema, snapshot.sheet_row(index), self.current_page, self.total_pages)
         else:
-            start = self.current_page * self.rows_per_embed
-            end = start + self.rows_per_embed
-            rows_data = self.data[start:end]
-            return create_embed(rows_data, self.column_titles, start + 1, self.current_page, self.total_pages, self.search_terms)
-
-    @discord.ui.button(label='Jump to Start', style=discord.ButtonStyle.secondary)
-    async def jump_to_start(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.check(interaction):
-            self.current_page = 0
-            await interaction.response.edit_message(embed=self.embed, view=self)
-
-    @discord.ui.button(label='Previous', style=discord.ButtonStyle.primary)
-    async def previous(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.check(interaction):
-            if self.detailed_view:
-                if self.current_page > 0:
-                    self.current_page -= 1
-            else:
-                if self.current_page > 0:
-                    self.current_page -= 1
-            await interaction.response.edit_message(embed=self.embed, view=self)
-
-    @discord.ui.button(label='Next', style=discord.ButtonStyle.primary)
-    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.check(interaction):
-            if self.detailed_view:
-                if self.current_page < len(self.data) - 1:
-                    self.current_page += 1
-            else:
-                if self.current_page < self.total_pages:
-                    self.current_page += 1
-            await interaction.response.edit_message(embed=self.embed, view=self)
+            start = self.current_page * state.rows_per_embed
+            end = start + state.rows_per_embed
+            indices = state.indices[start:end]
+            rows_data = [snapshot.rows[index] for index in indices]
+            row_nums = [snapshot.sheet_row(index) for index in indices]
+            return create_embed(rows_data, snapshot.schema, row_nums, self.current_page, self.total_pages, state.search_terms)
 
-    @discord.ui.button(label='Jump to Last', style=discord.ButtonStyle.secondary)
-    async def jump_to_last(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.check(interaction):
-            self.current_page = self.total_pages
-            await interaction.response.edit_message(embed=self.embed, view=self)
+# Pages of a trade paginator: from the view cache, or rebuilt from the saved spec on the
+# current snapshot when they were evicted or the bot restarted since
+async def trade_pages(key):
+    state = view_registry.pages.get(key)
+    if state is None:
+        spec = await asyncio.to_thread(view_registry.spec, key)
+        if spec is None:
+            return None
+        state = await build_trade_pages(spec)
+        view_registry.pages.put(key, state, state.size())
+    return state
 
-    @discord.ui.button(label='Toggle View', style=discord.ButtonStyle.secondary)
-    async def toggle_view(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.check(interaction):
-            self.detailed_view = not self.detailed_view
-            self.current_page = 0  # Reset to the first page
-            await interaction.response.edit_message(embed=self.embed, view=self)
+# Spec forms, the trade sheet's name last: ["query", TradeQuery spec, sheet] (no predicates
+# means every row) or ["dates", first, last, sheet]
+async def build_trade_pages(spec):
+    trades, snapshot = await load_trades(spec[-1])
+    if spec[0] == "dates":
+        return PageState(trades.sheet_id, snapshot, await trades.queries.run(TradeQuery([DateRange(spec[1], spec[2])]), snapshot), None, [])
+    query = TradeQuery.from_spec(spec[1])
+    indices = await trades.queries.run(query, snapshot) if query.predicates else range(len(snapshot))
+    return PageState(trades.sheet_id, snapshot, indices, None, query.search_terms())
 
-class RevertPermissionView(discord.ui.View):
-    def __init__(self, file_id, user_id, allowed_user_id=None, timeout=180):
-        super().__init__(timeout=timeout)
-        self.file_id = file_id
+# Send the first page of a trade paginator and register how to rebuild its pages
+async def send_trade_pages(interaction: discord.Interaction, spec, state, allowed_user, content=None):
+    key = await asyncio.to_thread(view_registry.register, spec)
+    view_registry.pages.put(key, state, state.size())
+    paginator = Paginator(key, state, interaction.user.id, allowed_user.id if allowed_user else None)
+    await interaction.followup.send(content=content, embed=paginator.embed, view=paginator)
+
+# Revert Permissions button of /sheet_link: rp:<view key>:<user id>:<allowed user id>
+class RevertPermissionButton(discord.ui.DynamicItem[discord.ui.Button], template=r"rp:(?P<key>[0-9a-f]+):(?P<user_id>\d+):(?P<allowed_user_id>\d*)"):
+    def __init__(self, key, user_id, allowed_user_id=None):
+        custom_id = f"rp:{key}:{user_id}:{allowed_user_id or ''}"
+        super().__init__(discord.ui.Button(label='Revert Permissions', style=discord.ButtonStyle.danger, custom_id=custom_id))
+        self.key = key
         self.user_id = user_id
         self.allowed_user_id = allowed_user_id
 
-    def check(self, interaction: discord.Interaction):
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        allowed_user_id = int(match["allowed_user_id"]) if match["allowed_user_id"] else None
+        return cls(match["key"], int(match["user_id"]), allowed_user_id)
+
+    async def interaction_check(self, interaction: discord.Interaction):
         return interaction.user.id == self.user_id or (self.allowed_user_id and interaction.user.id == self.allowed_user_id)
 
-    @discord.ui.button(label='Revert Permissions', style=discord.ButtonStyle.danger)
-    async def revert_permissions(self, interaction: discord.Interaction, button: discord.ui.Button):
-        if self.check(interaction):
-            remove_share_link(self.file_id)
-            await interaction.response.send_message("The share link has been removed and the sheet is now restricted.", ephemeral=True)
+    async def callback(self, interaction: discord.Interaction):
+        async with AutoDefer(interaction) as responder:
+            # Spec: ["revert", file ID, permission ID]
+            spec = await asyncio.to_thread(view_registry.spec, self.key)
+            if spec is None:
+                await responder.send(VIEW_EXPIRED, ephemeral=True)
+                return
+            await run_blocking(remove_share_link, spec[1], spec[2])
+            await responder.send("The share link has been removed and the sheet is now restricted.", ephemeral=True)
+
+class RevertPermissionView(discord.ui.View):
+    def __init__(self, key, user_id, allowed_user_id=None):
+        super().__init__(timeout=None)
+        self.add_item(RevertPermissionButton(key, user_id, allowed_user_id))
+
+# A trade sheet, loaded on first use, and its current snapshot; both can block, so they
+# run on the Google I/O pool. Loading a sheet restores its saved copy and has no deadline;
+# only the snapshot, which can wait on the live sheet, gets the per-command timeout.
+async def load_trades(sheet_id):
+    trades = sheets.trade(sheet_id, load=False) or await run_blocking(sheets.trade, sheet_id, timeout=None)
+    return trades, await run_blocking(trades.store.snapshot)
+
+# Trade sheet of the guild an interaction comes from, and its current snapshot
+async def guild_trades(interaction: discord.Interaction):
+    return await load_trades(sheets.settings(interaction.guild_id).trade_sheet_id)
+
+# The snapshot the indexes of a trade sheet cover, once a rebuild after a (re)load is done;
+# for the reports read straight from the indexes
+async def indexed_snapshot(trades):
+    return await asyncio.to_thread(trades.index.wait)
+
+# Index of a pool sheet, loaded on first use; blocks, so it runs on the Google I/O pool
+def load_pool(sheet_id, sheet_name):
+    return sheets.pool(sheet_id, sheet_name).get()
 
 @bot.tree.command(name="fetch_trade", description="Fetch trade details by row number")
 @app_commands.describe(row="Row number to fetch")
 async def fetch_trade(interaction: discord.Interaction, row: int):
-    try:
-        # Fetch the row data from Google Sheets
-        row_data = trade_sheet.row_values(row)
-        if row_data:
-            embed = create_embed([row_data], trade_column_titles, row, 0, 0, [])
-            await interaction.response.send_message(embed=embed)
-        else:
-            await interaction.response.send_message(f"No data found in row {row}.")
-    except Exception as e:
-        await interaction.response.send_message(f"An error occurred: {str(e)}")
+    async with AutoDefer(interaction) as responder:
+        try:
+            # Fetch the row data from the trade snapshot
+            _, snapshot = await guild_trades(interaction)
+            row_data = list(snapshot.schema) if row == 1 else snapshot.row(row - 2)
+            if row_data and any(row_data):
+                embed = create_embed([row_data], snapshot.schema, [row], 0, 0, [])
+                await responder.send(embed=embed)
+            else:
+                await responder.send(f"No data found in row {row}.")
+        except Exception as e:
+            await responder.send(f"An error occurred: {str(e)}")
 
 @bot.tree.command(name="fetch_all_trades", description="Fetch all trade details")
 @app_commands.describe(allowed_user="Optional user who can also interact with the buttons")
 async def fetch_all_trades(interaction: discord.Interaction, allowed_user: discord.Member = None):
     try:
         await interaction.response.defer()  # Defer the response to allow more time for processing
-        # Fetch all data from Google Sheets
-        all_data = trade_sheet.get_all_values()
-        if all_data:
-            paginator = Paginator(all_data, trade_column_titles, rows_per_embed=5, search_terms=[], user_id=interaction.user.id, allowed_user_id=allowed_user.id if allowed_user else None)
-            await interaction.followup.send(embed=paginator.embed, view=paginator)
+        # Fetch all data from the trade snapshot
+        trades, snapshot = await guild_trades(interaction)
+        if len(snapshot):
+            state = PageState(trades.sheet_id, snapshot, range(len(snapshot)), None, [])
+            await send_trade_pages(interaction, ["query", [], trades.sheet_id], state, allowed_user)
         else:
             await interaction.followup.send("No data found.")
     except Exception as e:
         await interaction.followup.send(f"An error occurred: {str(e)}")
 
+# Autocomplete choices; Discord allows 25 of them and 100 characters per name and value
+def autocomplete_choices(values):
+    return [app_commands.Choice(name=value, value=value) for value in values if len(value) <= 100][:25]
+
+# Suggestions for the last entry of a comma-separated list, keeping the entries before it
+# and any leading "!" or "=" of the /fetch_trades syntax
+def complete_last_entry(current, complete):
+    head, separator, last = current.rpartition(',')
+    head = head + separator + ' ' if separator else ''
+    stripped = last.lstrip()
+    marks = stripped[:len(stripped) - len(stripped.lstrip('!='))] if not separator else ''
+    return autocomplete_choices(head + marks + value for value in complete(stripped[len(marks):]))
+
+# Autocomplete over the distinct values of a trade column, served from the index of the
+# guild's trade sheet once it is loaded
+def trade_autocomplete(title):
+    async def autocomplete(interaction: discord.Interaction, current: str):
+        trades = sheets.trade(sheets.settings(interaction.guild_id).trade_sheet_id, load=False)
+        return complete_last_entry(current, lambda prefix: trades.index.complete(title, prefix)) if trades else []
+    return autocomplete
+
+buyer_autocomplete = trade_autocomplete(FIELDS["buyer"])
+category_autocomplete = trade_autocomplete(FIELDS["category"])
+item_autocomplete = trade_autocomplete(FIELDS["item"])
+
+# Pool index of the guild's pool sheet if it is loaded and built, for autocomplete
+def loaded_pool_index(interaction: discord.Interaction):
+    settings = sheets.settings(interaction.guild_id)
+    cache = sheets.pool(settings.pool_sheet_id, settings.pool_sheet_name, load=False)
+    return cache.index if cache else None
+
+# Talent names and types, served from the pool index once it is built
+async def talent_name_autocomplete(interaction: discord.Interaction, current: str):
+    index = loaded_pool_index(interaction)
+    return autocomplete_choices(index.name_completions.complete(current)) if index else []
+
+async def talent_type_autocomplete(interaction: discord.Interaction, current: str):
+    index = loaded_pool_index(interaction)
+    return autocomplete_choices(index.type_completions.complete(current)) if index else []
+
+# Function to run a trade query on the current snapshot and reply with a paginator or a count
+async def send_trade_query(interaction: discord.Interaction, query, allowed_user, not_found_message, count_only=False):
+    trades, snapshot = await guild_trades(interaction)
+    spec = ["query", query.to_spec(), trades.sheet_id]
+    terms = view_key(spec)
+    # A sheet loaded again after an eviction numbers its versions from the start again
+    version = (trades.generation, snapshot.version)
+    if count_only:
+        count = result_cache.get("trade_count", terms, version)
+        if count is None:
+            count = await trades.queries.count(query, snapshot)
+            result_cache.put("trade_count", terms, version, count, 64)
+        await interaction.followup.send(f"{count} matching trade{'s' if count != 1 else ''}.")
+        return
+    # The cached PageState comes with the pages it already rendered; () when nothing matched
+    state = result_cache.get("trades", terms, version)
+    if state is None:
+        indices = await trades.queries.run(query, snapshot)
+        state = PageState(trades.sheet_id, snapshot, indices, None, query.search_terms()) if indices else ()
+        result_cache.put("trades", terms, version, state, state.size() if state else 64)
+    if state:
+        await send_trade_pages(interaction, spec, state, allowed_user)
+    else:
+        await interaction.followup.send(not_found_message)
+
+@bot.tree.command(name="fetch_trades", description="Fetch trade details matching several fields at once")
+@app_commands.describe(
+    buyer="Buyers to match (see syntax below)",
+    user_id="User IDs to match",
+    message_id="Message IDs to match",
+    item="Items to match",
+    category="Categories to match",
+    price="Prices to match; ranges like 100..500, ..50 or 1000..",
+    date="Dates to match; ranges like 2024-01-01..2024-03-31, 2024-01..2024-02 or 2023..",
+    count_only="Only return the number of matching trades",
+    allowed_user="Optional user who can also interact with the buttons"
+)
+@app_commands.autocomplete(buyer=buyer_autocomplete, item=item_autocomplete, category=category_autocomplete)
+async def fetch_trades(
+    interaction: discord.Interaction,
+    buyer: Optional[str] = None,
+    user_id: Optional[str] = None,
+    message_id: Optional[str] = None,
+    item: Optional[str] = None,
+    category: Optional[str] = None,
+    price: Optional[str] = None,
+    date: Optional[str] = None,
+    count_only: bool = False,
+    allowed_user: discord.Member = None
+):
+    # Field syntax: "a, b" contains a or b, "=a, b" is exactly a or b, "lo..hi" range, "!" prefix negates
+    try:
+        await interaction.response.defer()  # Defer the response to allow more time for processing
+        try:
+            query = TradeQuery.from_fields(buyer=buyer, user_id=user_id, message_id=message_id, item=item, category=category, price=price, date=date)
+        except ValueError as e:
+            await interaction.followup.send(f"Invalid query: {str(e)}")
+            return
+        await send_trade_query(interaction, query, allowed_user, "No trades found for the given filters.", count_only=count_only)
+    except Exception as e:
+        await interaction.followup.send(f"An error occurred: {str(e)}")
+
+DEFAULT_UPLOAD_LIMIT = 10 * 1024 * 1024
+MAX_EXPORT_PARTS = 20
+
+@bot.tree.command(name="export_trades", description="Download the trades matching the given fields as a compressed file")
+@app_commands.describe(
+    buyer="Buyers to match (same syntax as /fetch_trades)",
+    user_id="User IDs to match",
+    message_id="Message IDs to match",
+    item="Items to match",
+    category="Categories to match",
+    price="Prices to match; ranges like 100..500",
+    date="Dates to match; ranges like 2024-01-01..2024-03-31",
+    file_format="File format (default CSV)"
+)
+@app_commands.choices(file_format=[app_commands.Choice(name=export_format.upper(), value=export_format) for export_format in EXPORT_FORMATS])
+@app_commands.autocomplete(buyer=buyer_autocomplete, item=item_autocomplete, category=category_autocomplete)
+async def export_trades(
+    interaction: discord.Interaction,
+    buyer: Optional[str] = None,
+    user_id: Optional[str] = None,
+    message_id: Optional[str] = None,
+    item: Optional[str] = None,
+    category: Optional[str] = None,
+    price: Optional[str] = None,
+    date: Optional[str] = None,
+    file_format: Optional[app_commands.Choice[str]] = None
+):
+    try:
+        await interaction.response.defer()  # Defer the response to allow more time for processing
+        try:
+            query = TradeQuery.from_fields(buyer=buyer, user_id=user_id, message_id=message_id, item=item, category=category, price=price, date=date)
+        except ValueError as e:
+            await interaction.followup.send(f"Invalid query: {str(e)}")
+            return
+        trades, snapshot = await guild_trades(interaction)
+        indices = await trades.queries.run(query, snapshot)
+        if not indices:
+            await interaction.followup.send("No trades found for the given filters.")
+            return
+
+        # Parts are compressed off the event loop one at a time and sent as soon as each is done
+        size_limit = interaction.guild.filesize_limit if interaction.guild else DEFAULT_UPLOAD_LIMIT
+        parts = export_parts(snapshot, indices, file_format.value if file_format else "csv", size_limit)
+        sent = 0
+        while True:
+            part = await asyncio.to_thread(next, parts, None)
+            if part is None:
+                break
+            if sent == MAX_EXPORT_PARTS:
+                await interaction.followup.send(f"Stopped after {sent} files; narrow the filters to export the rest.")
+                break
+            filename, data = part
+            sent += 1
+            content = f"{len(indices)} matching trades" if sent == 1 else None
+            await interaction.followup.send(content, file=discord.File(io.BytesIO(data), filename=filename))
+    except Exception as e:
+        await interaction.followup.send(f"An error occurred: {str(e)}")
+
 @bot.tree.command(name="fetch_trade_by_user", description="Fetch trade details by user IDs")
 @app_commands.describe(user_ids="Comma-separated list of user IDs to fetch trades for", allowed_user="Optional user who can also interact with the buttons")
 async def fetch_trade_by_user(interaction: discord.Interaction, user_ids: str, allowed_user: discord.Member = None):
     try:
         await interaction.response.defer()  # Defer the response to allow more time for processing
-        # Fetch all data from Google Sheets
-        all_data = trade_sheet.get_all_values()
-        user_id_variations = [uid.strip().lower() for uid in user_ids.split(',')]
-        user_data = [row for row in all_data[1:] if any(uid in str(row[trade_column_titles.index("user id")]).lower() for uid in user_id_variations)]
-        if user_data:
-            paginator = Paginator(user_data, trade_column_titles, rows_per_embed=5, search_terms=user_id_variations, user_id=interaction.user.id, allowed_user_id=allowed_user.id if allowed_user else None)
-            await interaction.followup.send(embed=paginator.embed, view=paginator)
-        else:
-            await interaction.followup.send(f"No trades found for user IDs {user_ids}.")
+        query = TradeQuery([Substring(FIELDS["user_id"], user_ids.split(','))])
+        await send_trade_query(interaction, query, allowed_user, f"No trades found for user IDs {user_ids}.")
     except Exception as e:
         await interaction.followup.send(f"An error occurred: {str(e)}")
 
 @bot.tree.command(name="fetch_trade_by_category", description="Fetch trade details by categories")
 @app_commands.describe(categories="Comma-separated list of categories to fetch trades for", allowed_user="Optional user who can also interact with the buttons")
+@app_commands.autocomplete(categories=category_autocomplete)
 async def fetch_trade_by_category(interaction: discord.Interaction, categories: str, allowed_user: discord.Member = None):
     try:
         await interaction.response.defer()  # Defer the response to allow more time for processing
-        # Fetch all data from Google Sheets
-        all_data = trade_sheet.get_all_values()
-        category_variations = [cat.strip().lower() for cat in categories.split(',')]
-        category_data = [row for row in all_data[1:] if any(cat in str(row[trade_column_titles.index("category")]).lower() for cat in category_variations)]
-        if category_data:
-            paginator = Paginator(category_data, trade_column_titles, rows_per_embed=5, search_terms=category_variations, user_id=interaction.user.id, allowed_user_id=allowed_user.id if allowed_user else None)
-            await interaction.followup.send(embed=paginator.embed, view=paginator)
-        else:
-            await interaction.followup.send(f"No trades found for categories {categories}.")
+        query = TradeQuery([Substring(FIELDS["category"], categories.split(','))])
+        await send_trade_query(interaction, query, allowed_user, f"No trades found for categories {categories}.")
     except Exception as e:
         await interaction.followup.send(f"An error occurred: {str(e)}")
 
 @bot.tree.command(name="fetch_trade_by_date", description="Fetch trade details by dates")
-@app_commands.describe(dates="Comma-separated list of dates to fetch trades for (YYYY-MM-DD)", allowed_user="Optional user who can also interact with the buttons")
+@app_commands.describe(dates="Comma-separated list of dates (YYYY-MM-DD), months (YYYY-MM) or years (YYYY) to fetch trades for", allowed_user="Optional user who can also interact with the buttons")
 async def fetch_trade_by_date(interaction: discord.Interaction, dates: str, allowed_user: discord.Member = None):
     try:
         await interaction.response.defer()  # Defer the response to allow more time for processing
-        # Fetch all data from Google Sheets
-        all_data = trade_sheet.get_all_values()
-        date_variations = [date.strip() for date in dates.split(',')]
-        date_data = [row for row in all_data[1:] if any(date in str(row[trade_column_titles.index("date")]).lower() for date in date_variations)]
-        if date_data:
-            paginator = Paginator(date_data, trade_column_titles, rows_per_embed=5, search_terms=date_variations, user_id=interaction.user.id, allowed_user_id=allowed_user.id if allowed_user else None)
-            await interaction.followup.send(embed=paginator.embed, view=paginator)
+        query = TradeQuery([dates_or_text(dates.split(','))])
+        await send_trade_query(interaction, query, allowed_user, f"No trades found for dates {dates}.")
+    except Exception as e:
+        await interaction.followup.send(f"An error occurred: {str(e)}")
+
+@bot.tree.command(name="fetch_trade_by_date_range", description="Fetch trade details between two dates")
+@app_commands.describe(
+    start="First day, month or year of the range (YYYY-MM-DD, YYYY-MM or YYYY, see granularity)",
+    end="Last day, month or year of the range (YYYY-MM-DD, YYYY-MM or YYYY, see granularity)",
+    granularity="Whether start and end are days, months or years; months and years also show trade counts per period",
+    allowed_user="Optional user who can also interact with the buttons"
+)
+@app_commands.choices(granularity=[app_commands.Choice(name=unit, value=unit) for unit in GRANULARITIES])
+async def fetch_trade_by_date_range(interaction: discord.Interaction, start: str, end: str, granularity: Optional[app_commands.Choice[str]] = None, allowed_user: discord.Member = None):
+    try:
+        await interaction.response.defer()  # Defer the response to allow more time for processing
+        trades, snapshot = await guild_trades(interaction)
+        unit = granularity.value if granularity else "day"
+        try:
+            first, _ = parse_period(start, unit)
+            _, last = parse_period(end, unit)
+        except ValueError:
+            await interaction.followup.send(f"Invalid {unit} range. Please use {dict(day='YYYY-MM-DD', month='YYYY-MM', year='YYYY')[unit]}.")
+            return
+        if unit != "day":
+            snapshot = await indexed_snapshot(trades)  # The counts per period come from the date index
+        # Two bisects on the sorted date index, then only the matching rows
+        date_indices = await trades.queries.run(TradeQuery([DateRange(first, last)]), snapshot)
+        if date_indices:
+            summary = None
+            if unit != "day":
+                counts = trades.index.dates.rollup(unit, first, last, snapshot)
+                summary = f"Trades per {unit}: " + ", ".join(f"{label}: {count}" for label, count in counts.items())
+                summary = summary[:1900]
+            state = PageState(trades.sheet_id, snapshot, date_indices, None, [])
+            await send_trade_pages(interaction, ["dates", first, last, trades.sheet_id], state, allowed_user, content=summary)
         else:
-            await interaction.followup.send(f"No trades found for dates {dates}.")
+            await interaction.followup.send(f"No trades found between {start} and {end}.")
     except Exception as e:
         await interaction.followup.send(f"An error occurred: {str(e)}")
 
 @bot.tree.command(name="fetch_trade_by_item", description="Fetch trade details by items")
 @app_commands.describe(items="Comma-separated list of items to fetch trades for", allowed_user="Optional user who can also interact with the buttons")
+@app_commands.autocomplete(items=item_autocomplete)
 async def fetch_trade_by_item(interaction: discord.Interaction, items: str, allowed_user: discord.Member = None):
     try:
         await interaction.response.defer()  # Defer the response to allow more time for processing
-        # Fetch all data from Google Sheets
-        all_data = trade_sheet.get_all_values()
-        item_column_index = trade_column_titles.index("items(s)")
-        item_variations = [item.strip().lower() for item in items.split(',')]
-        item_data = [row for row in all_data[1:] if any(item in str(row[item_column_index]).lower() for item in item_variations)]
-        if item_data:
-            paginator = Paginator(item_data, trade_column_titles, rows_per_embed=5, search_terms=item_variations, user_id=interaction.user.id, allowed_user_id=allowed_user.id if allowed_user else None)
-            await interaction.followup.send(embed=paginator.embed, view=paginator)
-        else:
-            await interaction.followup.send(f"No trades found for items {items}.")
+        query = TradeQuery([Substring(FIELDS["item"], items.split(','))])
+        await send_trade_query(interaction, query, allowed_user, f"No trades found for items {items}.")
     except Exception as e:
         await interaction.followup.send(f"An error occurred: {str(e)}")
 
 @bot.tree.command(name="fetch_trade_by_buyer", description="Fetch trade details by buyers")
 @app_commands.describe(buyers="Comma-separated list of buyers to fetch trades for", allowed_user="Optional user who can also interact with the buttons")
+@app_commands.autocomplete(buyers=buyer_autocomplete)
 async def fetch_trade_by_buyer(interaction: discord.Interaction, buyers: str, allowed_user: discord.Member = None):
     try:
         await interaction.response.defer()  # Defer the response to allow more time for processing
-        # Fetch all data from Google Sheets
-        all_data = trade_sheet.get_all_values()
-        buyer_variations = [buyer.strip().lower() for buyer in buyers.split(',')]
-        buyer_data = [row for row in all_data[1:] if any(buyer in str(row[trade_column_titles.index("buyer")]).lower() for buyer in buyer_variations)]
-        if buyer_data:
-            paginator = Paginator(buyer_data, trade_column_titles, rows_per_embed=5, search_terms=buyer_variations, user_id=interaction.user.id, allowed_user_id=allowed_user.id if allowed_user else None)
-            await interaction.followup.send(embed=paginator.embed, view=paginator)
-        else:
-            await interaction.followup.send(f"No trades found for buyers {buyers}.")
+        query = TradeQuery([Substring(FIELDS["buyer"], buyers.split(','))])
+        await send_trade_query(interaction, query, allowed_user, f"No trades found for buyers {buyers}.")
     except Exception as e:
         await interaction.followup.send(f"An error occurred: {str(e)}")
 
@@ -329,18 +773,94 @@ async def fetch_trade_by_buyer(interaction: discord.Interaction, buyers: str, al
 async def fetch_trade_by_price(interaction: discord.Interaction, price: str, allowed_user: discord.Member = None):
     try:
         await interaction.response.defer()  # Defer the response to allow more time for processing
-        # Fetch all data from Google Sheets
-        all_data = trade_sheet.get_all_values()
-        price_variations = [p.strip().lower() for p in price.split(',')]
-        price_data = [row for row in all_data[1:] if any(p in str(row[trade_column_titles.index("price")]).lower() for p in price_variations)]
-        if price_data:
-            paginator = Paginator(price_data, trade_column_titles, rows_per_embed=5, search_terms=price_variations, user_id=interaction.user.id, allowed_user_id=allowed_user.id if allowed_user else None)
-            await interaction.followup.send(embed=paginator.embed, view=paginator)
-        else:
-            await interaction.followup.send(f"No trades found for prices {price}.")
+        query = TradeQuery([Substring(FIELDS["price"], price.split(','))])
+        await send_trade_query(interaction, query, allowed_user, f"No trades found for prices {price}.")
     except Exception as e:
         await interaction.followup.send(f"An error occurred: {str(e)}")
 
+@bot.tree.command(name="fetch_trade_by_price_range", description="Fetch trade details by price range")
+@app_commands.describe(min_price="Lowest price to include", max_price="Highest price to include", allowed_user="Optional user who can also interact with the buttons")
+async def fetch_trade_by_price_range(interaction: discord.Interaction, min_price: Optional[float] = None, max_price: Optional[float] = None, allowed_user: discord.Member = None):
+    try:
+        await interaction.response.defer()  # Defer the response to allow more time for processing
+        # Compare the parsed numeric prices instead of matching price text
+        query = TradeQuery([PriceRange(min_price, max_price)])
+        await send_trade_query(interaction, query, allowed_user, f"No trades found with prices between {min_price if min_price is not None else 'any'} and {max_price if max_price is not None else 'any'}.")
+    except Exception as e:
+        await interaction.followup.send(f"An error occurred: {str(e)}")
+
+# Function to format a price summary from the trade index
+def format_price_summary(summary):
+    return (f"**Trades:** {summary['count']} | **Total:** {summary['total']:,.2f} | **Mean:** {summary['mean']:,.2f}\n"
+            f"**Median:** {summary['p50']:,.2f} | **P25:** {summary['p25']:,.2f} | **P75:** {summary['p75']:,.2f} | **P90:** {summary['p90']:,.2f}")
+
+@bot.tree.command(name="price_stats", description="Price totals, averages and percentiles per buyer, category or item")
+@app_commands.describe(group_by="Column to group the trades by", top="Number of groups to show, largest total first")
+@app_commands.choices(group_by=[
+    app_commands.Choice(name="buyer", value=FIELDS["buyer"]),
+    app_commands.Choice(name="category", value=FIELDS["category"]),
+    app_commands.Choice(name="item", value=FIELDS["item"]),
+    app_commands.Choice(name="user id", value=FIELDS["user_id"]),
+])
+async def price_stats(interaction: discord.Interaction, group_by: app_commands.Choice[str], top: app_commands.Range[int, 1, 24] = 10):
+    try:
+        await interaction.response.defer()  # Defer the response to allow more time for processing
+        trades, _ = await guild_trades(interaction)
+        snapshot = await indexed_snapshot(trades)
+        overall = trades.index.prices.summary(len(snapshot))
+        if overall is None:
+            await interaction.followup.send("No numeric prices found.")
+            return
+        # Sorting every price by group is CPU work, so it runs off the event loop
+        groups, group_count = await asyncio.to_thread(trades.index.price_stats, group_by.value, snapshot, top)
+        embed = discord.Embed(title=f"Price Stats by {group_by.name}", color=discord.Color.blue())
+        embed.description = format_price_summary(overall)
+        for label, summary in groups:
+            embed.add_field(name=(label or 'N/A')[:256], value=format_price_summary(summary), inline=False)
+        embed.set_footer(text=f"Top {len(groups)} of {group_count} groups by total")
+        await interaction.followup.send(embed=embed)
+    except Exception as e:
+        await interaction.followup.send(f"An error occurred: {str(e)}")
+
+@bot.tree.command(name="trade_stats", description="Trade counts, price totals and averages per buyer, user id, category, item or month")
+@app_commands.describe(group_by="What to group the trades by", order="Which figure to rank the groups by", top="Number of groups to show")
+@app_commands.choices(group_by=[
+    app_commands.Choice(name="buyer", value=FIELDS["buyer"]),
+    app_commands.Choice(name="user id", value=FIELDS["user_id"]),
+    app_commands.Choice(name="category", value=FIELDS["category"]),
+    app_commands.Choice(name="item", value=FIELDS["item"]),
+    app_commands.Choice(name="month", value="month"),
+], order=[
+    app_commands.Choice(name="total", value="total"),
+    app_commands.Choice(name="trades", value="trades"),
+    app_commands.Choice(name="average", value="mean"),
+    app_commands.Choice(name="name (months oldest first)", value="group"),
+])
+async def trade_stats(interaction: discord.Interaction, group_by: app_commands.Choice[str], order: Optional[app_commands.Choice[str]] = None, top: app_commands.Range[int, 1, 24] = 10):
+    try:
+        await interaction.response.defer()  # Defer the response to allow more time for processing
+        # The totals are kept up to date as rows come in; this only picks up sheet changes
+        trades, _ = await guild_trades(interaction)
+        await indexed_snapshot(trades)
+        order_name, order = (order.name, order.value) if order else ("total", "total")
+        totals = trades.index.group_totals(group_by.value)
+        if not len(totals):
+            await interaction.followup.send("No trades found.")
+            return
+        embed = discord.Embed(title=f"Trade Stats by {group_by.name}", color=discord.Color.blue())
+        embed.description = format_trade_totals(*totals.overall)
+        for label, count, priced, total, _ in totals.stats(order, top):
+            embed.add_field(name=(label or 'N/A')[:256], value=format_trade_totals(count, priced, total), inline=False)
+        embed.set_footer(text=f"Top {min(top, len(totals))} of {len(totals)} groups by {order_name}")
+        await interaction.followup.send(embed=embed)
+    except Exception as e:
+        await interaction.followup.send(f"An error occurred: {str(e)}")
+
+# Function to format the running totals of a group of trades
+def format_trade_totals(count, priced, total):
+    average = f"{total / priced:,.2f}" if priced else "N/A"
+    return f"**Trades:** {count:,} | **Total:** {total:,.2f} | **Average:** {average}"
+
 # New command to add a record
 @bot.tree.command(name="add_record", description="Add a new record to the trade sheet")
 @app_commands.describe(
@@ -362,109 +882,163 @@ async def add_record(
     category: Optional[str] = None,
     date: Optional[str] = None
 ):
-    try:
-        # Parse the date in dd/mm/yyyy format or use current date if empty
-        if date:
+    async with AutoDefer(interaction) as responder:
+        try:
+            # Parse the date in dd/mm/yyyy format (written as dd mmmm yyyy) or use current date if empty
             try:
-                parsed_date = datetime.strptime(date, "%d/%m/%Y")
-                formatted_date = parsed_date.strftime("%d %B %Y")  # Format the date as dd mmmm yyyy
-                print(f"Parsed date: {formatted_date}")  # Debug print
+                formatted_date = format_trade_date(date)
+                log.debug(f"Date: {formatted_date}")
             except ValueError:
-                await interaction.response.send_message("Invalid date format. Please use dd/mm/yyyy.")
+                await responder.send("Invalid date format. Please use dd/mm/yyyy.")
                 return
-        else:
-            parsed_date = datetime.now()
-            formatted_date = parsed_date.strftime("%d %B %Y")  # Format the date as dd mmmm yyyy
-            print(f"Using current date: {formatted_date}")  # Debug print
-        # Prepare the new row data
-        new_row_data = [
-            buyer or "",
-            user_id or "",
-            message_id or "",
-            item or "",
-            price or "",
-            category or "",
-            formatted_date
-        ]
-
-        print(f"New row data: {new_row_data}")  # Debug print
-
-        # Add the new row to the Google Sheet
-        trade_sheet.append_row(new_row_data, value_input_option='USER_ENTERED')
-        # Get the number of the last row (the row we just added)
-        last_row = len(trade_sheet.get_all_values())
-        print(f"Last row number: {last_row}")  # Debug print
-
-        # Set the format of the date column to 'DATE'
-        date_column_index = trade_column_titles.index("date") + 1
-        print(f"Date column index: {date_column_index}")  # Debug print
-        cell_range = f"{rowcol_to_a1(last_row, date_column_index)}:{rowcol_to_a1(last_row, date_column_index)}"
-        gf.format_cell_range(trade_sheet, cell_range, gf.cellFormat(
-            numberFormat=gf.numberFormat(type='DATE', pattern='dd mmmm yyyy')
-        ))
-
-        await interaction.response.send_message("Record added successfully!")
+            # Prepare the new row data
+            new_row_data = [
+                buyer or "",
+                user_id or "",
+                message_id or "",
+                item or "",
+                price or "",
+                category or "",
+                formatted_date
+            ]
+
+            log.debug(f"New row data: {new_row_data}")
+
+            # Queue the new row; it is appended and its date cell formatted as 'DATE' together
+            # with any other records submitted at the same time
+            trades, _ = await guild_trades(interaction)
+            last_row = await trades.writer.add(new_row_data)
+            log.debug(f"Last row number: {last_row}")
+
+            await responder.send("Record added successfully!")
+        except Exception as e:
+            await responder.send(f"An error occurred: {str(e)}")
+
+MAX_IMPORT_BYTES = 20 * 1024 * 1024
+PROGRESS_INTERVAL = 2.0  # Seconds between progress edits, to stay clear of Discord's edit rate limit
+
+@bot.tree.command(name="import_records", description="Add trade records in bulk from a CSV or TSV file")
+@app_commands.describe(file="CSV/TSV with buyer, user id, message id, item, price, category and date (dd/mm/yyyy) columns; a header row is optional")
+async def import_records(interaction: discord.Interaction, file: discord.Attachment):
+    try:
+        await interaction.response.defer()  # Defer the response to allow more time for processing
+        if file.size > MAX_IMPORT_BYTES:
+            await interaction.followup.send(f"The file is too large; the limit is {MAX_IMPORT_BYTES // (1024 * 1024)} MiB.")
+            return
+        data = await file.read()
+        # Every row is checked before anything is written, so a bad file adds nothing
+        rows, errors = await asyncio.to_thread(read_trade_rows, data, file.filename)
+        if errors:
+            lines = "\n".join(f"Line {line}: {message}" for line, message in errors[:MAX_REPORTED_ERRORS])
+            more = f"\n…and {len(errors) - MAX_REPORTED_ERRORS} more" if len(errors) > MAX_REPORTED_ERRORS else ""
+            await interaction.followup.send(f"Nothing was imported; {len(errors)} row(s) are invalid:\n{lines}{more}")
+            return
+        if not rows:
+            await interaction.followup.send("The file has no records.")
+            return
+
+        await interaction.edit_original_response(content=f"Importing {len(rows)} records…")
+        last_update = time.monotonic()
+
+        async def progress(written, total):
+            nonlocal last_update
+            if written < total and time.monotonic() - last_update >= PROGRESS_INTERVAL:
+                last_update = time.monotonic()
+                await interaction.edit_original_response(content=f"Importing records… {written}/{total}")
+
+        trades, _ = await guild_trades(interaction)
+        try:
+            first_row, last_row = await trades.writer.add_many(rows, progress=progress)
+        except PartialImport as e:
+            # Importing the file again would add the written records twice
+            ranges = ", ".join(f"{first}–{last}" for first, last in e.written)
+            await interaction.edit_original_response(content=f"Import stopped after {e.records} of {len(rows)} records: {str(e.error)}\n"
+                                                             f"Records 1–{e.records} were written to rows {ranges}; records {e.records + 1}–{len(rows)} were not imported.")
+            return
+        await interaction.edit_original_response(content=f"Imported {len(rows)} records into rows {first_row}–{last_row}.")
     except Exception as e:
-        await interaction.response.send_message(f"An error occurred: {str(e)}")
+        await interaction.followup.send(f"An error occurred: {str(e)}")
+
+# Drive file IDs by sheet name, most recently used last. Names that were not found are
+# remembered for a shorter time so a sheet created afterwards shows up soon.
+FILE_ID_TTL = 600
+MISSING_FILE_TTL = 60
+MAX_FILE_IDS = 1024
+file_ids = OrderedDict()
+file_ids_lock = threading.Lock()
 
-# Function to create a shareable link and change permissions with retry logic
+# Function to create a shareable link and change permissions. The permission and the link
+# are requested in one batch round trip; returns the link and the id of the permission.
 def create_share_link(file_id):
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            # Change permissions to make the file publicly accessible
-            permission = {
-                'type': 'anyone',
-                'role': 'reader',
-            }
-            drive_service.permissions().create(
-                fileId=file_id,
-                body=permission
-            ).execute()
-
-            # Get the shareable link
-            file = drive_service.files().get(fileId=file_id, fields='webViewLink').execute()
-            return file.get('webViewLink')
-        except HttpError as error:
-            if error.resp.status in [500, 503]:
-                time.sleep(2 ** attempt)  # Exponential backoff
-            else:
-                print(f'An error occurred: {error}')
-                return None
-    return None
+    try:
+        # Change permissions to make the file publicly accessible
+        permission = {
+            'type': 'anyone',
+            'role': 'reader',
+        }
+        created, file = scheduler.call(DRIVE, execute_batch, drive_service, [
+            drive_service.permissions().create(fileId=file_id, body=permission, fields='id'),
+            drive_service.files().get(fileId=file_id, fields='webViewLink'),
+        ], cost=2)
+        return file.get('webViewLink'), created.get('id')
+    except HttpError as error:
+        log.error(f'Could not share file {file_id}: {error}')
+        return None, None
 
-# Function to remove the shareable link and revert permissions
-def remove_share_link(file_id):
+# Function to remove the shareable link and revert permissions. With the id returned by
+# create_share_link it is a single request; otherwise the 'anyone' permissions are listed
+# first and then deleted together in one batch.
+def remove_share_link(file_id, permission_id=None):
     try:
-        # List the permissions
-        permissions = drive_service.permissions().list(fileId=file_id).execute()
-        for permission in permissions.get('permissions', []):
-            if permission['type'] == 'anyone':
-                # Remove the 'anyone' permission
-                drive_service.permissions().delete(
-                    fileId=file_id,
-                    permissionId=permission['id']
-                ).execute()
+        if permission_id is not None:
+            permission_ids = [permission_id]
+        else:
+            permissions = scheduler.execute(DRIVE, drive_service.permissions().list(fileId=file_id, fields='permissions(id,type)'))
+            permission_ids = [permission['id'] for permission in permissions.get('permissions', []) if permission['type'] == 'anyone']
+        if permission_ids:
+            deletions = [drive_service.permissions().delete(fileId=file_id, permissionId=permission_id) for permission_id in permission_ids]
+            # A permission that is already gone (reverted twice, or by hand) counts as removed
+            scheduler.call(DRIVE, execute_batch, drive_service, deletions, ignore_statuses=(404,), cost=len(deletions))
     except HttpError as error:
-        print(f'An error occurred: {error}')
+        log.error(f'Could not revert the permissions of file {file_id}: {error}')
+
+# Escape a value for a single-quoted string in a Drive `q` query
+def drive_query_string(value):
+    return value.replace('\\', '\\\\').replace("'", "\\'")
 
-# Function to get the file ID by name
+# Function to get the file ID by name, from the cache when the name was looked up recently
 def get_file_id_by_name(file_name):
+    now = time.monotonic()
+    with file_ids_lock:
+        cached = file_ids.get(file_name)
+        hit = cached is not None and cached[1] > now
+        telemetry.cache("file_ids", hit)
+        if hit:
+            file_ids.move_to_end(file_name)
+            return cached[0]
     try:
-        print(f"Searching for file with name: {file_name}")
-        response = drive_service.files().list(
-            q=f"name='{file_name}'",
+        log.debug(f"Searching for file with name: {file_name}")
+        response = scheduler.execute(DRIVE, drive_service.files().list(
+            q=f"name='{drive_query_string(file_name)}'",
             spaces='drive',
             fields='files(id, name)',
-        ).execute()
+        ), key=('file_id', file_name))
         files = response.get('files', [])
-        print(f"Found files: {files}")  # Debug log
-        if not files:
-            return None
-        return files[0]['id']
+        log.debug(f"Found files: {files}")
     except HttpError as error:
-        print(f'An error occurred: {error}')
+        log.error(f'Could not look up file {file_name!r}: {error}')
         return None
+    file_id = files[0]['id'] if files else None
+    with file_ids_lock:
+        file_ids[file_name] = (file_id, now + (FILE_ID_TTL if file_id else MISSING_FILE_TTL))
+        file_ids.move_to_end(file_name)
+        while len(file_ids) > MAX_FILE_IDS:
+            file_ids.popitem(last=False)
+    return file_id
+
+def forget_file_id(file_name):
+    with file_ids_lock:
+        file_ids.pop(file_name, None)
 
 @bot.tree.command(name="sheet_link", description="Share a Google Sheet and create a shareable link")
 @app_commands.describe(sheet_name="The name of the Google Sheet to share", allowed_user="Optional user who can also interact with the button")
@@ -472,21 +1046,23 @@ async def sheet_link(interaction: discord.Interaction, sheet_name: str, allowed_
     try:
         await interaction.response.send_message("Processing your request, please wait...")
 
-        file_id = get_file_id_by_name(sheet_name)
+        file_id = await run_blocking(get_file_id_by_name, sheet_name)
         if not file_id:
             await interaction.edit_original_response(content=f"No sheet found with the name {sheet_name}.")
             return
 
-        share_link = create_share_link(file_id)
+        share_link, permission_id = await run_blocking(create_share_link, file_id)
         if share_link:
-            view = RevertPermissionView(file_id, user_id=interaction.user.id, allowed_user_id=allowed_user.id if allowed_user else None)
+            key = await asyncio.to_thread(view_registry.register, ["revert", file_id, permission_id])
+            view = RevertPermissionView(key, user_id=interaction.user.id, allowed_user_id=allowed_user.id if allowed_user else None)
             await interaction.edit_original_response(content=f"Sheet shared successfully! [View Sheet]({share_link})", view=view)
         else:
+            forget_file_id(sheet_name)  # The cached ID may belong to a sheet that was deleted since
             await interaction.edit_original_response(content="Failed to create a shareable link.")
     except discord.errors.NotFound:
-        print("Failed to send follow-up message: interaction expired.")
+        log.warning("Failed to send follow-up message: interaction expired.")
     except Exception as e:
-        print(f"An error occurred: {str(e)}")
+        log.exception(f"An error occurred: {str(e)}")
 
 def create_poolfind_embed(data, inputs):
     embed = discord.Embed(title="Pool Finder Results", color=discord.Color.blue())
@@ -517,8 +1093,17 @@ def create_poolfind_embed(data, inputs):
 
     return embed
 
+# "Did you mean" lines for the /poolfind inputs that matched no talent, closest names first
+def format_suggestions(suggestions):
+    lines = []
+    for value, names in suggestions:
+        if names:
+            lines.append(f"`{value}` not found, did you mean: " + ", ".join(f"**{name}**" for name in names) + "?")
+    return "\n".join(lines)
+
 @bot.tree.command(name="poolfind", description="Find data in the pool finder sheet")
 @app_commands.describe(required_input="Required value for column B", optional_input_1="Optional value 1 for column B", optional_input_2="Optional value 2 for column B", optional_input_3="Optional value 3 for column B", optional_input_4="Optional value 4 for column B")
+@app_commands.autocomplete(required_input=talent_name_autocomplete, optional_input_1=talent_name_autocomplete, optional_input_2=talent_name_autocomplete, optional_input_3=talent_name_autocomplete, optional_input_4=talent_name_autocomplete)
 async def poolfind(interaction: discord.Interaction, required_input: str, optional_input_1: Optional[str] = None, optional_input_2: Optional[str] = None, optional_input_3: Optional[str] = None, optional_input_4: Optional[str] = None):
     try:
         await interaction.response.defer()  # Defer the interaction response to allow more time for processing
@@ -530,29 +1115,125 @@ async def poolfind(interaction: discord.Interaction, required_input: str, option
         if optional_input_3: inputs.append(optional_input_3)
         if optional_input_4: inputs.append(optional_input_4)
 
-        data = get_data_based_on_selection(SPREADSHEET_ID, inputs, creds)
-        if data:
-            embed = create_poolfind_embed(data, inputs)
-            await interaction.followup.send(embed=embed)
+        settings = sheets.settings(interaction.guild_id)
+        index = await run_blocking(load_pool, settings.pool_sheet_id, settings.pool_sheet_name)
+        # Every index has its own version, so the terms need not name the sheet. Only the
+        # matching rows and suggested names are cached: the reply echoes what this user typed.
+        inputs = [value.strip() for value in inputs]
+        terms = tuple(normalize_input(value) for value in inputs)
+        cached = result_cache.get("poolfind", terms, index.version)
+        if cached is None:
+            cached = (index.select(terms), dict(index.suggest(terms)))
+            size = 512 + sum(64 + sum(len(str(cell)) for cell in row) for row in cached[0])
+            result_cache.put("poolfind", terms, index.version, cached, size + sum(64 + len(name) for names in cached[1].values() for name in names))
+        data, suggested = cached
+        embed = create_poolfind_embed(data, inputs) if data else None
+        hint = format_suggestions((value, suggested[term]) for value, term in zip(inputs, terms) if term in suggested)
+        if embed:
+            await interaction.followup.send(content=hint or None, embed=embed)
         else:
-            await interaction.followup.send("No data found for the given selections.")
+            await interaction.followup.send("No data found for the given selections." + (f"\n{hint}" if hint else ""))
     except Exception as e:
         await interaction.followup.send(f"An error occurred: {str(e)}")
 
 @bot.tree.command(name="talenttype", description="Find talents by talent type in the pool finder sheet")
 @app_commands.describe(talent_type="Talent type to search for in column C")
+@app_commands.autocomplete(talent_type=talent_type_autocomplete)
 async def talenttype(interaction: discord.Interaction, talent_type: str):
     try:
         await interaction.response.defer()  # Defer the interaction response to allow more time for processing
 
-        data, exact_talent_type = get_data_by_talent_type(SPREADSHEET_ID, talent_type, creds)
+        settings = sheets.settings(interaction.guild_id)
+        index = await run_blocking(load_pool, settings.pool_sheet_id, settings.pool_sheet_name)
+        terms = normalize_input(talent_type.strip())
+        cached = result_cache.get("talenttype", terms, index.version)
+        if cached is None:
+            cached = index.talent_type(terms)
+            result_cache.put("talenttype", terms, index.version, cached, 256 + sum(64 + len(name) for name in cached[0]))
+        data, exact_talent_type = cached
         if data:
-            paginator = TalentTypePaginator(data, exact_talent_type=exact_talent_type)
+            spec = ["talent_type", exact_talent_type, settings.pool_sheet_id, settings.pool_sheet_name]
+            key = await asyncio.to_thread(view_registry.register, spec)
+            paginator = TalentTypePaginator(key, data, exact_talent_type=exact_talent_type)
             await paginator.send_initial_message(interaction)
         else:
             await interaction.followup.send("No data found for the given talent type.")
     except Exception as e:
         await interaction.followup.send(f"An error occurred: {str(e)}")
 
+@bot.tree.command(name="configure_sheets", description="Set the trade and pool finder sheets this server uses")
+@app_commands.describe(
+    trade_sheet_id="ID of the trade records spreadsheet (the long part of its URL), or \"default\" for the shared one",
+    pool_sheet_id="ID of the pool finder spreadsheet, or \"default\" for the shared one",
+    pool_sheet_name="Tab of the pool finder spreadsheet that lists the talents, or \"default\""
+)
+@app_commands.default_permissions(administrator=True)
+@app_commands.guild_only()
+async def configure_sheets(interaction: discord.Interaction, trade_sheet_id: Optional[str] = None, pool_sheet_id: Optional[str] = None, pool_sheet_name: Optional[str] = None):
+    try:
+        settings = await asyncio.to_thread(sheets.configure, interaction.guild_id, trade_sheet_id, pool_sheet_id, pool_sheet_name)
+        await interaction.response.send_message(
+            f"Trade sheet: `{settings.trade_sheet_id}`\nPool finder sheet: `{settings.pool_sheet_id}` ({settings.pool_sheet_name})\n"
+            "They are loaded the next time a command uses them.", ephemeral=True)
+    except PermissionError as e:
+        await interaction.response.send_message(str(e), ephemeral=True)
+    except Exception as e:
+        await interaction.response.send_message(f"An error occurred: {str(e)}", ephemeral=True)
+
+def format_latency(histogram):
+    p50, p99 = histogram.quantile(0.5), histogram.quantile(0.99)
+    return f"{histogram.count} calls, p50 ≤ {p50 * 1000:g} ms, p99 ≤ {p99 * 1000:g} ms"
+
+def format_bytes(count):
+    for unit in ("B", "KiB", "MiB"):
+        if count < 1024:
+            return f"{count:.0f} {unit}"
+        count /= 1024
+    return f"{count:.1f} GiB"
+
+# Lines of one histogram per label value, slowest p99 first
+def latency_lines(name, label):
+    histograms = sorted(telemetry.histogram_values(name).items(), key=lambda item: item[1].quantile(0.99), reverse=True)
+    return [f"`{dict(labels).get(label, '-')}`: {format_latency(histogram)}" for labels, histogram in histograms]
+
+def counter_total(name, **labels):
+    return sum(value for key, value in telemetry.counter_values(name).items() if all(dict(key).get(k) == v for k, v in labels.items()))
+
+@bot.tree.command(name="bot_stats", description="Command latency, Google API usage and cache hit rates")
+@app_commands.default_permissions(administrator=True)
+async def bot_stats(interaction: discord.Interaction):
+    uptime = int(time.time() - telemetry.started_at)
+    embed = discord.Embed(title="Bot statistics", color=discord.Color.dark_grey())
+    embed.description = f"Up for {uptime // 3600}h {uptime % 3600 // 60}m"
+
+    embed.add_field(name="Commands", value=truncate("\n".join(latency_lines("command_seconds", "command")) or "None yet", FIELD_VALUE_LIMIT), inline=False)
+
+    google = []
+    for bucket in scheduler.buckets:
+        histogram = telemetry.histogram_values("google_call_seconds").get((("bucket", bucket),))
+        if histogram is None:
+            continue
+        google.append(
+            f"`{bucket}`: {format_latency(histogram)}, {counter_total('google_quota_errors_total', bucket=bucket)} quota errors, "
+            f"{counter_total('google_retries_total', bucket=bucket)} retries, {counter_total('google_coalesced_total', bucket=bucket)} coalesced"
+        )
+    fetched = {dict(labels)['api']: value for labels, value in telemetry.counter_values("google_bytes_fetched_total").items()}
+    google.extend(f"`{api}` fetched {format_bytes(count)}" for api, count in sorted(fetched.items()))
+    embed.add_field(name="Google API", value=truncate("\n".join(google) or "No calls yet", FIELD_VALUE_LIMIT), inline=False)
+
+    caches = [f"`{cache}`: {hits / (hits + misses):.0%} of {hits + misses}" for cache, (hits, misses) in sorted(telemetry.cache_rates().items())]
+    embed.add_field(name="Cache hit rates", value=truncate("\n".join(caches) or "No lookups yet", FIELD_VALUE_LIMIT), inline=False)
+
+    loaded = sheets.loaded()
+    embed.add_field(name="Sheets", value=(
+        f"{len(loaded)} loaded, about {format_bytes(sheets.memory_size())} of {format_bytes(sheets.max_bytes)}\n"
+        f"{counter_total('sheet_loads_total')} loads, {counter_total('sheet_evictions_total')} evictions"
+    ), inline=False)
+
+    embed.add_field(name="Rendering", value=truncate("\n".join(latency_lines("render_seconds", "view")) or "Nothing rendered yet", FIELD_VALUE_LIMIT), inline=False)
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 
-bot.run('TOKEN')
+if __name__ == "__main__":
+    # Logging is already set up through the queue listener; keep discord.py from adding its own handler
+    bot.run('TOKEN', log_handler=None)
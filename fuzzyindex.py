@@ -0,0 +1,72 @@
+import difflib
+import heapq
+import re
+from collections import Counter, defaultdict
+from itertools import chain
+
+# Typo-tolerant lookups over a set of labels, for "did you mean" suggestions. Each label
+# is split into character trigrams once, when the index is built; a query only counts the
+# trigrams it shares with each label through the posting lists, then reranks the few best
+# candidates by edit similarity.
+
+MIN_OVERLAP = 0.3  # Share of trigrams a candidate must have in common with the query (Dice)
+MIN_SIMILARITY = 0.6  # difflib ratio a suggestion must reach
+CANDIDATES_PER_RESULT = 2  # Candidates reranked by edit similarity per suggestion asked for
+
+
+# Lowercase letters and digits only, so "swift foot", "Swift-Foot" and "swiftfoot" compare equal
+def compact_key(label):
+    return re.sub(r'[^0-9a-z]', '', label.lower())
+
+
+def trigrams(key):
+    padded = f"  {key} "
+    return {padded[start:start + 3] for start in range(len(padded) - 2)}
+
+
+class FuzzyIndex:
+    def __init__(self, labels=()):
+        self.labels = []
+        self.keys = []
+        self.sizes = []
+        self.postings = defaultdict(list)
+        seen = set()
+        for label in labels:
+            label = str(label).strip()
+            key = compact_key(label)
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            grams = trigrams(key)
+            for gram in grams:
+                self.postings[gram].append(len(self.labels))
+            self.labels.append(label)
+            self.keys.append(key)
+            self.sizes.append(len(grams))
+        self.postings = dict(self.postings)
+
+    def __len__(self):
+        return len(self.labels)
+
+    # Up to `limit` labels closest to `query`, best first, as (label, similarity) pairs
+    def suggest(self, query, limit=5):
+        key = compact_key(query)
+        if not key:
+            return []
+        grams = trigrams(key)
+        shared = Counter(chain.from_iterable(self.postings.get(gram, ()) for gram in grams))
+
+        sizes = self.sizes
+        overlaps = [(2 * count / (len(grams) + sizes[position]), position) for position, count in shared.items()]
+        overlaps = heapq.nlargest(limit * CANDIDATES_PER_RESULT, (pair for pair in overlaps if pair[0] >= MIN_OVERLAP))
+
+        matcher = difflib.SequenceMatcher(autojunk=False)
+        matcher.set_seq2(key)
+        scored = []
+        for _, position in overlaps:
+            matcher.set_seq1(self.keys[position])
+            similarity = matcher.ratio()
+            if similarity >= MIN_SIMILARITY:
+                scored.append((-similarity, self.labels[position]))
+        scored.sort()
+        return [(label, -similarity) for similarity, label in scored[:limit]]
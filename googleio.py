@@ -0,0 +1,129 @@
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import discord
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.http import build_http
+from gscheduler import INTERACTIVE, error_status, in_lane
+from telemetry import count_http_bytes
+
+
+# Blocking Google API calls (gspread, googleapiclient) run on this bounded pool so a slow
+# request never stalls the discord.py event loop, heartbeats or other users' commands
+MAX_WORKERS = 8
+DEFAULT_TIMEOUT = 20
+executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="google-io")
+
+# Interactions must be acknowledged within 3 seconds; defer once this much of it is gone
+DEFER_AFTER = 2.0
+
+
+# Run a blocking function on the Google I/O pool and wait for it for at most `timeout` seconds.
+# On timeout the worker thread finishes in the background but the caller gets asyncio.TimeoutError.
+# The Google calls it makes are scheduled in `lane`; background jobs pass BACKGROUND.
+async def run_blocking(func, *args, timeout=DEFAULT_TIMEOUT, lane=INTERACTIVE, **kwargs):
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(executor, functools.partial(in_lane, lane, func, *args, **kwargs))
+    return await asyncio.wait_for(future, timeout)
+
+
+_discovery_documents = {}
+_discovery_lock = threading.Lock()
+_local = threading.local()
+
+
+# Discovery document of a Google API, read once per process from the copy bundled with
+# googleapiclient instead of being parsed (or downloaded) again for every service
+def get_discovery_document(api, version):
+    with _discovery_lock:
+        key = (api, version)
+        if key not in _discovery_documents:
+            _discovery_documents[key] = discovery_cache.get_static_doc(api, version)
+        return _discovery_documents[key]
+
+
+# Long-lived service for the calling thread. googleapiclient services share one httplib2
+# connection that is not thread-safe, so each pool thread keeps its own per API and
+# credentials and reuses it (and its open connection) for every later call. The bytes
+# of every response are counted in the telemetry.
+def get_service(api, version, creds):
+    services = _local.__dict__.setdefault('services', {})
+    key = (api, version, id(creds))
+    service = services.get(key)
+    if service is None:
+        document = get_discovery_document(api, version)
+        http = count_http_bytes(creds.authorize(build_http()), api)
+        if document:
+            service = build_from_document(document, http=http)
+        else:
+            service = build(api, version, http=http, cache_discovery=False)
+        services[key] = service
+    return service
+
+
+# Module-level handle for a service that resolves to the calling thread's instance
+class ThreadLocalService:
+    def __init__(self, api, version, creds):
+        self.api = api
+        self.version = version
+        self.creds = creds
+
+    def __getattr__(self, name):
+        return getattr(get_service(self.api, self.version, self.creds), name)
+
+
+# Send several requests of one googleapiclient service in a single batch HTTP round trip.
+# Returns their responses in order and raises the first error, except for errors whose
+# status is in `ignore_statuses` (their response is None).
+def execute_batch(service, requests, ignore_statuses=()):
+    responses = [None] * len(requests)
+    errors = []
+
+    def collect(request_id, response, exception):
+        if exception is None:
+            responses[int(request_id)] = response
+        elif error_status(exception) not in ignore_statuses:
+            errors.append(exception)
+
+    batch = service.new_batch_http_request(callback=collect)
+    for position, request in enumerate(requests):
+        batch.add(request, request_id=str(position))
+    batch.execute()
+    if errors:
+        raise errors[0]
+    return responses
+
+
+# Replies to an interaction, deferring it automatically when the 3-second deadline gets close.
+# Use as `async with AutoDefer(interaction) as responder:` and send through responder.send().
+class AutoDefer:
+    def __init__(self, interaction: discord.Interaction, after=DEFER_AFTER):
+        self.interaction = interaction
+        self.after = after
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._defer_when_due())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # Cancelling under the lock never interrupts a defer() that is already in flight
+        async with self._lock:
+            self._task.cancel()
+
+    async def _defer_when_due(self):
+        elapsed = (discord.utils.utcnow() - self.interaction.created_at).total_seconds()
+        await asyncio.sleep(max(0.0, self.after - elapsed))
+        async with self._lock:
+            if not self.interaction.response.is_done():
+                await self.interaction.response.defer()
+
+    async def send(self, content=None, **kwargs):
+        async with self._lock:
+            self._task.cancel()
+            if self.interaction.response.is_done():
+                return await self.interaction.followup.send(content, **kwargs)
+            return await self.interaction.response.send_message(content, **kwargs)
@@ -0,0 +1,183 @@
+import random
+import threading
+import time
+from concurrent.futures import Future
+from telemetry import telemetry
+
+# Every Sheets and Drive call made by the bot goes through one scheduler, on the worker
+# thread that makes the call. It keeps the service account under Google's per-minute
+# quotas with a token bucket per quota bucket, lets interactive commands go ahead of
+# background refreshes, answers identical reads that are already in flight with the
+# result of the first one, and retries rate-limited and transient failures with jitter.
+
+# Quota buckets and the per-minute request limits of one service account
+SHEETS_READ = "sheets_read"
+SHEETS_WRITE = "sheets_write"
+DRIVE = "drive"
+QUOTAS = {SHEETS_READ: 60, SHEETS_WRITE: 60, DRIVE: 600}
+
+# Priority lanes
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+# Share of each bucket that background calls leave for interactive ones
+BACKGROUND_RESERVE = 0.25
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_BACKOFF = 16
+
+_local = threading.local()
+
+
+def current_lane():
+    return getattr(_local, 'lane', INTERACTIVE)
+
+
+# Run func with every Google call it makes scheduled in `lane`
+def in_lane(lane, func, *args, **kwargs):
+    previous = current_lane()
+    _local.lane = lane
+    try:
+        return func(*args, **kwargs)
+    finally:
+        _local.lane = previous
+
+
+# HTTP status of a googleapiclient HttpError or gspread APIError, or None for other errors
+def error_status(error):
+    resp = getattr(error, 'resp', None)
+    if resp is not None and getattr(resp, 'status', None) is not None:
+        status = int(resp.status)
+    else:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    # Drive reports per-user rate limits as 403 rateLimitExceeded / userRateLimitExceeded
+    if status == 403 and 'ratelimitexceeded' in str(error).lower():
+        return 429
+    return status
+
+
+# Seconds the server asked us to wait before retrying, if it said so
+def retry_after(error):
+    headers = getattr(error, 'resp', None)
+    if headers is None:
+        headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after') or headers.get('Retry-After'))
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+# Token bucket refilled continuously at `per_minute` requests a minute. The burst is a
+# quarter of the minute's quota so a burst followed by the steady rate stays under it.
+class TokenBucket:
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst or max(1, per_minute // 4)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._condition = threading.Condition()
+        self._interactive_waiting = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Take one token, waiting until there is one. Background callers leave a reserve for
+    # interactive ones and never take a token while an interactive caller is waiting.
+    def acquire(self, lane=INTERACTIVE):
+        interactive = lane != BACKGROUND
+        needed = 1.0 if interactive else min(self.capacity, 1.0 + self.capacity * BACKGROUND_RESERVE)
+        with self._condition:
+            if interactive:
+                self._interactive_waiting += 1
+            try:
+                while True:
+                    self._refill()
+                    if not interactive and self._interactive_waiting:
+                        self._condition.wait()  # Woken when the interactive callers are served
+                        continue
+                    if self.tokens >= needed:
+                        self.tokens -= 1
+                        return
+                    self._condition.wait((needed - self.tokens) / self.rate)
+            finally:
+                if interactive:
+                    self._interactive_waiting -= 1
+                    self._condition.notify_all()
+
+    # Empty the bucket after a quota error so every caller slows down, not just the one that hit it
+    def drain(self):
+        with self._condition:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+
+
+class GoogleScheduler:
+    def __init__(self, quotas=QUOTAS, retries=5):
+        self.buckets = {bucket: TokenBucket(per_minute) for bucket, per_minute in quotas.items()}
+        self.retries = retries
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    # Call func(*args, **kwargs) against `bucket`. Calls with the same `key` that overlap
+    # share a single request and all get its result, so keyed results must not be mutated.
+    # Writes that are not safe to repeat pass idempotent=False and are only retried when
+    # Google refused them outright (429). A batch request passes the number of requests
+    # it carries as `cost`, since each of them counts against the quota.
+    def call(self, bucket, func, *args, key=None, idempotent=True, cost=1, **kwargs):
+        if key is None:
+            return self._call(bucket, func, args, kwargs, idempotent, cost)
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+        if not leader:
+            telemetry.inc("google_coalesced_total", bucket=bucket)
+            return future.result()
+        try:
+            result = self._call(bucket, func, args, kwargs, idempotent, cost)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    # Execute a googleapiclient request
+    def execute(self, bucket, request, key=None, idempotent=True):
+        return self.call(bucket, request.execute, key=key, idempotent=idempotent)
+
+    def _call(self, bucket, func, args, kwargs, idempotent, cost):
+        token_bucket = self.buckets[bucket]
+        lane = current_lane()
+        for attempt in range(self.retries):
+            with telemetry.timer("google_throttle_seconds", bucket=bucket, lane=lane):
+                for _ in range(cost):
+                    token_bucket.acquire(lane)
+            telemetry.inc("google_calls_total", cost, bucket=bucket)
+            started = time.perf_counter()
+            try:
+                result = func(*args, **kwargs)
+                telemetry.observe("google_call_seconds", time.perf_counter() - started, bucket=bucket)
+                return result
+            except Exception as e:
+                status = error_status(e)
+                telemetry.observe("google_call_seconds", time.perf_counter() - started, bucket=bucket)
+                telemetry.inc("google_errors_total", bucket=bucket, status=status or "none")
+                if status == 429:
+                    token_bucket.drain()
+                    telemetry.inc("google_quota_errors_total", bucket=bucket)
+                retryable = status == 429 or (idempotent and status in RETRY_STATUSES)
+                if not retryable or attempt == self.retries - 1:
+                    raise
+                telemetry.inc("google_retries_total", bucket=bucket)
+                # Exponential backoff with full jitter, unless the server said how long to wait
+                delay = retry_after(e)
+                time.sleep(delay if delay is not None else random.uniform(0, min(MAX_BACKOFF, 2 ** attempt)))
+
+
+# The process-wide scheduler shared by the bot, the trade store and the pool finder
+scheduler = GoogleScheduler()
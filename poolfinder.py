@@ -1,22 +1,41 @@
-from oauth2client.service_account import ServiceAccountCredentials
-from googleapiclient.discovery import build
-import re
+import itertools
+import logging
+import threading
+import time
+from googleio import get_service
+from gscheduler import DRIVE, SHEETS_READ, scheduler
+from telemetry import telemetry
+from prefixindex import PrefixIndex, normalize_input
+from fuzzyindex import FuzzyIndex
+
+log = logging.getLogger(__name__)
+
+POOL_SHEET_NAME = "Pet Talents Priority List"
+
+# Rough bytes a pool sheet row takes once indexed (names, types, completions, trigrams)
+POOL_ROW_BYTES = 1100
+
+_index_versions = itertools.count(1)
 
 def initialize_sheets_api(creds):
-    service = build('sheets', 'v4', credentials=creds)
+    # Reuse the calling thread's long-lived Sheets service instead of building a new one per request
+    service = get_service('sheets', 'v4', creds)
     return service.spreadsheets()
 
 def fetch_data(spreadsheet_id, sheet_name, range_name, creds):
     full_range = f"'{sheet_name}'!{range_name}"
     sheets = initialize_sheets_api(creds)
-    result = sheets.values().get(spreadsheetId=spreadsheet_id, range=full_range).execute()
+    request = sheets.values().get(spreadsheetId=spreadsheet_id, range=full_range)
+    result = scheduler.execute(SHEETS_READ, request, key=('values', spreadsheet_id, full_range))
     values = result.get('values', [])
     return values
 
 def fetch_hyperlinks(spreadsheet_id, sheet_name, col_range, creds):
     full_range = f"'{sheet_name}'!{col_range}"
     sheets = initialize_sheets_api(creds)
-    result = sheets.get(spreadsheetId=spreadsheet_id, ranges=full_range, fields="sheets.data.rowData.values.hyperlink,sheets.data.rowData.values.formattedValue").execute()
+    fields = "sheets.data.rowData.values.hyperlink,sheets.data.rowData.values.formattedValue"
+    request = sheets.get(spreadsheetId=spreadsheet_id, ranges=full_range, fields=fields)
+    result = scheduler.execute(SHEETS_READ, request, key=('grids', spreadsheet_id, full_range, fields))
     hyperlinks = []
     for row in result.get('sheets', [])[0].get('data', [])[0].get('rowData', []):
         cell = row.get('values', [{}])[0]
@@ -25,60 +44,177 @@ def fetch_hyperlinks(spreadsheet_id, sheet_name, col_range, creds):
         hyperlinks.append((formatted_value, hyperlink))
     return hyperlinks
 
+def fetch_grids(spreadsheet_id, sheet_name, ranges, creds):
+    # Fetch several ranges of a sheet in one field-masked spreadsheets.get round trip.
+    # Returns one grid per range; each grid is a list of rows of (formatted value, hyperlink) cells.
+    sheets = initialize_sheets_api(creds)
+    full_ranges = [f"'{sheet_name}'!{range_name}" for range_name in ranges]
+    fields = "sheets.data.rowData.values(formattedValue,hyperlink)"
+    # Identical fetches already in flight (several lookups right after a change) share one request
+    request = sheets.get(spreadsheetId=spreadsheet_id, ranges=full_ranges, fields=fields)
+    result = scheduler.execute(SHEETS_READ, request, key=('grids', spreadsheet_id, tuple(full_ranges), fields))
+    grids = []
+    for data in (result.get('sheets') or [{}])[0].get('data', []):
+        grid = []
+        for row in data.get('rowData', []):
+            grid.append([(cell.get('formattedValue', ''), cell.get('hyperlink')) for cell in row.get('values', [])])
+        grids.append(grid)
+    return grids
+
+def grid_values(grid):
+    # Plain values of a grid, trimmed the way values().get trims them
+    rows = []
+    for row in grid:
+        values = [value for value, _ in row]
+        while values and values[-1] == '':
+            values.pop()
+        rows.append(values)
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
 def fetch_data_and_hyperlinks(spreadsheet_id, sheet_name, data_range, hyperlink_range, creds):
-    data = fetch_data(spreadsheet_id, sheet_name, data_range, creds)
-    hyperlinks = fetch_hyperlinks(spreadsheet_id, sheet_name, hyperlink_range, creds)
-    return data, hyperlinks
-
-def normalize_input(value):
-    # Normalize the input by making it lowercase and replacing spaces and hyphens with a common character
-    return re.sub(r'[\s-]', '-', value.lower())
-
-def get_data_based_on_selection(sheet_id, inputs, creds):
-    # Updated sheet name and ranges
-    sheet_name = "Pet Talents Priority List"
-    data_range = "A:G"  # We need columns A to G
-    
-    # Fetch data
-    data = fetch_data(sheet_id, sheet_name, data_range, creds)
-    
-    # Normalize the inputs
-    normalized_inputs = [normalize_input(input) for input in inputs]
-    
-    # Process the data to include rows where column B matches any of the inputs
-    filtered_data = []
-    for row in data:
-        if len(row) >= 7:
-            normalized_row_b = normalize_input(row[1])
-            if normalized_row_b in normalized_inputs:
+    data_grid, hyperlink_grid = fetch_grids(spreadsheet_id, sheet_name, [data_range, hyperlink_range], creds)
+    hyperlinks = [(row[0][0] or 'N/A', row[0][1]) if row else ('N/A', None) for row in hyperlink_grid]
+    return grid_values(data_grid), hyperlinks
+
+def load_pool_sheet(spreadsheet_id, creds, sheet_name=POOL_SHEET_NAME):
+    # Values of columns A to G (priority, talent name, rarity, info, hyperlink, type, retired flag)
+    # together with the hyperlink on each talent name cell in column B, in a single request
+    grid = fetch_grids(spreadsheet_id, sheet_name, ["A:G"], creds)[0]
+    rows = grid_values(grid)
+    name_links = [row[1][1] if len(row) > 1 else None for row in grid[:len(rows)]]
+    return rows, name_links
+
+class PoolIndex:
+    # Lookup tables built once per revision of the pool sheet:
+    # normalized talent name -> prepared /poolfind rows, normalized talent type -> talent names,
+    # autocomplete indexes over the talent names and types, and a fuzzy index over the talent
+    # names for inputs that match nothing exactly. `version` tells indexes apart even when
+    # the Drive revision could not be fetched, so results cached for one never outlive it.
+    def __init__(self, rows, name_links, revision=None):
+        self.revision = revision
+        self.version = next(_index_versions)
+        self.row_count = len(rows)
+        self.by_name = {}
+        self.by_type = {}
+        for position, (row, name_link) in enumerate(zip(rows, name_links)):
+            if len(row) >= 7:
                 # Prepare additional info
                 additional_info = row[3]
                 if row[6].lower() == 'true':
                     additional_info += ", Retired"
-                filtered_data.append([row[0], row[1], row[2], additional_info, row[4]])
-    
-    return filtered_data
-
-def get_data_by_talent_type(sheet_id, talent_type, creds):
-    # Updated sheet name and ranges
-    sheet_name = "Pet Talents Priority List"
-    data_range = "B4:C"  # We only need columns B and C
-    
-    # Fetch data
-    data = fetch_data(sheet_id, sheet_name, data_range, creds)
-    
-    # Normalize the talent type input
-    normalized_talent_type = normalize_input(talent_type)
-
-    # Process the data to include rows where column C matches the talent type
-    filtered_data = []
-    exact_match_value = None
-    for row in data:
-        if len(row) >= 2:
-            normalized_row_talent_type = normalize_input(row[1])
-            if normalized_row_talent_type == normalized_talent_type:
-                filtered_data.append(row[0])  # Only add data from column B
-                if exact_match_value is None:
-                    exact_match_value = row[1]  # Capture the exact matching value
-    
-    return filtered_data, exact_match_value
\ No newline at end of file
+                # Fall back to the hyperlink on the talent name when column E has none
+                hyperlink = row[4] if row[4] and row[4].lower() != 'false' else (name_link or row[4])
+                result = [row[0], row[1], row[2], additional_info, hyperlink]
+                self.by_name.setdefault(normalize_input(row[1]), []).append((position, result))
+            # Talent types are listed from row 4 on, in column C
+            if position >= 3 and len(row) >= 3 and row[2]:
+                exact_value, names = self.by_type.setdefault(normalize_input(row[2]), (row[2], []))
+                names.append(row[1])
+        self.name_completions = PrefixIndex(results[0][1][1] for results in self.by_name.values())
+        self.type_completions = PrefixIndex(exact_value for exact_value, _ in self.by_type.values())
+        self.name_matches = FuzzyIndex(results[0][1][1] for results in self.by_name.values())
+
+    def select(self, inputs):
+        # Rows whose column B matches any of the inputs, in sheet order
+        matches = {}
+        for value in inputs:
+            for position, result in self.by_name.get(normalize_input(value), []):
+                matches[position] = result
+        return [matches[position] for position in sorted(matches)]
+
+    def suggest(self, inputs, limit=5):
+        # Closest talent names for each input without an exact match, as (input, names) pairs
+        suggestions = []
+        for value in inputs:
+            if normalize_input(value) not in self.by_name:
+                suggestions.append((value, [name for name, _ in self.name_matches.suggest(value, limit)]))
+        return suggestions
+
+    def talent_type(self, talent_type):
+        exact_value, names = self.by_type.get(normalize_input(talent_type), (None, []))
+        return list(names), exact_value
+
+class PoolCache:
+    # Holds the PoolIndex of one spreadsheet. Lookups never touch Sheets once it is built;
+    # check() compares the Drive file version and rebuilds only when the sheet changed.
+    def __init__(self, spreadsheet_id, creds, sheet_name=POOL_SHEET_NAME):
+        self.spreadsheet_id = spreadsheet_id
+        self.creds = creds
+        self.sheet_name = sheet_name
+        self.index = None
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, callback):
+        # callback(rows, name_links, revision) runs whenever the index is rebuilt from the sheet
+        self._listeners.append(callback)
+
+    def memory_size(self):
+        index = self.index
+        return index.row_count * POOL_ROW_BYTES if index is not None else 0
+
+    def close(self):
+        # Stop checking the sheet for changes; a later get_pool_cache() starts a new cache
+        with _pool_caches_lock:
+            key = (self.spreadsheet_id, self.sheet_name)
+            if _pool_caches.get(key) is self:
+                del _pool_caches[key]
+
+    def restore(self, rows, name_links, revision):
+        # Serve a locally saved copy until check() sees a different Drive revision
+        with self._lock:
+            self.index = PoolIndex(rows, name_links, revision)
+
+    def get(self):
+        index = self.index
+        telemetry.cache("pool_index", index is not None)
+        if index is None:
+            with self._lock:
+                if self.index is None:
+                    self._build(self._fetch_revision())
+                index = self.index
+        return index
+
+    def check(self):
+        with self._lock:
+            revision = self._fetch_revision()
+            self.checked_at = time.monotonic()
+            unchanged = self.index is not None and revision is not None and revision == self.index.revision
+            telemetry.cache("pool_revision", unchanged)
+            if not unchanged:
+                self._build(revision)
+            return self.index
+
+    def _build(self, revision):
+        rows, name_links = load_pool_sheet(self.spreadsheet_id, self.creds, self.sheet_name)
+        self.index = PoolIndex(rows, name_links, revision)
+        for callback in self._listeners:
+            callback(rows, name_links, revision)
+
+    def _fetch_revision(self):
+        try:
+            drive = get_service('drive', 'v3', self.creds)
+            request = drive.files().get(fileId=self.spreadsheet_id, fields='version,modifiedTime')
+            file = scheduler.execute(DRIVE, request, key=('version', self.spreadsheet_id))
+            return file.get('version') or file.get('modifiedTime')
+        except Exception as e:
+            log.warning(f"Could not fetch the pool sheet revision: {e}")
+            return None
+
+_pool_caches = {}
+_pool_caches_lock = threading.Lock()
+
+def get_pool_cache(sheet_id, creds, sheet_name=POOL_SHEET_NAME):
+    with _pool_caches_lock:
+        cache = _pool_caches.get((sheet_id, sheet_name))
+        if cache is None:
+            cache = _pool_caches[(sheet_id, sheet_name)] = PoolCache(sheet_id, creds, sheet_name)
+        return cache
+
+def check_pool_revisions():
+    # Rebuild the index of every pool sheet whose Drive revision moved; run periodically off the event loop
+    for cache in list(_pool_caches.values()):
+        cache.check()
@@ -0,0 +1,64 @@
+import bisect
+import re
+
+# Autocomplete lookups over a set of labels (talent names, talent types, buyers...).
+# Every word of every normalized label is a key in one sorted list, so completing a
+# prefix is a bisect plus a short scan and never touches the network.
+
+MAX_WORDS = 8
+
+
+def normalize_input(value):
+    # Normalize the input by making it lowercase and replacing spaces and hyphens with a common character
+    return re.sub(r'[\s-]', '-', value.lower())
+
+
+# (key, rank, label) entries of a label: the whole normalized label (rank 0), then the same
+# from the start of each later word, so "foot" finds "Swift Foot"
+def label_entries(label):
+    key = normalize_input(label)
+    starts = [0] + [match.end() for match in re.finditer(r'-+', key)][:MAX_WORDS - 1]
+    return [(key[start:], rank, label) for rank, start in enumerate(starts) if start < len(key)]
+
+
+class PrefixIndex:
+    def __init__(self, labels=()):
+        entries = set()
+        for label in labels:
+            label = str(label).strip()
+            if label:
+                entries.update(label_entries(label))
+        # One list of tuples rather than parallel lists, so a reader on another thread never
+        # sees an insert half done
+        self.entries = sorted(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    # Add one label in place; for many labels at once build a new index instead
+    def add(self, label):
+        label = str(label).strip()
+        if label:
+            for entry in label_entries(label):
+                position = bisect.bisect_left(self.entries, entry)
+                if position == len(self.entries) or self.entries[position] != entry:
+                    self.entries.insert(position, entry)
+
+    # Up to `limit` distinct labels with a word starting with `prefix`, labels that start
+    # with it first; an empty prefix lists labels from the top. The scan stops after a
+    # few times `limit` matches, so a one-letter prefix costs no more than a long one.
+    def complete(self, prefix, limit=25):
+        key = normalize_input(prefix.strip())
+        entries = self.entries
+        position = bisect.bisect_left(entries, (key,))
+        leading, inner = [], []
+        seen = set()
+        while position < len(entries) and len(leading) < limit and len(seen) < limit * 4:
+            entry_key, rank, label = entries[position]
+            if not entry_key.startswith(key):
+                break
+            if label not in seen:
+                seen.add(label)
+                (inner if rank else leading).append(label)
+            position += 1
+        return (leading + inner)[:limit]
@@ -0,0 +1,137 @@
+import functools
+import re
+
+# Discord embed limits
+FIELD_VALUE_LIMIT = 1024
+FIELD_NAME_LIMIT = 256
+FIELD_COUNT_LIMIT = 25
+EMBED_LIMIT = 6000
+
+# Room kept free in every embed for its title, footer and field names
+EMBED_OVERHEAD = 300
+MAX_ROWS_PER_PAGE = 10
+TRUNCATED = "…"
+
+
+# Regex matching any of the terms, built from a trie of the terms so the engine never
+# retries shared prefixes; optional branches are greedy, so the longest term wins
+def trie_pattern(terms):
+    trie = {}
+    for term in terms:
+        node = trie
+        for char in term:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def build(node):
+        branches = [re.escape(char) + build(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        if "" in node:
+            return body + "?" if len(branches) == 1 and len(branches[0]) == 1 else "(?:" + body + ")?"
+        return body
+
+    return build(trie)
+
+
+# Bolds every occurrence of the search terms in one pass with a single precompiled
+# pattern. The longest term wins where terms overlap ("1" inside "12"), and runs of
+# adjacent matches are bolded as one, so no text is ever bolded twice. Matching
+# ignores case like the trade filters do.
+class Highlighter:
+    def __init__(self, terms):
+        terms = {term.lower() for term in terms if term}
+        self.pattern = re.compile(f"(?:{trie_pattern(terms)})+", re.IGNORECASE) if terms else None
+
+    def __call__(self, text):
+        if text is None or self.pattern is None:
+            return text
+        return self.pattern.sub(r"**\g<0>**", text)
+
+
+@functools.lru_cache(maxsize=256)
+def _highlighter(terms):
+    return Highlighter(terms)
+
+
+def highlighter(search_terms):
+    return _highlighter(tuple(search_terms or ()))
+
+
+def truncate(text, limit):
+    return text if len(text) <= limit else text[:limit - len(TRUNCATED)] + TRUNCATED
+
+
+# "Row N" block for one row, with the search terms in bold
+def format_row(row_num, row_data, column_titles, highlight):
+    row_content = " | ".join(f"{title}: {highlight(data) or 'N/A'}" for title, data in zip(column_titles, row_data))
+    return f"Row {row_num}\n{row_content}\n\n"
+
+
+# Pack row blocks into (name, value) fields that respect the field and embed limits.
+# Blocks are kept whole when they fit in a field and split across fields otherwise;
+# whatever does not fit in the embed at all is cut off with a marker.
+def pack_fields(blocks, name="Records", budget=EMBED_LIMIT - EMBED_OVERHEAD):
+    fields = []
+    value = ""
+    for block in blocks:
+        while block:
+            room = FIELD_VALUE_LIMIT - len(value)
+            if len(block) <= room:
+                value += block
+                block = ""
+            elif value:
+                fields.append(value)
+                value = ""
+            else:
+                value, block = block[:FIELD_VALUE_LIMIT], block[FIELD_VALUE_LIMIT:]
+    if value:
+        fields.append(value)
+
+    packed = []
+    used = 0
+    for position, value in enumerate(fields[:FIELD_COUNT_LIMIT]):
+        field_name = name if position == 0 else f"{name} (cont.)"
+        room = budget - used - len(field_name)
+        if room <= len(TRUNCATED):
+            break
+        if len(value) > room or (position == FIELD_COUNT_LIMIT - 1 and len(fields) > FIELD_COUNT_LIMIT):
+            packed.append((field_name, truncate(value, min(room, len(value) - 1))))
+            break
+        packed.append((field_name, value))
+        used += len(field_name) + len(value)
+    return packed
+
+
+# Fields for a page of rows: highlighted, packed and within Discord's limits
+def render_rows(rows_data, column_titles, row_nums, search_terms):
+    highlight = highlighter(search_terms)
+    blocks = [format_row(row_num, row_data, column_titles, highlight) for row_num, row_data in zip(row_nums, rows_data)]
+    return pack_fields(blocks)
+
+
+# Fields for the detailed view of one row: one inline field per column, truncated to fit
+def render_detail(row_data, column_titles, budget=EMBED_LIMIT - EMBED_OVERHEAD):
+    fields = []
+    used = 0
+    for title, data in list(zip(column_titles, row_data))[:FIELD_COUNT_LIMIT]:
+        name = truncate(title or 'N/A', FIELD_NAME_LIMIT)
+        room = min(FIELD_VALUE_LIMIT, budget - used - len(name))
+        if room <= len(TRUNCATED):
+            break
+        value = truncate(data or 'N/A', room)
+        fields.append((name, value))
+        used += len(name) + len(value)
+    return fields
+
+
+# Rows per page that keeps a page of rows like `sample` within one embed
+def rows_per_page(sample, column_titles, maximum=MAX_ROWS_PER_PAGE, budget=EMBED_LIMIT - EMBED_OVERHEAD):
+    if not sample:
+        return maximum
+    highlight = highlighter(())
+    # Highlighting adds a few characters per match; leave a quarter of the budget for it
+    sizes = [len(format_row(0, row_data, column_titles, highlight)) for row_data in sample]
+    largest = max(sizes)
+    return max(1, min(maximum, (budget * 3 // 4) // max(largest, 1)))
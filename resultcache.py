@@ -0,0 +1,31 @@
+from telemetry import telemetry
+from viewregistry import BoundedCache
+
+# Results of repeated lookups (/poolfind, /talenttype, the trade queries), so asking the
+# same thing again neither scans nor renders anything. An entry is keyed on the command
+# and its normalized terms and remembers the version of the data it was computed from;
+# a lookup only hits on the same version, so a reload or an appended trade invalidates
+# it, and the stale entry is replaced by the next put.
+
+RESULT_CACHE_BYTES = 32 * 1024 * 1024
+RESULT_CACHE_TTL = 15 * 60  # Seconds a result is kept after its last use
+
+
+class ResultCache(BoundedCache):
+    def __init__(self, max_bytes=RESULT_CACHE_BYTES, ttl=RESULT_CACHE_TTL):
+        super().__init__("results", max_bytes, ttl)
+
+    # The result `command` gave for `terms` on data `version`, or None; results are never None
+    def get(self, command, terms, version):
+        entry = self._lookup((command, terms))
+        hit = entry is not None and entry[0] == version
+        if entry is not None and not hit:
+            telemetry.inc("result_cache_stale_total", command=command)
+        telemetry.cache(f"{command} results", hit)
+        return entry[1] if hit else None
+
+    def put(self, command, terms, version, result, size):
+        super().put((command, terms), (version, result), size)
+
+    def discard(self, test):
+        super().discard(lambda entry: test(entry[1]))
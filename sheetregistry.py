@@ -0,0 +1,256 @@
+import itertools
+import json
+import logging
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from poolfinder import POOL_SHEET_NAME, get_pool_cache
+from telemetry import telemetry
+from tradeindex import TradeIndex
+from tradepool import QueryPool
+from tradequery import FIELDS
+from tradestore import TradeStore
+from tradewriter import TradeWriter
+
+log = logging.getLogger(__name__)
+
+# Trade and pool sheets of every guild the bot serves. A guild is configured with its own
+# trade spreadsheet (by ID) and pool spreadsheet (by ID and tab), chosen among the ones
+# the operator's allowlist gives it; whatever a guild did not configure comes from the
+# default sheets. A sheet is loaded on first use, from the local
+# snapshot when there is one, and shared by every guild configured with it. When the
+# estimated memory of the loaded sheets goes over the budget, the least recently used
+# ones are dropped; their local snapshot makes loading them again cheap. Every sheet goes
+# through the same credentials, Google services and query worker processes.
+
+SHEET_MEMORY_BYTES = 2 * 1024 ** 3
+MIN_IDLE = 60  # Seconds a sheet must have gone unused before it can be evicted
+ROW_SAMPLE = 100
+# A trade sheet's rows and indexes take about this many times the size of the cells
+# alone (measured on the benchmark sheet: ~530 B of cells and ~3.4 KiB of index per row)
+INDEXED_ROW_FACTOR = 7
+
+
+# Which spreadsheets each guild may use, kept by whoever runs the bot rather than by guild
+# admins: {"<guild id>": ["<spreadsheet id>", ...]}. Without the file every guild keeps
+# the default sheets.
+def load_allowlist(path):
+    try:
+        with open(path, encoding="utf-8") as file:
+            return {int(guild_id): set(sheet_ids) for guild_id, sheet_ids in json.load(file).items()}
+    except FileNotFoundError:
+        log.warning(f"No sheet allowlist at {path}; every server uses the default sheets")
+        return {}
+
+
+# What /configure_sheets takes to put a setting back to the default sheets
+USE_DEFAULT = "default"
+
+
+# Sheets of one guild; a None setting means the default one
+class GuildSheets:
+    __slots__ = ("trade_sheet_id", "pool_sheet_id", "pool_sheet_name")
+
+    def __init__(self, trade_sheet_id, pool_sheet_id, pool_sheet_name=POOL_SHEET_NAME):
+        self.trade_sheet_id = trade_sheet_id
+        self.pool_sheet_id = pool_sheet_id
+        self.pool_sheet_name = pool_sheet_name
+
+    # The same settings with the given ones changed; None keeps the current value and
+    # USE_DEFAULT clears it
+    def replace(self, trade_sheet_id=None, pool_sheet_id=None, pool_sheet_name=None):
+        def changed(current, value):
+            if value is None:
+                return current
+            return None if value.strip().lower() == USE_DEFAULT else value.strip()
+        return GuildSheets(changed(self.trade_sheet_id, trade_sheet_id), changed(self.pool_sheet_id, pool_sheet_id),
+                           changed(self.pool_sheet_name, pool_sheet_name))
+
+
+# Store versions restart when an evicted sheet is loaded again, so anything cached from a
+# sheet also records the generation of the TradeSheet it came from
+_generations = itertools.count(1)
+
+
+# A trade spreadsheet and everything the commands use on it; its local snapshot is saved
+# under its ID, so spreadsheets that share a name never share a snapshot
+class TradeSheet:
+    def __init__(self, sheet_id, open_worksheet, drive_service, db):
+        self.sheet_id = sheet_id
+        self.generation = next(_generations)
+        self.store = TradeStore(open_worksheet, drive_service, refresh_interval=60)
+        self.index = TradeIndex(self.store, completion_columns=(FIELDS["buyer"], FIELDS["category"], FIELDS["item"]),
+                                stats_columns=(FIELDS["buyer"], FIELDS["user_id"], FIELDS["category"], FIELDS["item"]),
+                                exact_columns=(FIELDS["user_id"], FIELDS["message_id"]))
+        self.writer = TradeWriter(self.store)
+        # Runs the queries, sending the broad ones to the worker processes
+        self.queries = QueryPool(self.index)
+        db.attach_trade_store(self.store, f"trades:{sheet_id}")
+        self._row_bytes = None
+
+    # Estimated from a sample of the rows, taken once the sheet has some
+    def memory_size(self):
+        snapshot = self.store.peek()
+        if snapshot is None or not len(snapshot):
+            return self.queries.shared_bytes()
+        if self._row_bytes is None:
+            self._row_bytes = row_bytes(snapshot)
+        return int(len(snapshot) * self._row_bytes * INDEXED_ROW_FACTOR) + self.queries.shared_bytes()
+
+    def close(self):
+        self.queries.close()
+
+
+# Average bytes of a row of a (non-empty) snapshot, estimated from a sample of its rows
+def row_bytes(snapshot):
+    step = max(1, len(snapshot) // ROW_SAMPLE)
+    sample = [snapshot.rows[index] for index in range(0, len(snapshot), step)][:ROW_SAMPLE]
+    return sum(sys.getsizeof(row) + sum(sys.getsizeof(cell) for cell in row) for row in sample) / len(sample)
+
+
+class SheetEntry:
+    __slots__ = ("sheet", "used_at", "lock")
+
+    def __init__(self):
+        self.sheet = None
+        self.used_at = 0.0
+        self.lock = threading.Lock()
+
+
+# Loading a sheet blocks, so trade() and pool() are called off the event loop unless
+# load=False, which only returns sheets that are already loaded
+class SheetRegistry:
+    def __init__(self, db, open_worksheet, drive_service, creds, default, allowlist, max_bytes=SHEET_MEMORY_BYTES):
+        self.db = db
+        self.open_worksheet = open_worksheet  # open_worksheet(spreadsheet id) -> its first worksheet
+        self.drive_service = drive_service
+        self.creds = creds
+        self.default = default
+        self.allowlist = allowlist
+        self.max_bytes = max_bytes
+        self.guilds = {guild_id: GuildSheets(*sheets) for guild_id, sheets in db.load_guild_sheets().items()}
+        self._entries = OrderedDict()  # key -> SheetEntry, least recently used first
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._change_listeners = []
+
+    def add_listener(self, callback):
+        # callback(sheet) runs after a TradeSheet or PoolCache was evicted
+        self._listeners.append(callback)
+
+    def add_change_listener(self, callback):
+        # callback(sheet, snapshot, start) runs after the rows of a loaded TradeSheet changed,
+        # with `start` as for a store listener (0 after a full reload)
+        self._change_listeners.append(callback)
+
+    # Every guild may use the default sheets, and the ones the allowlist gives it
+    def allowed(self, guild_id, sheet_id):
+        return sheet_id in (self.default.trade_sheet_id, self.default.pool_sheet_id) or sheet_id in self.allowlist.get(guild_id, ())
+
+    # Sheets a guild uses; one taken off the allowlist is replaced by the default straight away
+    def settings(self, guild_id):
+        settings = self.guilds.get(guild_id)
+        if settings is None:
+            return self.default
+        trade_sheet_id = settings.trade_sheet_id
+        if trade_sheet_id is None or not self.allowed(guild_id, trade_sheet_id):
+            trade_sheet_id = self.default.trade_sheet_id
+        if settings.pool_sheet_id is not None and not self.allowed(guild_id, settings.pool_sheet_id):
+            return GuildSheets(trade_sheet_id, self.default.pool_sheet_id, self.default.pool_sheet_name)
+        return GuildSheets(trade_sheet_id, settings.pool_sheet_id or self.default.pool_sheet_id,
+                           settings.pool_sheet_name or self.default.pool_sheet_name)
+
+    # Change the sheets of a guild and save them; returns the settings now in use. Raises
+    # PermissionError for a spreadsheet the allowlist does not give the guild.
+    def configure(self, guild_id, trade_sheet_id=None, pool_sheet_id=None, pool_sheet_name=None):
+        requested = GuildSheets(None, None, None).replace(trade_sheet_id, pool_sheet_id)
+        for sheet_id in (requested.trade_sheet_id, requested.pool_sheet_id):
+            if sheet_id is not None and not self.allowed(guild_id, sheet_id):
+                raise PermissionError(f"Spreadsheet {sheet_id} is not allowed for this server; ask the bot operator to allow it first.")
+        settings = self.guilds.get(guild_id, GuildSheets(None, None, None)).replace(trade_sheet_id, pool_sheet_id, pool_sheet_name)
+        self.db.save_guild_sheets(guild_id, settings.trade_sheet_id, settings.pool_sheet_id, settings.pool_sheet_name)
+        self.guilds[guild_id] = settings
+        return self.settings(guild_id)
+
+    def trade(self, sheet_id, load=True):
+        def build():
+            sheet = TradeSheet(sheet_id, lambda: self.open_worksheet(sheet_id), self.drive_service, self.db)
+            sheet.store.add_listener(lambda snapshot, start: self._changed(sheet, snapshot, start), replay=False)
+            return sheet
+        return self._get(("trade", sheet_id), build, load)
+
+    def _changed(self, sheet, snapshot, start):
+        for callback in self._change_listeners:
+            try:
+                callback(sheet, snapshot, start)
+            except Exception:
+                log.exception("A trade sheet change listener failed")
+
+    def pool(self, sheet_id, sheet_name=POOL_SHEET_NAME, load=True):
+        def build():
+            cache = get_pool_cache(sheet_id, self.creds, sheet_name)
+            self.db.attach_pool_cache(cache)
+            return cache
+        return self._get(("pool", sheet_id, sheet_name), build, load)
+
+    def loaded(self):
+        with self._lock:
+            return [entry.sheet for entry in self._entries.values() if entry.sheet is not None]
+
+    def memory_size(self):
+        return sum(sheet.memory_size() for sheet in self.loaded())
+
+    def _get(self, key, build, load):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if not load:
+                    return None
+                entry = self._entries[key] = SheetEntry()
+            self._entries.move_to_end(key)
+            entry.used_at = time.monotonic()
+            sheet = entry.sheet
+        if sheet is None and load:
+            with entry.lock:
+                if entry.sheet is None:
+                    started = time.perf_counter()
+                    try:
+                        entry.sheet = build()
+                    except Exception:
+                        with self._lock:
+                            if self._entries.get(key) is entry:
+                                del self._entries[key]
+                        raise
+                    telemetry.inc("sheet_loads_total", kind=key[0])
+                    telemetry.observe("sheet_load_seconds", time.perf_counter() - started, kind=key[0])
+                sheet = entry.sheet
+            self.enforce()
+        return sheet
+
+    # Evict the least recently used sheets until the loaded ones fit in the budget again;
+    # sheets used in the last MIN_IDLE seconds are kept even if that leaves it exceeded
+    def enforce(self):
+        with self._lock:
+            entries = [(key, entry) for key, entry in self._entries.items() if entry.sheet is not None]
+        sizes = [entry.sheet.memory_size() for _, entry in entries]
+        total = sum(sizes)
+        now = time.monotonic()
+        evicted = []
+        for (key, entry), size in zip(entries, sizes):
+            if total <= self.max_bytes or now - entry.used_at < MIN_IDLE:
+                break
+            with self._lock:
+                if self._entries.get(key) is not entry:
+                    continue
+                del self._entries[key]
+            total -= size
+            evicted.append((key, entry.sheet))
+        for key, sheet in evicted:
+            sheet.close()
+            telemetry.inc("sheet_evictions_total", kind=key[0])
+            log.info(f"Evicted {key[0]} sheet {key[1:]} to stay within the memory budget")
+            for callback in self._listeners:
+                callback(sheet)
+        return total
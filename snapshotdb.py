@@ -0,0 +1,119 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Cells of a row are stored joined by the ASCII unit separator, which is far cheaper to
+# split on load than JSON and never appears in sheet text
+SEPARATOR = "\x1f"
+
+
+# Local SQLite copy of the trade and pool sheets, saved with the revision they were read
+# at, so a restarted bot can serve commands straight away and reconcile with Google in
+# the background. Trade appends are written as they happen; full reloads replace the copy.
+class SnapshotDB:
+    def __init__(self, path="snapshot.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY, header TEXT, revision TEXT, saved_at REAL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS rows (name TEXT, position INTEGER, cells TEXT, PRIMARY KEY (name, position)) WITHOUT ROWID")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS views (key TEXT PRIMARY KEY, spec TEXT, used_at REAL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS guild_sheets (guild_id INTEGER PRIMARY KEY, trade_sheet_id TEXT, pool_sheet_id TEXT, pool_sheet_name TEXT)")
+
+    # (header, rows, revision) saved under `name`, or None if there is no copy yet
+    def load(self, name):
+        with self._lock:
+            source = self._conn.execute("SELECT header, revision FROM sources WHERE name = ?", (name,)).fetchone()
+            if source is None:
+                return None
+            cursor = self._conn.execute("SELECT cells FROM rows WHERE name = ? ORDER BY position", (name,))
+            rows = [cells.split(SEPARATOR) for cells, in cursor]
+        header, revision = source
+        return header.split(SEPARATOR) if header else [], rows, revision
+
+    # Save rows from position `start` on; start == 0 replaces everything saved under `name`
+    def save(self, name, header, rows, start, revision):
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                if start == 0:
+                    self._conn.execute("DELETE FROM rows WHERE name = ?", (name,))
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO rows (name, position, cells) VALUES (?, ?, ?)",
+                    ((name, start + offset, SEPARATOR.join(str(cell) for cell in row)) for offset, row in enumerate(rows))
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO sources (name, header, revision, saved_at) VALUES (?, ?, ?, ?)",
+                    (name, SEPARATOR.join(header), None if revision is None else str(revision), time.time())
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    # What a paginator or button shows, saved under its key so the view still works after a
+    # restart; `spec` is anything JSON can store
+    def save_view(self, key, spec):
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO views (key, spec, used_at) VALUES (?, ?, ?)", (key, json.dumps(spec), time.time()))
+
+    def load_view(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT spec FROM views WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # Forget the views last saved before `saved_before` (a time.time() value); returns how many
+    def expire_views(self, saved_before):
+        with self._lock:
+            return self._conn.execute("DELETE FROM views WHERE used_at < ?", (saved_before,)).rowcount
+
+    # {guild id: (trade sheet id, pool sheet id, pool sheet name)} of every configured guild
+    def load_guild_sheets(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT guild_id, trade_sheet_id, pool_sheet_id, pool_sheet_name FROM guild_sheets").fetchall()
+        return {guild_id: tuple(sheets) for guild_id, *sheets in rows}
+
+    def save_guild_sheets(self, guild_id, trade_sheet_id, pool_sheet_id, pool_sheet_name):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO guild_sheets (guild_id, trade_sheet_id, pool_sheet_id, pool_sheet_name) VALUES (?, ?, ?, ?)",
+                (guild_id, trade_sheet_id, pool_sheet_id, pool_sheet_name)
+            )
+
+    # Restore a TradeStore from the saved copy and keep the copy up to date from then on
+    def attach_trade_store(self, store, name="Trade Records"):
+        saved = self.load(name)
+        if saved is not None:
+            header, rows, revision = saved
+            store.restore(header, rows, revision)
+
+        def save_trades(snapshot, start):
+            try:
+                self.save(name, list(snapshot.schema), snapshot.rows[start:len(snapshot)], start, store.revision)
+            except Exception as e:
+                log.warning(f"Could not save the local trade snapshot: {e}")
+
+        store.add_listener(save_trades, replay=False)
+
+    # Restore a PoolCache from the saved copy and save every index rebuild
+    def attach_pool_cache(self, cache):
+        name = f"pool:{cache.spreadsheet_id}:{cache.sheet_name}"
+        saved = self.load(name)
+        if saved is not None:
+            _, rows, revision = saved
+            # The talent name hyperlink is saved as the first cell of each row
+            cache.restore([row[1:] for row in rows], [row[0] or None for row in rows], revision)
+
+        def save_pool(rows, name_links, revision):
+            try:
+                self.save(name, [], [[link or ""] + row for row, link in zip(rows, name_links)], 0, revision)
+            except Exception as e:
+                log.warning(f"Could not save the local pool snapshot: {e}")
+
+        cache.add_listener(save_pool)
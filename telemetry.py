@@ -0,0 +1,169 @@
+import bisect
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+# In-process metrics: counters and latency histograms keyed by name and labels, cheap
+# enough to record on every command, Google call, cache lookup and render. /bot_stats
+# reads them directly and write_prometheus() exports them in the Prometheus text format.
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "total")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # The last slot is +Inf
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+
+    # Upper bound of the bucket holding the q-th quantile (0 < q <= 1)
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for position, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKETS[position] if position < len(BUCKETS) else float("inf")
+        return float("inf")
+
+
+class Telemetry:
+    def __init__(self):
+        self.started_at = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    # Record how long the block takes in the `name` histogram
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def cache(self, cache, hit):
+        self.inc("cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+    # Counter values of `name` by their labels
+    def counter_values(self, name):
+        with self._lock:
+            return {labels: value for (counter, labels), value in self.counters.items() if counter == name}
+
+    def histogram_values(self, name):
+        with self._lock:
+            return {labels: histogram for (histogram_name, labels), histogram in self.histograms.items() if histogram_name == name}
+
+    # Hit rate of each cache: {cache: (hits, misses)}
+    def cache_rates(self):
+        rates = {}
+        for labels, value in self.counter_values("cache_requests_total").items():
+            labels = dict(labels)
+            hits, misses = rates.get(labels["cache"], (0, 0))
+            rates[labels["cache"]] = (hits + value, misses) if labels["result"] == "hit" else (hits, misses + value)
+        return rates
+
+    def render_prometheus(self, prefix="tradebot_"):
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(histogram.counts), histogram.count, histogram.total)) for key, histogram in self.histograms.items())
+        lines = [f"# TYPE {prefix}uptime_seconds gauge", f"{prefix}uptime_seconds {time.time() - self.started_at:.3f}"]
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {prefix}{name} counter")
+            lines.append(f"{prefix}{name}{_labels(labels)} {value}")
+        for (name, labels), (counts, count, total) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {prefix}{name} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{prefix}{name}_bucket{_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{prefix}{name}_count{_labels(labels)} {count}")
+            lines.append(f"{prefix}{name}_sum{_labels(labels)} {total:.6f}")
+        return "\n".join(lines) + "\n"
+
+    # Write the metrics for a textfile collector; the rename keeps readers from seeing half a file
+    def write_prometheus(self, path):
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as file:
+            file.write(self.render_prometheus())
+        os.replace(temporary, path)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+# Count the bytes of every response received through a requests session (gspread's client)
+def count_session_bytes(session, api):
+    def count(response, *args, **kwargs):
+        telemetry.inc("google_bytes_fetched_total", len(response.content or b""), api=api)
+
+    session.hooks.setdefault("response", []).append(count)
+
+
+# Count the bytes of every response received through an httplib2 Http (googleapiclient)
+def count_http_bytes(http, api):
+    request = http.request
+
+    def counted_request(*args, **kwargs):
+        response, content = request(*args, **kwargs)
+        telemetry.inc("google_bytes_fetched_total", len(content or b""), api=api)
+        return response, content
+
+    http.request = counted_request
+    return http
+
+
+# Log records are put on a queue by the caller and written by a background thread, so a
+# slow terminal or disk never blocks the event loop. Returns the listener to stop on exit.
+def setup_logging(level=logging.INFO, handler=None):
+    handler = handler or logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers = [logging.handlers.QueueHandler(records)]
+    listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+# The process-wide metrics
+telemetry = Telemetry()
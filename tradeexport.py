@@ -0,0 +1,49 @@
+import csv
+import gzip
+import io
+import json
+
+# Gzip-compressed CSV/JSONL exports of trade rows, cut into parts that each fit in one
+# Discord upload. Parts are produced one at a time, so only the part being built is ever
+# held in memory, however many rows are exported.
+
+FORMATS = ("csv", "jsonl")
+BATCH_ROWS = 200
+# The gzip stream holds back up to a compression window of data until it is flushed,
+# so a part is closed once it is this close to the limit
+SIZE_MARGIN = 256 * 1024
+
+
+def encode_rows(rows, titles, export_format):
+    if export_format == "jsonl":
+        return "".join(json.dumps(dict(zip(titles, row)), ensure_ascii=False) + "\n" for row in rows)
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    return buffer.getvalue()
+
+
+# Yield (filename, gzip bytes) parts holding the rows of `snapshot` at `indices`, in order.
+# Each row starts with its sheet row number; CSV parts each repeat the header row.
+def export_parts(snapshot, indices, export_format, size_limit, basename="trades"):
+    titles = ["row"] + list(snapshot.schema)
+    header = encode_rows([titles], titles, "csv") if export_format == "csv" else ""
+    extension = f"{export_format}.gz"
+    limit = max(size_limit - SIZE_MARGIN, size_limit // 2)
+
+    part = 1
+    buffer = gzip_file = None
+    for start in range(0, len(indices), BATCH_ROWS):
+        if gzip_file is None:
+            buffer = io.BytesIO()
+            gzip_file = gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6, mtime=0)
+            gzip_file.write(header.encode())
+        rows = [[snapshot.sheet_row(index)] + list(snapshot.rows[index]) for index in indices[start:start + BATCH_ROWS]]
+        gzip_file.write(encode_rows(rows, titles, export_format).encode())
+        if buffer.tell() >= limit:
+            gzip_file.close()
+            yield f"{basename}-part{part}.{extension}", buffer.getvalue()
+            part += 1
+            buffer = gzip_file = None
+    if gzip_file is not None:
+        gzip_file.close()
+        yield (f"{basename}-part{part}.{extension}" if part > 1 else f"{basename}.{extension}"), buffer.getvalue()
@@ -0,0 +1,90 @@
+import codecs
+import csv
+from datetime import datetime
+
+# Reading trade records from an uploaded CSV/TSV file for /import_records. Rows are
+# parsed lazily from the upload and checked with the same rules /add_record applies.
+
+# Column order of a trade row as /add_record writes it
+RECORD_FIELDS = ("buyer", "user_id", "message_id", "item", "price", "category", "date")
+
+# Header spellings accepted for each field: the /add_record parameter or the sheet title
+HEADER_ALIASES = {
+    "buyer": "buyer",
+    "user_id": "user_id", "user id": "user_id",
+    "message_id": "message_id", "message id": "message_id",
+    "item": "item", "items": "item", "items(s)": "item",
+    "price": "price",
+    "category": "category",
+    "date": "date",
+}
+
+MAX_REPORTED_ERRORS = 10
+
+
+# Date cell as /add_record writes it: dd/mm/yyyy input becomes "dd mmmm yyyy", empty means today
+def format_trade_date(text):
+    if text:
+        return datetime.strptime(text.strip(), "%d/%m/%Y").strftime("%d %B %Y")
+    return datetime.now().strftime("%d %B %Y")
+
+
+# Lines of the uploaded bytes, decoded as they are read
+def iter_lines(data, encoding="utf-8-sig"):
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    start = 0
+    while start < len(data):
+        end = data.find(b"\n", start)
+        end = len(data) if end == -1 else end + 1
+        yield decoder.decode(data[start:end])
+        start = end
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def detect_delimiter(data, filename=""):
+    if filename.lower().endswith((".tsv", ".tab")):
+        return "\t"
+    first_line = data[:data.find(b"\n")] if b"\n" in data else data
+    return "\t" if first_line.count(b"\t") > first_line.count(b",") else ","
+
+
+# Parse and validate an uploaded file into trade rows. A header row naming the columns is
+# optional; without one the columns are taken in /add_record order. Returns the rows and
+# a list of (line number, message) for the rows that were rejected.
+def read_trade_rows(data, filename=""):
+    reader = csv.reader(iter_lines(data), delimiter=detect_delimiter(data, filename))
+    positions = None
+    rows = []
+    errors = []
+    for record in reader:
+        if not any(cell.strip() for cell in record):
+            continue
+        if positions is None:
+            positions = header_positions(record)
+            if positions is not None:
+                continue
+            positions = {field: position for position, field in enumerate(RECORD_FIELDS)}
+        line = reader.line_num
+        width = max(positions.values()) + 1
+        if any(cell.strip() for cell in record[width:]):
+            errors.append((line, f"expected at most {width} columns, got {len(record)}"))
+            continue
+        values = {field: record[position].strip() if position < len(record) else "" for field, position in positions.items()}
+        try:
+            values["date"] = format_trade_date(values.get("date"))
+        except ValueError:
+            errors.append((line, f"invalid date {values['date']!r}, use dd/mm/yyyy"))
+            continue
+        rows.append([values.get(field, "") for field in RECORD_FIELDS])
+    return rows, errors
+
+
+# Field positions named by a header row, or None if the row is data
+def header_positions(record):
+    names = [cell.strip().lower() for cell in record]
+    known = [name for name in names if name]
+    if len(set(known)) < 2 or not all(name in HEADER_ALIASES for name in known):
+        return None
+    return {HEADER_ALIASES[name]: position for position, name in enumerate(names) if name}
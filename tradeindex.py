@@ -0,0 +1,589 @@
+import bisect
+import calendar
+import heapq
+import logging
+import math
+import re
+import statistics
+import threading
+import time
+from array import array
+from datetime import date, datetime
+from itertools import chain
+from prefixindex import PrefixIndex
+from telemetry import telemetry
+
+try:
+    import numpy as np
+except ImportError:  # Price filters and aggregates fall back to pure Python
+    np = None
+
+log = logging.getLogger(__name__)
+
+# Inverted indexes over the trade snapshot so the fetch_trade_by_* filters do not
+# have to scan every row. Cells are keyed by cell_key(), which the filters use as well.
+
+# Formats found in the date column: add_record writes "dd mmmm yyyy", people type the others
+DATE_FORMATS = ("%d %B %Y", "%d %b %Y", "%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y")
+GRANULARITIES = ("day", "month", "year")
+PERCENTILES = (25, 50, 75, 90)
+LATE_DATES = 1024  # Smallest tail of out-of-order dates the DateIndex folds back in
+
+
+# How a cell is compared: stripped and lowercased, in the indexes and in the row checks alike
+def cell_key(cell):
+    return str(cell).strip().lower()
+
+
+def trigrams(value):
+    return {value[i:i + 3] for i in range(len(value) - 2)}
+
+
+# Index for one column: a hash index from each distinct cell value to the rows holding
+# it, plus a trigram index from each trigram to the distinct values containing it.
+# Substring queries intersect the trigram sets of the term and then verify the few
+# candidate values, so their cost depends on the number of matches, not on the rows.
+# Columns of IDs, unique per row and looked up whole, skip the trigram index (it would
+# hold a dozen entries per row); substring queries on them check the distinct values.
+class ColumnIndex:
+    def __init__(self, substrings=True):
+        self.postings = {}
+        self.grams = {} if substrings else None
+        self.labels = {}
+        self.completions = None
+
+    def add(self, row_index, cell):
+        value = cell_key(cell)
+        rows = self.postings.get(value)
+        if rows is None:
+            rows = self.postings[value] = []
+            label = self.labels[value] = str(cell).strip()  # First spelling seen, for display
+            if self.grams is not None:
+                for gram in trigrams(value):
+                    self.grams.setdefault(gram, set()).add(value)
+            if self.completions is not None:
+                self.completions.add(label)
+        rows.append(row_index)
+
+    # Keep an autocomplete index over the distinct values from now on
+    def enable_completions(self):
+        self.completions = PrefixIndex(list(self.labels.values()))
+
+    # Distinct values containing `term`
+    def values_containing(self, term):
+        if len(term) < 3 or self.grams is None:
+            # Too short for a trigram, or no trigram index; the distinct values are no more
+            # than the rows
+            return [value for value in list(self.postings) if term in value]
+        candidates = None
+        for gram in sorted(trigrams(term), key=lambda gram: len(self.grams.get(gram, ()))):
+            values = self.grams.get(gram)
+            if not values:
+                return []
+            candidates = set(values) if candidates is None else candidates & values
+            if not candidates:
+                return []
+        return [value for value in candidates if term in value]
+
+    def exact(self, value):
+        return self.postings.get(cell_key(value), [])
+
+
+_parsed_dates = {}
+
+# Day ordinal of a date cell, or None if it is not a date; distinct strings are parsed once
+def parse_date(text):
+    text = str(text).strip()
+    if text not in _parsed_dates:
+        ordinal = None
+        for date_format in DATE_FORMATS:
+            try:
+                ordinal = datetime.strptime(text, date_format).date().toordinal()
+                break
+            except ValueError:
+                pass
+        _parsed_dates[text] = ordinal
+    return _parsed_dates[text]
+
+
+# First and last day ordinal of a period: YYYY-MM-DD for days, YYYY-MM for months, YYYY for years
+def parse_period(text, granularity="day"):
+    text = text.strip()
+    if granularity == "year":
+        year = datetime.strptime(text, "%Y").year
+        return date(year, 1, 1).toordinal(), date(year, 12, 31).toordinal()
+    if granularity == "month":
+        month = datetime.strptime(text, "%Y-%m")
+        last_day = calendar.monthrange(month.year, month.month)[1]
+        return date(month.year, month.month, 1).toordinal(), date(month.year, month.month, last_day).toordinal()
+    ordinal = parse_date(text)
+    if ordinal is None:
+        raise ValueError(f"{text!r} is not a date (YYYY-MM-DD)")
+    return ordinal, ordinal
+
+
+# Label of the period a day ordinal falls in
+def period_label(ordinal, granularity):
+    day = date.fromordinal(ordinal)
+    if granularity == "year":
+        return f"{day.year}"
+    if granularity == "month":
+        return f"{day.year}-{day.month:02d}"
+    return day.isoformat()
+
+
+# The date column parsed into day ordinals and kept sorted, with the row index of each
+# entry alongside, so a date range is two bisects plus the matching rows: O(log n + k).
+# Rows added by a change are collected and merged in by commit(): a full rebuild sorts
+# once and in-order appends extend the lists. Out-of-order ones (imported history) go to
+# a small sorted tail that readers merge on the fly; once it outgrows about the square
+# root of the index it is folded into the main lists, so a backdated row costs O(sqrt n)
+# amortized. `entries` is replaced as one (ordinals, rows, late ordinals, late rows)
+# tuple, so readers never see the lists out of step.
+class DateIndex:
+    def __init__(self):
+        self.entries = ([], [], [], [])
+        self._batch = []
+
+    def add(self, row_index, cell):
+        ordinal = parse_date(cell)
+        if ordinal is not None:
+            self._batch.append((ordinal, row_index))
+
+    def commit(self):
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        ordinals, rows, late_ordinals, late_rows = self.entries
+        in_order = (not ordinals or batch[0][0] >= ordinals[-1]) and all(previous[0] <= entry[0] for previous, entry in zip(batch, batch[1:]))
+        if in_order:
+            # Rows first: an ordinal a reader can see always has its row
+            rows.extend(row_index for _, row_index in batch)
+            ordinals.extend(ordinal for ordinal, _ in batch)
+            return
+        batch.sort()
+        if not ordinals:
+            self.entries = ([ordinal for ordinal, _ in batch], [row_index for _, row_index in batch], [], [])
+            return
+        late_ordinals, late_rows = late_ordinals[:], late_rows[:]
+        for ordinal, row_index in batch:
+            position = bisect.bisect_right(late_ordinals, ordinal)
+            late_ordinals.insert(position, ordinal)
+            late_rows.insert(position, row_index)
+        if len(late_ordinals) <= max(LATE_DATES, math.isqrt(len(ordinals))):
+            self.entries = (ordinals, rows, late_ordinals, late_rows)
+            return
+        merged = list(heapq.merge(zip(ordinals, rows), zip(late_ordinals, late_rows)))
+        self.entries = ([ordinal for ordinal, _ in merged], [row_index for _, row_index in merged], [], [])
+
+    def _bounds(self, ordinals, first, last):
+        return bisect.bisect_left(ordinals, first), bisect.bisect_right(ordinals, last)
+
+    # (ordinal, row index) pairs dated between the two ordinals (inclusive), in date order
+    def _pairs(self, first, last):
+        ordinals, rows, late_ordinals, late_rows = self.entries
+        start, end = self._bounds(ordinals, first, last)
+        pairs = zip(ordinals[start:end], rows[start:end])
+        late_start, late_end = self._bounds(late_ordinals, first, last)
+        if late_start == late_end:
+            return pairs
+        return heapq.merge(pairs, zip(late_ordinals[late_start:late_end], late_rows[late_start:late_end]))
+
+    # Row indices dated between the two ordinals (inclusive), in date order
+    def between(self, first, last, snapshot):
+        ordinals, rows, late_ordinals, _ = self.entries
+        if late_ordinals:
+            return [index for _, index in self._pairs(first, last) if index < len(snapshot)]
+        start, end = self._bounds(ordinals, first, last)
+        return [index for index in rows[start:end] if index < len(snapshot)]
+
+    def count(self, first, last):
+        ordinals, _, late_ordinals, _ = self.entries
+        start, end = self._bounds(ordinals, first, last)
+        late_start, late_end = self._bounds(late_ordinals, first, last)
+        return end - start + late_end - late_start
+
+    # Every entry as (ordinals, rows) lists, the late ones last
+    def all_entries(self):
+        ordinals, rows, late_ordinals, late_rows = self.entries
+        length = len(ordinals)  # Rows are extended first, so there are at least as many
+        return ordinals[:length] + late_ordinals, rows[:length] + late_rows
+
+    # Number of rows per month or year (or day) between the two ordinals, oldest first
+    def rollup(self, granularity, first=None, last=None, snapshot=None):
+        counts = {}
+        previous_ordinal, label = None, None
+        for ordinal, index in self._pairs(first if first is not None else 0, last if last is not None else date.max.toordinal()):
+            if snapshot is not None and index >= len(snapshot):
+                continue
+            if ordinal != previous_ordinal:
+                previous_ordinal, label = ordinal, period_label(ordinal, granularity)
+            counts[label] = counts.get(label, 0) + 1
+        return counts
+
+
+# Numeric value of a price cell ("1,200", "$15", " 7.5 "), or NaN if it is not a number
+def parse_price(text):
+    try:
+        return float(re.sub(r"[\s,$€£]", "", str(text)))
+    except ValueError:
+        return math.nan
+
+
+# The price column as a compact float64 array aligned with the row indices (NaN where the
+# cell is not a number). With NumPy the array grows by doubling and range filters and
+# aggregates are vectorized; without it an array('d') and plain Python loops are used.
+class PriceColumn:
+    def __init__(self):
+        self.length = 0
+        self._values = np.empty(1024) if np is not None else array('d')
+
+    def add(self, row_index, cell):
+        while self.length <= row_index:
+            self._append(parse_price(cell) if self.length == row_index else math.nan)
+
+    def _append(self, price):
+        if np is None:
+            self._values.append(price)
+        else:
+            if self.length == len(self._values):
+                grown = np.empty(len(self._values) * 2)
+                grown[:self.length] = self._values[:self.length]
+                self._values = grown
+            self._values[self.length] = price
+        self.length += 1
+
+    def value(self, row_index):
+        return self._values[row_index] if row_index < self.length else math.nan
+
+    # Prices of the first `length` rows
+    def values(self, length):
+        return self._values[:min(length, self.length)]
+
+    # Row indices in `snapshot` priced between low and high (inclusive; None leaves a side open)
+    def between(self, low, high, snapshot):
+        values = self.values(len(snapshot))
+        low = -math.inf if low is None else low
+        high = math.inf if high is None else high
+        if np is not None:
+            return np.flatnonzero((values >= low) & (values <= high)).tolist()
+        return [index for index, price in enumerate(values) if low <= price <= high]
+
+    # Count, total, mean and percentiles of the prices of `rows` (all rows if None), ignoring NaN
+    def summary(self, length, rows=None):
+        values = self.values(length)
+        if np is not None:
+            if rows is not None:
+                values = values[np.asarray(rows, dtype=np.intp)]
+            values = values[~np.isnan(values)]
+            if not len(values):
+                return None
+            percentiles = np.percentile(values, PERCENTILES)
+            return {
+                "count": int(len(values)),
+                "total": float(values.sum()),
+                "mean": float(values.mean()),
+                **{f"p{p}": float(value) for p, value in zip(PERCENTILES, percentiles)},
+            }
+        if rows is not None:
+            values = [values[index] for index in rows]
+        values = sorted(price for price in values if not math.isnan(price))
+        if not values:
+            return None
+        quantiles = statistics.quantiles(values, n=100, method='inclusive') if len(values) > 1 else [values[0]] * 99
+        return {
+            "count": len(values),
+            "total": math.fsum(values),
+            "mean": statistics.fmean(values),
+            **{f"p{p}": quantiles[p - 1] for p in PERCENTILES},
+        }
+
+
+# Running row count, priced row count and price total per group (buyer, month...), updated
+# as rows are added so trade statistics are read off these totals instead of the rows.
+# Groups are numbered in order of appearance and their totals kept in parallel lists;
+# the ranking of a query is cached until the next row comes in.
+class GroupTotals:
+    def __init__(self):
+        self.ids = {}
+        self.labels = []
+        self.counts = []
+        self.priced = []
+        self.totals = []
+        self.overall = [0, 0, 0.0]
+        self.changes = 0
+        self._rankings = {}
+
+    def __len__(self):
+        return len(self.labels)
+
+    def add(self, key, label, price):
+        group = self.ids.get(key)
+        if group is None:
+            group = self.ids[key] = len(self.labels)
+            self.counts.append(0)
+            self.priced.append(0)
+            self.totals.append(0.0)
+            self.labels.append(label)  # First spelling seen, for display
+        self.counts[group] += 1
+        self.overall[0] += 1
+        if not math.isnan(price):
+            self.priced[group] += 1
+            self.totals[group] += price
+            self.overall[1] += 1
+            self.overall[2] += price
+        self.changes += 1
+
+    # (label, trades, priced trades, total, mean) of the first `limit` groups, largest
+    # `order` first ("trades", "total" or "mean"), or by label for "group"
+    def stats(self, order="total", limit=25):
+        cached = self._rankings.get(order)
+        if cached is not None and cached[0] == self.changes and cached[1] >= limit:
+            ranking = cached[2]
+        else:
+            changes = self.changes
+            ranking = self._rank(order, limit)
+            self._rankings[order] = (changes, limit, ranking)
+        return [(self.labels[group], self.counts[group], self.priced[group], self.totals[group],
+                 self.totals[group] / self.priced[group] if self.priced[group] else math.nan)
+                for group in ranking[:limit]]
+
+    def _rank(self, order, limit):
+        length = len(self.labels)
+        if order == "group":
+            return heapq.nsmallest(limit, range(length), key=self.labels.__getitem__)
+        if order == "trades":
+            keys = self.counts[:length]
+        elif order == "total":
+            keys = self.totals[:length]
+        else:
+            keys = [total / priced if priced else -math.inf for total, priced in zip(self.totals[:length], self.priced[:length])]
+        if np is None or length <= limit:
+            return heapq.nlargest(limit, range(length), key=keys.__getitem__)
+        keys = np.asarray(keys, dtype=float)
+        top = np.argpartition(-keys, limit - 1)[:limit]
+        return top[np.argsort(-keys[top], kind="stable")].tolist()
+
+
+# Per-column indexes for a TradeStore, kept in step with it through a store listener:
+# appended rows are added in place, a full reload rebuilds the indexes on a background
+# thread and swaps them in. Until then covers() is false for the new snapshot and the
+# queries check its rows one by one, so a (re)load never waits for the indexes.
+# The `completion_columns` also get an autocomplete index over their distinct values, and
+# the `stats_columns` (plus the month of the date column) keep running GroupTotals. The
+# `exact_columns` get no trigram index.
+class TradeIndex:
+    def __init__(self, store, completion_columns=(), stats_columns=(), exact_columns=()):
+        self.store = store
+        self.completion_columns = {title.strip().lower() for title in completion_columns}
+        self.exact_columns = {title.strip().lower() for title in exact_columns}
+        self.stats_columns = [title.strip().lower() for title in stats_columns]
+        self.columns = {}
+        self.dates = DateIndex()
+        self.prices = PriceColumn()
+        self.totals = {}
+        self.version = None
+        self.snapshot = None  # The latest snapshot the indexes hold every row of
+        self._building = None  # The snapshot being indexed in the background
+        self._idle = threading.Event()
+        self._idle.set()
+        self._lock = threading.Lock()
+        self._listeners = []
+        store.add_listener(self._on_change)
+
+    # Register a callback(snapshot, start) run once the indexes caught up with a change of
+    # the store; `start` means the same as for a store listener
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def covers(self, snapshot):
+        indexed = self.snapshot
+        return indexed is not None and indexed.rows is snapshot.rows and len(snapshot) <= len(indexed)
+
+    # Block until no rebuild is running; returns the latest snapshot the indexes cover
+    def wait(self):
+        self._idle.wait()
+        if self.snapshot is None:
+            raise RuntimeError("The trade indexes could not be built")
+        return self.snapshot
+
+    def _on_change(self, snapshot, start):
+        with self._lock:
+            if start == 0:
+                self._building = snapshot
+                self._idle.clear()
+                threading.Thread(target=self._build, args=(snapshot,), name="trade-index", daemon=True).start()
+                return
+            if self._building is not None or self.snapshot is None or self.snapshot.rows is not snapshot.rows:
+                return  # The rebuild in progress catches up with these rows
+            start = len(self.snapshot)
+            if len(snapshot) <= start:
+                return
+            self._add_rows(self.columns, self.dates, self.prices, self.totals, snapshot, start)
+            self.snapshot, self.version = snapshot, snapshot.version
+            self._notify(snapshot, start)
+
+    def _build(self, snapshot):
+        started = time.perf_counter()
+        try:
+            columns = {title.strip().lower(): ColumnIndex(title.strip().lower() not in self.exact_columns) for title in snapshot.schema}
+            dates = DateIndex()
+            prices = PriceColumn()
+            totals = {title: GroupTotals() for title in self.stats_columns + ["month"]}
+            self._add_rows(columns, dates, prices, totals, snapshot, 0)
+            for title in self.completion_columns & columns.keys():
+                columns[title].enable_completions()
+        except Exception:
+            log.exception("Could not build the trade indexes")
+            with self._lock:
+                if self._building is snapshot:
+                    self._building = None
+                    self._idle.set()
+            return
+        with self._lock:
+            if self._building is not snapshot:
+                return  # A newer reload is being indexed instead
+            # Rows appended while the indexes were being built
+            latest = self.store.peek()
+            if latest is not None and latest.rows is snapshot.rows and len(latest) > len(snapshot):
+                self._add_rows(columns, dates, prices, totals, latest, len(snapshot))
+                snapshot = latest
+            self.columns, self.dates, self.prices, self.totals = columns, dates, prices, totals
+            self.snapshot, self.version = snapshot, snapshot.version
+            self._building = None
+            self._idle.set()
+            telemetry.observe("trade_index_build_seconds", time.perf_counter() - started)
+            self._notify(snapshot, 0)
+
+    def _notify(self, snapshot, start):
+        for callback in self._listeners:
+            try:
+                callback(snapshot, start)
+            except Exception:
+                log.exception("A trade index listener failed")
+
+    def _add_rows(self, columns, dates, prices, totals, snapshot, start):
+        indexes = [(position, columns[title.strip().lower()]) for position, title in enumerate(snapshot.schema)]
+        typed = []
+        for title, typed_index in (("date", dates), ("price", prices)):
+            try:
+                typed.append((snapshot.schema.index(title), typed_index))
+            except ValueError:
+                pass
+        grouped = [(snapshot.schema.index(title), totals[title]) for title in self.stats_columns if title in columns]
+        month_totals = totals["month"]
+        try:
+            date_position = snapshot.schema.index("date")
+        except ValueError:
+            date_position = None
+        months = {}
+        rows = snapshot.rows
+        for row_index in range(start, len(snapshot)):
+            row = rows[row_index]
+            for position, column in indexes:
+                column.add(row_index, row[position] if position < len(row) else "")
+            for position, typed_index in typed:
+                typed_index.add(row_index, row[position])
+            price = float(prices.value(row_index))
+            for position, group_totals in grouped:
+                cell = str(row[position]) if position < len(row) else ""
+                group_totals.add(cell_key(cell), cell.strip(), price)
+            ordinal = parse_date(row[date_position]) if date_position is not None and date_position < len(row) else None
+            month = months.get(ordinal)
+            if month is None:
+                month = months[ordinal] = period_label(ordinal, "month") if ordinal is not None else ""
+            month_totals.add(month, month, price)
+        dates.commit()
+
+    def column(self, title):
+        try:
+            return self.columns[title.strip().lower()]
+        except KeyError:
+            raise ValueError(f"{title!r} is not a column of the trade sheet") from None
+
+    # Up to `limit` distinct values of a column starting with `prefix`, for autocomplete
+    def complete(self, title, prefix, limit=25):
+        column = self.columns.get(title.strip().lower())
+        if column is None or column.completions is None:
+            return []
+        return column.completions.complete(prefix, limit)
+
+    # Sorted indices of the rows in `snapshot` whose `title` cell contains any of `terms`
+    def search(self, title, terms, snapshot):
+        column = self.column(title)
+        matches = set()
+        for term in terms:
+            for value in column.values_containing(term):
+                matches.update(column.exact(value))
+        return sorted(index for index in matches if index < len(snapshot))
+
+    # Sorted indices of the rows in `snapshot` whose `title` cell equals any of `values`
+    def lookup(self, title, values, snapshot):
+        column = self.column(title)
+        matches = set()
+        for value in values:
+            matches.update(column.exact(value))
+        return sorted(index for index in matches if index < len(snapshot))
+
+    # Running totals per value of a stats column, or per month for "month"
+    def group_totals(self, group):
+        totals = self.totals.get(cell_key(group))
+        if totals is None:
+            raise ValueError(f"{group!r} is not a column the trade statistics are kept for")
+        return totals
+
+    # Price summary per distinct value of a column (buyer, category, item...), largest total first
+    # Price summaries of the `limit` groups with the largest totals, and the number of
+    # groups with a price. With NumPy the rows are sorted once by group and price, and the
+    # totals and percentiles of every group come from that one sorted array.
+    def price_stats(self, title, snapshot, limit=None):
+        column = self.column(title)
+        length = len(snapshot)
+        values = list(column.postings)
+        postings = [column.postings[value] for value in values]
+        if np is None:
+            groups = []
+            for value, rows in zip(values, postings):
+                rows = [index for index in rows if index < length] if rows and rows[-1] >= length else rows
+                summary = self.prices.summary(length, rows) if rows else None
+                if summary is not None:
+                    groups.append((column.labels.get(value, value), summary))
+            groups.sort(key=lambda group: group[1]["total"], reverse=True)
+            return groups[:limit], len(groups)
+
+        sizes = np.fromiter((len(rows) for rows in postings), dtype=np.intp, count=len(postings))
+        rows = np.fromiter(chain.from_iterable(postings), dtype=np.intp, count=int(sizes.sum()))
+        codes = np.repeat(np.arange(len(postings)), sizes)
+        keep = rows < length
+        prices = np.full(len(rows), np.nan)
+        prices[keep] = self.prices.values(length)[rows[keep]]
+        keep = ~np.isnan(prices)
+        codes, prices = codes[keep], prices[keep]
+        if not len(prices):
+            return [], 0
+        order = np.lexsort((prices, codes))
+        codes, prices = codes[order], prices[order]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        counts = np.diff(np.r_[starts, len(prices)])
+        totals = np.add.reduceat(prices, starts)
+        group_count = len(starts)
+        top = np.argsort(-totals, kind="stable")[:limit]
+        starts, counts, totals = starts[top], counts[top], totals[top]
+        quantiles = {}
+        for p in PERCENTILES:
+            # Linear interpolation between the closest ranks, like np.percentile
+            position = (counts - 1) * (p / 100)
+            lower = np.floor(position).astype(np.intp)
+            upper = np.minimum(lower + 1, counts - 1)
+            low, high = prices[starts + lower], prices[starts + upper]
+            quantiles[p] = low + (high - low) * (position - lower)
+        groups = []
+        for rank, code in enumerate(codes[starts].tolist()):
+            value = values[code]
+            groups.append((column.labels.get(value, value), {
+                "count": int(counts[rank]),
+                "total": float(totals[rank]),
+                "mean": float(totals[rank] / counts[rank]),
+                **{f"p{p}": float(quantiles[p][rank]) for p in PERCENTILES},
+            }))
+        return groups, group_count
@@ -0,0 +1,270 @@
+import asyncio
+import atexit
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+
+from telemetry import telemetry
+
+try:
+    import numpy as np
+except ImportError:  # Without NumPy every query runs inline
+    np = None
+
+log = logging.getLogger(__name__)
+
+# Offloads broad trade queries to a pool of worker processes. The trade snapshot is
+# published once into a shared memory segment, column by column (lowercased cells as
+# UTF-8 text, prices as float64, dates as day ordinals), and each job only names the
+# segment, the query and the chunk of rows to scan, so nothing large is pickled per
+# job. Rows appended after the last publication are checked inline, and the segment is
+# republished after a full reload or once enough rows have been appended. One set of
+# worker processes serves the QueryPool of every trade sheet.
+
+# Queries whose index plan is estimated to touch fewer rows than this run inline
+OFFLOAD_MIN_ROWS = 50_000
+CHUNK_ROWS = 100_000
+REPUBLISH_ROWS = 20_000
+
+
+# Main-process handle of one published snapshot. `layout` tells the workers where each
+# column of each chunk is in the segment; it is small and sent along with every job.
+class SharedTable:
+    def __init__(self, snapshot, index, generation):
+        length = len(snapshot)
+        rows = snapshot.rows
+        chunks = range(0, length, CHUNK_ROWS)
+        parts = []
+        size = 0
+
+        def place(data):
+            nonlocal size
+            offset = size
+            parts.append((offset, data))
+            size += (len(data) + 7) // 8 * 8  # Keep the numeric arrays aligned
+            return offset, len(data)
+
+        columns = {}
+        for position, title in enumerate(snapshot.schema):
+            blocks = []
+            for start in chunks:
+                cells = (str(row[position]).lower().replace("\n", " ") if position < len(row) else "" for row in rows[start:min(start + CHUNK_ROWS, length)])
+                blocks.append(place(("\n".join(cells) + "\n").encode()))
+            columns[title.strip().lower()] = blocks
+        prices = np.full(length, np.nan)
+        prices[:min(length, index.prices.length)] = index.prices.values(length)
+        dates = np.zeros(length, dtype=np.int32)
+        date_ordinals, date_rows = index.dates.all_entries()
+        date_rows = np.asarray(date_rows, dtype=np.intp)
+        in_range = date_rows < length
+        dates[date_rows[in_range]] = np.asarray(date_ordinals, dtype=np.int32)[in_range]
+
+        self.layout = {
+            "length": length,
+            "columns": columns,
+            "prices": place(prices.tobytes()),
+            "dates": place(dates.tobytes()),
+        }
+        self.memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for offset, data in parts:
+            self.memory.buf[offset:offset + len(data)] = data
+        self.name = self.memory.name
+        _live.add(self.name)
+        self.length = length
+        self.generation = generation
+        self.users = 0
+        self.retired = False
+
+    def release(self):
+        _live.discard(self.name)
+        self.memory.close()
+        self.memory.unlink()
+
+
+# One chunk of a published table, as seen from a worker
+class ChunkView:
+    def __init__(self, buffer, layout, chunk):
+        self.buffer = buffer
+        self.layout = layout
+        self.chunk = chunk
+        self.start = chunk * CHUNK_ROWS
+        self.length = min(layout["length"] - self.start, CHUNK_ROWS)
+
+    def text(self, title):
+        offset, length = self.layout["columns"][title.strip().lower()][self.chunk]
+        return bytes(self.buffer[offset:offset + length]).decode().split("\n")[:-1]
+
+    def _array(self, name, dtype):
+        offset, _ = self.layout[name]
+        return np.frombuffer(self.buffer, dtype=dtype, count=self.length, offset=offset + self.start * np.dtype(dtype).itemsize).copy()
+
+    def prices(self):
+        return self._array("prices", np.float64)
+
+    def dates(self):
+        return self._array("dates", np.int32)
+
+
+_attached = {}
+_executor = None
+# Names of the segments not yet released, sent with every job so the workers can let go
+# of the others
+_live = set()
+
+
+# Fork the workers now, before the process starts any thread, rather than on the first
+# query: a forked worker would inherit the locks other threads hold at that moment
+def start_workers(workers):
+    global _executor
+    if workers and np is not None and _executor is None:
+        if "fork" not in multiprocessing.get_all_start_methods():
+            # Windows: spawned workers would re-import the bot, so queries stay inline
+            log.info("Trade queries run inline: this platform cannot fork worker processes")
+            return
+        # Workers forked before the resource tracker runs would each start their own, and
+        # a worker's tracker unlinks every segment it attached to when the worker dies
+        resource_tracker.ensure_running()
+        _executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"))
+        _executor.submit(int).result()
+        atexit.register(_executor.shutdown)
+
+
+# After a worker died the pool refuses every job; forking new workers from a process that
+# now runs threads is unsafe, so every later query runs inline instead
+def stop_workers(reason):
+    global _executor
+    executor, _executor = _executor, None
+    if executor is not None:
+        log.warning(f"Running trade queries inline from now on: {reason}")
+        atexit.unregister(executor.shutdown)
+        executor.shutdown(wait=False)
+
+
+# Worker side: the row indices of one chunk matching `query`. Every live segment (one per
+# trade sheet) stays attached; the ones released since the last job are detached.
+def scan_chunk(name, layout, query, chunk, live):
+    for stale in [attached for attached in _attached if attached not in live]:
+        try:
+            _attached[stale].close()
+        except BufferError:
+            continue  # Still referenced; tried again on the next job
+        del _attached[stale]
+    memory = _attached.get(name)
+    if memory is None:
+        memory = _attached[name] = shared_memory.SharedMemory(name=name)
+    view = ChunkView(memory.buf, layout, chunk)
+    return np.flatnonzero(query.scan(view)) + view.start
+
+
+# Runs the trade queries of one sheet inline or in the worker pool, depending on their
+# estimated cost. The segment is kept in step with the store through a TradeIndex listener,
+# so it is only published from built indexes, which it reads the prices and dates from.
+class QueryPool:
+    def __init__(self, index, min_rows=OFFLOAD_MIN_ROWS):
+        self.index = index
+        self.min_rows = min_rows
+        self.table = None
+        self.generation = 0
+        self.closed = False
+        self._lock = threading.Lock()
+        if np is not None:
+            index.add_listener(self._on_change)
+            atexit.register(self.close)  # Shared memory outlives the process unless unlinked
+
+    # Bytes of shared memory the published table takes
+    def shared_bytes(self):
+        table = self.table
+        return table.memory.size if table is not None else 0
+
+    # Stop publishing; the table is released once the last job reading it is done
+    def close(self):
+        atexit.unregister(self.close)
+        with self._lock:
+            self.closed = True
+        self._publish(None)
+
+    def _on_change(self, snapshot, start):
+        if self.closed:
+            return
+        if start == 0:
+            self.generation += 1
+        table = self.table
+        stale = table is None or table.generation != self.generation or len(snapshot) - table.length >= REPUBLISH_ROWS
+        if stale and len(snapshot) >= self.min_rows:
+            started = time.perf_counter()
+            try:
+                self._publish(SharedTable(snapshot, self.index, self.generation))
+            except Exception as e:
+                # Queries keep running inline until the next publication succeeds
+                log.warning(f"Could not publish the trade snapshot to the query workers: {e}")
+                return
+            telemetry.observe("query_pool_publish_seconds", time.perf_counter() - started)
+
+    def _publish(self, table):
+        with self._lock:
+            if self.closed and table is not None:
+                previous = table  # Closed while it was being built
+            else:
+                previous, self.table = self.table, table
+            if previous is not None:
+                previous.retired = True
+                if previous.users:
+                    previous = None  # Released by the last job still reading it
+        if previous is not None:
+            previous.release()
+
+    def _acquire(self):
+        with self._lock:
+            table = self.table
+            if table is None or table.generation != self.generation:
+                return None
+            table.users += 1
+            return table
+
+    def _done(self, table):
+        with self._lock:
+            table.users -= 1
+            release = table.retired and not table.users
+        if release:
+            table.release()
+
+    async def count(self, query, snapshot):
+        count = query.indexed_count(self.index, snapshot)
+        return count if count is not None else len(await self.run(query, snapshot))
+
+    # Sorted indices of the rows of `snapshot` matching `query`
+    async def run(self, query, snapshot):
+        index, executor = self.index, _executor
+        if not index.covers(snapshot):
+            # The indexes of a (re)loaded sheet are still being built
+            telemetry.inc("trade_queries_total", mode="scan")
+            return await asyncio.to_thread(query.scan_rows, index, snapshot)
+        if executor is None or len(snapshot) < self.min_rows or query.cost(index, snapshot) < self.min_rows:
+            telemetry.inc("trade_queries_total", mode="inline")
+            return query.run(index, snapshot)
+        table = self._acquire()
+        if table is None:
+            telemetry.inc("trade_queries_total", mode="inline")
+            return query.run(index, snapshot)
+        telemetry.inc("trade_queries_total", mode="pool")
+        try:
+            loop = asyncio.get_running_loop()
+            chunks = range((min(table.length, len(snapshot)) + CHUNK_ROWS - 1) // CHUNK_ROWS)
+            live = frozenset(_live)
+            jobs = [loop.run_in_executor(executor, scan_chunk, table.name, table.layout, query, chunk, live) for chunk in chunks]
+            results = await asyncio.gather(*jobs)
+        except BrokenProcessPool:
+            stop_workers("a worker process died")
+            return query.run(index, snapshot)
+        finally:
+            self._done(table)
+        indices = np.concatenate(results).tolist() if results else []
+        if indices and indices[-1] >= len(snapshot):
+            indices = [row_index for row_index in indices if row_index < len(snapshot)]
+        # Rows appended since the table was published
+        indices.extend(row_index for row_index in range(table.length, len(snapshot)) if query.matches(index, snapshot, row_index))
+        return indices
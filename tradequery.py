@@ -0,0 +1,396 @@
+import math
+from datetime import date
+from tradeindex import cell_key, parse_date, parse_period, parse_price
+
+try:
+    import numpy as np
+except ImportError:  # Only the process pool scans need it; see tradepool
+    np = None
+
+# Query fields of /fetch_trades and the trade sheet column each one filters
+FIELDS = {
+    "buyer": "buyer",
+    "user_id": "user id",
+    "message_id": "message id",
+    "item": "items(s)",
+    "price": "price",
+    "category": "category",
+    "date": "date",
+}
+
+
+# A filter on one column. Every predicate can estimate how many rows it matches from the
+# indexes (cheap), produce its matching row indices from the indexes, and test one row.
+# scan() is the index-free path used by the process pool: a boolean mask over a chunk of
+# rows published by tradepool.
+class Predicate:
+    negated = False
+
+    def estimate(self, index, snapshot):
+        raise NotImplementedError
+
+    def rows(self, index, snapshot):
+        raise NotImplementedError
+
+    def matches(self, index, snapshot, row_index):
+        raise NotImplementedError
+
+    def scan(self, chunk):
+        raise NotImplementedError
+
+    def to_spec(self):
+        raise NotImplementedError
+
+    def search_terms(self):
+        return []
+
+
+# Cell contains any of the terms (case-insensitive), like the fetch_trade_by_* commands
+class Substring(Predicate):
+    def __init__(self, title, terms):
+        self.title = title
+        self.terms = [term.strip().lower() for term in terms]
+        self._values = None
+
+    def _matching_values(self, index):
+        if self._values is None:
+            column = index.column(self.title)
+            self._values = {value for term in self.terms for value in column.values_containing(term)}
+        return self._values
+
+    def estimate(self, index, snapshot):
+        column = index.column(self.title)
+        return sum(len(column.exact(value)) for value in self._matching_values(index))
+
+    def rows(self, index, snapshot):
+        return set(index.lookup(self.title, self._matching_values(index), snapshot))
+
+    def matches(self, index, snapshot, row_index):
+        cell = str(snapshot.rows[row_index][snapshot.schema.index(self.title)]).lower()
+        return any(term in cell for term in self.terms)
+
+    def scan(self, chunk):
+        cells = chunk.text(self.title)
+        return np.fromiter((any(term in cell for term in self.terms) for cell in cells), dtype=bool, count=len(cells))
+
+    def search_terms(self):
+        return self.terms
+
+    def to_spec(self):
+        return ["Substring", self.title, self.terms]
+
+    # The matching values are cached per index; workers scan without them
+    def __getstate__(self):
+        return {**self.__dict__, "_values": None}
+
+
+# Cell equals one of the values (case-insensitive), served by the hash index
+class Exact(Predicate):
+    def __init__(self, title, values):
+        self.title = title
+        self.values = {cell_key(value) for value in values}
+
+    def estimate(self, index, snapshot):
+        column = index.column(self.title)
+        return sum(len(column.exact(value)) for value in self.values)
+
+    def rows(self, index, snapshot):
+        return set(index.lookup(self.title, self.values, snapshot))
+
+    def matches(self, index, snapshot, row_index):
+        return cell_key(snapshot.rows[row_index][snapshot.schema.index(self.title)]) in self.values
+
+    def scan(self, chunk):
+        cells = chunk.text(self.title)
+        return np.fromiter((cell.strip() in self.values for cell in cells), dtype=bool, count=len(cells))
+
+    def search_terms(self):
+        return list(self.values)
+
+    def to_spec(self):
+        return ["Exact", self.title, sorted(self.values)]
+
+
+# Date between two day ordinals (inclusive), served by the sorted date index
+class DateRange(Predicate):
+    def __init__(self, first, last):
+        self.first = first
+        self.last = last
+
+    def estimate(self, index, snapshot):
+        return index.dates.count(self.first, self.last)
+
+    def rows(self, index, snapshot):
+        return set(index.dates.between(self.first, self.last, snapshot))
+
+    def matches(self, index, snapshot, row_index):
+        ordinal = parse_date(snapshot.rows[row_index][snapshot.schema.index("date")])
+        return ordinal is not None and self.first <= ordinal <= self.last
+
+    def scan(self, chunk):
+        ordinals = chunk.dates()  # 0 where the cell is not a date
+        return (ordinals >= self.first) & (ordinals <= self.last)
+
+    def search_terms(self):
+        if self.first == self.last:
+            return [date.fromordinal(self.first).strftime("%d %B %Y")]  # As written by add_record
+        return []
+
+    def to_spec(self):
+        return ["DateRange", self.first, self.last]
+
+
+# Numeric price between low and high (inclusive; None leaves a side open)
+class PriceRange(Predicate):
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        self._rows = None
+
+    def estimate(self, index, snapshot):
+        return len(self.rows(index, snapshot))
+
+    def rows(self, index, snapshot):
+        if self._rows is None:
+            self._rows = set(index.prices.between(self.low, self.high, snapshot))
+        return self._rows
+
+    def matches(self, index, snapshot, row_index):
+        if index.covers(snapshot):
+            price = index.prices.value(row_index)
+        else:
+            price = parse_price(snapshot.rows[row_index][snapshot.schema.index("price")])
+        low = -math.inf if self.low is None else self.low
+        high = math.inf if self.high is None else self.high
+        return low <= price <= high
+
+    def scan(self, chunk):
+        prices = chunk.prices()
+        mask = ~np.isnan(prices)
+        if self.low is not None:
+            mask &= prices >= self.low
+        if self.high is not None:
+            mask &= prices <= self.high
+        return mask
+
+    def to_spec(self):
+        return ["PriceRange", self.low, self.high]
+
+    def __getstate__(self):
+        return {**self.__dict__, "_rows": None}
+
+
+# Any of several predicates on the same field
+class AnyOf(Predicate):
+    def __init__(self, predicates):
+        self.predicates = predicates
+
+    def estimate(self, index, snapshot):
+        return sum(predicate.estimate(index, snapshot) for predicate in self.predicates)
+
+    def rows(self, index, snapshot):
+        return set().union(*(predicate.rows(index, snapshot) for predicate in self.predicates))
+
+    def matches(self, index, snapshot, row_index):
+        return any(predicate.matches(index, snapshot, row_index) for predicate in self.predicates)
+
+    def scan(self, chunk):
+        return np.logical_or.reduce([predicate.scan(chunk) for predicate in self.predicates])
+
+    def search_terms(self):
+        return [term for predicate in self.predicates for term in predicate.search_terms()]
+
+    def to_spec(self):
+        return ["AnyOf", [predicate.to_spec() for predicate in self.predicates]]
+
+
+# Rows the inner predicate does not match
+class Not(Predicate):
+    negated = True
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def estimate(self, index, snapshot):
+        return len(snapshot) - self.predicate.estimate(index, snapshot)
+
+    def rows(self, index, snapshot):
+        return set(range(len(snapshot))) - self.predicate.rows(index, snapshot)
+
+    def matches(self, index, snapshot, row_index):
+        return not self.predicate.matches(index, snapshot, row_index)
+
+    def scan(self, chunk):
+        return ~self.predicate.scan(chunk)
+
+    def to_spec(self):
+        return ["Not", self.predicate.to_spec()]
+
+
+# Whether an AnyOf sits anywhere in the predicate; the estimates of its alternatives add
+# up, so rows matched by more than one are counted twice
+def has_any_of(predicate):
+    if isinstance(predicate, AnyOf):
+        return True
+    if isinstance(predicate, Not):
+        return has_any_of(predicate.predicate)
+    return False
+
+
+# Rebuild a predicate from its to_spec() form (plain lists, safe to store as JSON)
+def predicate_from_spec(spec):
+    kind, *args = spec
+    if kind == "AnyOf":
+        return AnyOf([predicate_from_spec(inner) for inner in args[0]])
+    if kind == "Not":
+        return Not(predicate_from_spec(args[0]))
+    predicate_types = {"Substring": Substring, "Exact": Exact, "DateRange": DateRange, "PriceRange": PriceRange}
+    if kind not in predicate_types:
+        raise ValueError(f"Unknown predicate {kind!r}")
+    return predicate_types[kind](*args)
+
+
+# First and last day ordinal of a YYYY-MM-DD (or dd/mm/yyyy), YYYY-MM or YYYY period
+def parse_any_period(text):
+    for granularity in ("day", "month", "year"):
+        try:
+            return parse_period(text, granularity)
+        except ValueError:
+            pass
+    raise ValueError(f"{text.strip()!r} is not a date, month or year")
+
+
+def parse_range(text, parse_bound):
+    low, _, high = text.partition("..")
+    return (parse_bound(low) if low.strip() else None), (parse_bound(high) if high.strip() else None)
+
+
+def parse_number(text):
+    value = parse_price(text)
+    if math.isnan(value):
+        raise ValueError(f"{text.strip()!r} is not a number")
+    return value
+
+
+# Parse the value of one /fetch_trades field into a predicate:
+#   "a, b"     cell contains a or b      "=a, b"   cell is exactly a or b
+#   "lo..hi"   range (price and date; either side may be left out)
+#   "!..."     negates any of the above
+# A date field without ".." matches whole dates by day and anything else as text,
+# the same way /fetch_trade_by_date does.
+def parse_predicate(field, text):
+    title = FIELDS[field]
+    text = text.strip()
+    if text.startswith("!"):
+        return Not(parse_predicate(field, text[1:]))
+    if ".." in text and field in ("price", "date"):
+        if field == "price":
+            return PriceRange(*parse_range(text, parse_number))
+        first, last = parse_range(text, parse_any_period)
+        return DateRange(first[0] if first else date.min.toordinal(), last[1] if last else date.max.toordinal())
+    if text.startswith("="):
+        return Exact(title, text[1:].split(','))
+    terms = text.split(',')
+    if field == "date":
+        return dates_or_text(terms)
+    return Substring(title, terms)
+
+
+# Dates, YYYY-MM months and YYYY years matched through the date index, any other term as text
+def dates_or_text(terms):
+    predicates, text_terms = [], []
+    for term in (term.strip() for term in terms):
+        try:
+            predicates.append(DateRange(*parse_any_period(term)))
+        except ValueError:
+            text_terms.append(term)
+    if text_terms:
+        predicates.append(Substring(FIELDS["date"], text_terms))
+    return predicates[0] if len(predicates) == 1 else AnyOf(predicates)
+
+
+# A conjunction of predicates, evaluated by a small planner: the predicate the indexes
+# say matches the fewest rows drives the query, and each remaining predicate is either
+# intersected from its own index result or checked row by row on the surviving
+# candidates, whichever touches fewer rows.
+class TradeQuery:
+    def __init__(self, predicates):
+        self.predicates = predicates
+
+    @classmethod
+    def from_fields(cls, **fields):
+        return cls([parse_predicate(field, text) for field, text in fields.items() if text])
+
+    # The query as plain lists, for storing it and running it again later
+    def to_spec(self):
+        return [predicate.to_spec() for predicate in self.predicates]
+
+    @classmethod
+    def from_spec(cls, spec):
+        return cls([predicate_from_spec(predicate) for predicate in spec])
+
+    def search_terms(self):
+        return [term for predicate in self.predicates if not predicate.negated for term in predicate.search_terms()]
+
+    def plan(self, index, snapshot):
+        estimates = [(predicate.estimate(index, snapshot), position, predicate) for position, predicate in enumerate(self.predicates)]
+        estimates.sort(key=lambda estimate: (estimate[2].negated, estimate[0], estimate[1]))
+        return [(estimate, predicate) for estimate, _, predicate in estimates]
+
+    # Sorted indices of the matching rows of `snapshot`
+    def run(self, index, snapshot):
+        plan = self.plan(index, snapshot)
+        if not plan:
+            return list(range(len(snapshot)))
+        estimate, driver = plan[0]
+        candidates = driver.rows(index, snapshot)
+        for estimate, predicate in plan[1:]:
+            if not candidates:
+                break
+            if len(candidates) <= estimate or predicate.negated:
+                candidates = {row_index for row_index in candidates if predicate.matches(index, snapshot, row_index)}
+            else:
+                candidates &= predicate.rows(index, snapshot)
+        return sorted(candidates)
+
+    # Rows run() is expected to touch, following the same choices as run()
+    def cost(self, index, snapshot):
+        plan = self.plan(index, snapshot)
+        if not plan:
+            return len(snapshot)
+        cost = candidates = plan[0][0]
+        for estimate, predicate in plan[1:]:
+            if candidates <= estimate or predicate.negated:
+                cost += candidates
+            else:
+                cost += estimate
+                candidates = estimate
+        return cost
+
+    def matches(self, index, snapshot, row_index):
+        return all(predicate.matches(index, snapshot, row_index) for predicate in self.predicates)
+
+    # Sorted indices of the matching rows found by checking every row, for a snapshot
+    # the indexes do not cover yet
+    def scan_rows(self, index, snapshot):
+        return [row_index for row_index in range(len(snapshot)) if self.matches(index, snapshot, row_index)]
+
+    # Mask of the rows of a published chunk matching every predicate
+    def scan(self, chunk):
+        mask = np.ones(chunk.length, dtype=bool)
+        for predicate in self.predicates:
+            mask &= predicate.scan(chunk)
+        return mask
+
+    # Number of matching rows without building any result rows. A single predicate is
+    # answered from its index estimate alone, which is exact when the index is current
+    # and no AnyOf inside it can count a row twice.
+    def count(self, index, snapshot):
+        count = self.indexed_count(index, snapshot)
+        return count if count is not None else len(self.run(index, snapshot))
+
+    # The count straight from the index estimate when that is exact, else None
+    def indexed_count(self, index, snapshot):
+        if len(self.predicates) == 1 and not has_any_of(self.predicates[0]) and index.version == snapshot.version:
+            return self.predicates[0].estimate(index, snapshot)
+        return None
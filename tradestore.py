@@ -0,0 +1,244 @@
+import logging
+import re
+import threading
+import time
+from gspread.utils import rowcol_to_a1
+from gscheduler import DRIVE, SHEETS_READ, SHEETS_WRITE, scheduler
+from telemetry import telemetry
+
+log = logging.getLogger(__name__)
+
+
+# Column titles of the trade sheet, with case-insensitive lookups by title
+class TradeSchema:
+    def __init__(self, titles):
+        self.titles = list(titles)
+        self._positions = {}
+        for position, title in enumerate(self.titles):
+            self._positions.setdefault(title.strip().lower(), position)
+
+    def __iter__(self):
+        return iter(self.titles)
+
+    def __len__(self):
+        return len(self.titles)
+
+    def __getitem__(self, position):
+        return self.titles[position]
+
+    def index(self, title):
+        try:
+            return self._positions[title.strip().lower()]
+        except KeyError:
+            raise ValueError(f"{title!r} is not a column of the trade sheet") from None
+
+
+# Immutable view over the first `length` rows of the store's append-only row list.
+# Row indices are 0-based; the matching sheet row is index + 2 (row 1 holds the titles).
+class TradeSnapshot:
+    __slots__ = ("version", "schema", "rows", "length")
+
+    def __init__(self, version, schema, rows, length):
+        self.version = version
+        self.schema = schema
+        self.rows = rows
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        rows = self.rows
+        for index in range(self.length):
+            yield rows[index]
+
+    def row(self, index):
+        if 0 <= index < self.length:
+            return self.rows[index]
+        return None
+
+    def sheet_row(self, index):
+        return index + 2
+
+
+# In-memory copy of the "Trade Records" sheet that serves every trade command.
+# The first snapshot() call downloads the sheet once; afterwards refresh() only asks
+# Drive for the file version and, when it moved, fetches the rows appended since the
+# last known row count. A periodic full reload, done once the version moved, picks up
+# edits made in place.
+class TradeStore:
+    def __init__(self, open_worksheet, drive_service=None, refresh_interval=30, full_refresh_interval=900):
+        self._open_worksheet = open_worksheet
+        self._drive_service = drive_service
+        self.refresh_interval = refresh_interval
+        self.full_refresh_interval = full_refresh_interval
+        self._worksheet = None
+        self._lock = threading.RLock()
+        self._rows = []
+        self._snapshot = None
+        self._version = 0
+        self._revision = None
+        self._checked_at = 0.0
+        self._loaded_at = 0.0
+        self._listeners = []
+
+    @property
+    def worksheet(self):
+        if self._worksheet is None:
+            self._worksheet = scheduler.call(SHEETS_READ, self._open_worksheet)
+        return self._worksheet
+
+    @property
+    def schema(self):
+        return self.snapshot().schema
+
+    @property
+    def revision(self):
+        return self._revision
+
+    # Register a callback(snapshot, start) run after rows from index `start` were added;
+    # start == 0 means the snapshot was rebuilt from scratch. With replay, a callback
+    # added after the first load is called once for the current snapshot.
+    def add_listener(self, callback, replay=True):
+        with self._lock:
+            self._listeners.append(callback)
+            if replay and self._snapshot is not None:
+                callback(self._snapshot, 0)
+
+    # Serve a locally saved copy of the sheet until the next refresh() reconciles it with
+    # the live sheet; the saved revision lets that refresh skip the download when unchanged
+    def restore(self, titles, rows, revision):
+        with self._lock:
+            self._rows = []
+            self._snapshot = TradeSnapshot(self._version, TradeSchema(titles), self._rows, 0)
+            self._revision = revision
+            self._checked_at = self._loaded_at = time.monotonic()
+            self._extend([self._pad(row) for row in rows], start=0)
+            return self._snapshot
+
+    def snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None or self._stale():
+            with self._lock:
+                # Callers that queued up behind a refresh get its result instead of refreshing again
+                snapshot = self._snapshot
+                if snapshot is None or self._stale():
+                    snapshot = self.refresh()
+        return snapshot
+
+    # The current snapshot without checking the sheet for changes; None before the first load
+    def peek(self):
+        return self._snapshot
+
+    def _stale(self):
+        return time.monotonic() - self._checked_at >= self.refresh_interval
+
+    def refresh(self, force=False):
+        with self._lock:
+            now = time.monotonic()
+            if force or self._snapshot is None:
+                return self._load()
+
+            revision = self._fetch_revision()
+            unchanged = revision is not None and revision == self._revision
+            telemetry.cache("trade_revision", unchanged)
+            if unchanged:
+                self._checked_at = now
+                return self._snapshot
+            if now - self._loaded_at >= self.full_refresh_interval:
+                return self._load(revision)
+
+            # Re-read the last known row along with everything after it; if it changed,
+            # rows were edited or removed and only a full reload gives a consistent view
+            snapshot = self._snapshot
+            known = snapshot.length
+            first_row = known + 1 if known else 2
+            tail = [self._pad(row) for row in scheduler.call(SHEETS_READ, self.worksheet.get, f"A{first_row}:{self._last_column()}")]
+            if known:
+                if not tail or tail[0] != self._pad(self._rows[known - 1]):
+                    return self._load()
+                tail = tail[1:]
+
+            self._revision = revision
+            self._checked_at = now
+            if tail:
+                self._extend(tail)
+            return self._snapshot
+
+    # Write-through append of one row: returns the sheet row number it landed on
+    def append_row(self, row, value_input_option='USER_ENTERED'):
+        return self.append_rows([row], value_input_option)
+
+    # Write-through append in a single values.append call: returns the sheet row number
+    # of the first appended row, taken from the response's updated range. The store keeps
+    # the values as the sheet parsed them, which the response includes, so they match
+    # what the next full reload reads.
+    def append_rows(self, rows, value_input_option='USER_ENTERED'):
+        with self._lock:
+            snapshot = self.snapshot()
+            # Not retried after a server error: the rows may have been written anyway
+            response = scheduler.call(SHEETS_WRITE, self.worksheet.append_rows, rows, value_input_option=value_input_option,
+                                      include_values_in_response=True, idempotent=False)
+            row_num = updated_row(response)
+            if row_num is None or row_num == snapshot.length + 2:
+                self._extend([self._pad(row) for row in appended_values(response, rows)])
+            else:
+                # Somebody else appended in the meantime; catch up from the sheet
+                self._revision = None
+                self.refresh()
+            return row_num if row_num is not None else self._snapshot.length + 2 - len(rows)
+
+    def _load(self, revision=None):
+        revision = self._fetch_revision() if revision is None else revision
+        values = scheduler.call(SHEETS_READ, self.worksheet.get_all_values)
+        schema = TradeSchema(values[0] if values else [])
+        self._rows = []
+        self._snapshot = TradeSnapshot(self._version, schema, self._rows, 0)
+        self._revision = revision
+        self._checked_at = self._loaded_at = time.monotonic()
+        self._extend([self._pad(row) for row in values[1:]], start=0)
+        return self._snapshot
+
+    def _extend(self, rows, start=None):
+        start = len(self._rows) if start is None else start
+        self._rows.extend(rows)
+        self._version += 1
+        self._snapshot = TradeSnapshot(self._version, self._snapshot.schema, self._rows, len(self._rows))
+        for callback in self._listeners:
+            callback(self._snapshot, start)
+
+    def _pad(self, row):
+        width = len(self._snapshot.schema) if self._snapshot is not None else 0
+        row = list(row)
+        if len(row) < width:
+            row.extend([""] * (width - len(row)))
+        return row
+
+    def _last_column(self):
+        width = max(len(self._snapshot.schema), 1)
+        return re.sub(r"\d", "", rowcol_to_a1(1, width))
+
+    def _fetch_revision(self):
+        if self._drive_service is None:
+            return None
+        try:
+            file_id = self.worksheet.spreadsheet.id
+            request = self._drive_service.files().get(fileId=file_id, fields='version')
+            file = scheduler.execute(DRIVE, request, key=('version', file_id))
+            return file.get('version')
+        except Exception as e:
+            log.warning(f"Could not fetch the trade sheet revision: {e}")
+            return None
+
+
+# Row number of the first row written by a values.append response, e.g. "Sheet1!A42:G42" -> 42
+def updated_row(response):
+    updated_range = ((response or {}).get('updates') or {}).get('updatedRange', '')
+    match = re.search(r"![A-Z]+(\d+)", updated_range)
+    return int(match.group(1)) if match else None
+
+
+# Rows as written by a values.append response that included its values, else the rows sent
+def appended_values(response, rows):
+    values = (((response or {}).get('updates') or {}).get('updatedData') or {}).get('values')
+    return values if values is not None and len(values) == len(rows) else rows
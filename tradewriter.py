@@ -0,0 +1,126 @@
+import asyncio
+import logging
+from googleio import run_blocking
+from gscheduler import SHEETS_WRITE, scheduler
+
+log = logging.getLogger(__name__)
+
+
+# An import that failed part way through: the chunks appended before the failure stay in
+# the sheet. `written` holds the (first, last) sheet rows they landed on, merged where
+# they are contiguous, and `records` how many of the imported rows they are.
+class PartialImport(Exception):
+    def __init__(self, written, records, error):
+        self.written = written
+        self.records = records
+        self.error = error
+        ranges = ", ".join(f"{first}–{last}" for first, last in written)
+        super().__init__(f"{error} (the first {records} records were already written to rows {ranges})")
+
+
+# Write-behind queue for new trade records. Records submitted while a write is in flight
+# are combined into one values.append plus one batchUpdate that formats the whole date
+# range. Each caller is answered as soon as the append is accepted: the rows are in the
+# sheet by then, and a caller told otherwise would add them again. The append is waited
+# for without a timeout for the same reason, and a failed date format is only logged.
+class TradeWriter:
+    def __init__(self, store, date_column="date", date_pattern='dd mmmm yyyy', max_batch=100, linger=0.05):
+        self.store = store
+        self.date_column = date_column
+        self.date_pattern = date_pattern
+        self.max_batch = max_batch
+        self.linger = linger
+        self._queue = None
+        self._worker = None
+
+    # Queue a row and wait until it is written; returns the sheet row number it landed on
+    async def add(self, row):
+        if self._worker is None or self._worker.done():
+            self._queue = self._queue or asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((row, future))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self._queue.get()]
+            # Give a burst a moment to arrive, then take whatever is queued
+            await asyncio.sleep(self.linger)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            rows = [row for row, _ in batch]
+            try:
+                first_row = await run_blocking(self.store.append_rows, rows, 'USER_ENTERED', timeout=None)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for offset, (_, future) in enumerate(batch):
+                if not future.done():
+                    future.set_result(first_row + offset)
+            await self._format_written(first_row, first_row + len(rows) - 1)
+
+    # Append a large number of rows (an import) with one values.append per chunk, then
+    # format the date column of the whole imported range with a single batchUpdate.
+    # `progress(written, total)` is awaited after each chunk. Returns the first and last
+    # sheet row written; rows appended by others in between are formatted too, which is
+    # harmless since they are trade rows with dates as well. If a chunk fails after others
+    # were appended, those are formatted and PartialImport says where they landed.
+    async def add_many(self, rows, chunk_size=5000, progress=None):
+        written = []
+        records = 0
+        try:
+            for start in range(0, len(rows), chunk_size):
+                chunk = rows[start:start + chunk_size]
+                row_num = await run_blocking(self.store.append_rows, chunk, 'USER_ENTERED', timeout=None)
+                if written and written[-1][1] + 1 == row_num:
+                    written[-1] = (written[-1][0], row_num + len(chunk) - 1)
+                else:
+                    written.append((row_num, row_num + len(chunk) - 1))
+                records += len(chunk)
+                if progress is not None:
+                    await progress(records, len(rows))
+        except Exception as e:
+            if not written:
+                raise
+            await self._format_written(min(first for first, _ in written), max(last for _, last in written))
+            raise PartialImport(written, records, e) from e
+        if not written:
+            return None, None
+        first_row, last_row = min(first for first, _ in written), max(last for _, last in written)
+        await self._format_written(first_row, last_row)
+        return first_row, last_row
+
+    # The rows are written whether or not this works, so a failure is logged, not raised
+    async def _format_written(self, first_row, last_row):
+        try:
+            await run_blocking(self._format_dates, first_row, last_row)
+        except Exception as e:
+            log.warning(f"Could not format the dates of trade rows {first_row}-{last_row}: {e!r}")
+
+    def _format_dates(self, first_row, last_row):
+        worksheet = self.store.worksheet
+        date_column = self.store.schema.index(self.date_column)
+        scheduler.call(SHEETS_WRITE, worksheet.spreadsheet.batch_update, {"requests": [
+            date_format_request(worksheet.id, first_row, last_row, date_column, self.date_pattern)
+        ]})
+
+
+# repeatCell request giving rows first_row..last_row (1-based, inclusive) of a column a DATE format
+def date_format_request(sheet_id, first_row, last_row, column, pattern):
+    return {
+        "repeatCell": {
+            "range": {
+                "sheetId": sheet_id,
+                "startRowIndex": first_row - 1,
+                "endRowIndex": last_row,
+                "startColumnIndex": column,
+                "endColumnIndex": column + 1,
+            },
+            "cell": {"userEnteredFormat": {"numberFormat": {"type": "DATE", "pattern": pattern}}},
+            "fields": "userEnteredFormat.numberFormat",
+        }
+    }
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from telemetry import telemetry
+
+# State behind the bot's paginators and buttons. A view is identified by a short key
+# derived from its spec (the query or talent type it shows), the spec is saved in the
+# SnapshotDB under that key, and the buttons carry the key plus their page in their
+# custom_id. Whatever the pages are built from is kept in a BoundedCache and rebuilt
+# from the spec when it has been evicted or the bot has restarted.
+
+VIEW_CACHE_BYTES = 64 * 1024 * 1024
+VIEW_CACHE_TTL = 15 * 60  # Seconds a result set is kept after its last use
+VIEW_SPEC_TTL = 30 * 24 * 3600  # Seconds a saved spec keeps its buttons working
+MAX_SPECS = 4096  # Specs kept in memory in front of the database
+SPEC_RESAVE_AFTER = 24 * 3600  # Running the same query again renews its saved spec this often
+
+
+# LRU cache with a budget in (estimated) bytes and an idle time-to-live
+class BoundedCache:
+    def __init__(self, name, max_bytes, ttl):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self._entries = OrderedDict()  # key -> (value, size, last used)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        value = self._lookup(key)
+        telemetry.cache(self.name, value is not None)
+        return value
+
+    def _lookup(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[2] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                return None
+            self._entries[key] = (entry[0], entry[1], now)
+            self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key, value, size):
+        now = time.monotonic()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, now)
+            self.bytes += size
+            # Expired entries first, then the least recently used, but never the new one
+            while self._entries:
+                oldest_key, (_, _, used) = next(iter(self._entries.items()))
+                if oldest_key == key or (self.bytes <= self.max_bytes and now - used <= self.ttl):
+                    break
+                self._remove(oldest_key)
+                telemetry.inc("cache_evictions_total", cache=self.name)
+
+    def pop(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    # Drop every entry whose value passes `test`
+    def discard(self, test):
+        with self._lock:
+            for key in [key for key, (value, _, _) in self._entries.items() if test(value)]:
+                self._remove(key)
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+
+# Key of a spec: the same query run again gets the same key, and so shares its cached pages
+def view_key(spec):
+    text = json.dumps(spec, sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+
+# register() and spec() may touch the database, so they are called off the event loop
+class ViewRegistry:
+    def __init__(self, db, max_bytes=VIEW_CACHE_BYTES, ttl=VIEW_CACHE_TTL, spec_ttl=VIEW_SPEC_TTL):
+        self.db = db
+        self.spec_ttl = spec_ttl
+        self.pages = BoundedCache("view_pages", max_bytes, ttl)
+        self._specs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, spec):
+        key = view_key(spec)
+        now = time.time()
+        with self._lock:
+            saved_at = self._specs.get(key, (None, None))[1]
+            fresh = saved_at is not None and now - saved_at < SPEC_RESAVE_AFTER
+            self._remember(key, spec, saved_at if fresh else now)
+        if not fresh:
+            self.db.save_view(key, spec)
+        return key
+
+    # The spec saved under `key`, or None if it is unknown or has expired
+    def spec(self, key):
+        with self._lock:
+            remembered = self._specs.get(key)
+            if remembered is not None:
+                self._specs.move_to_end(key)
+                return remembered[0]
+        spec = self.db.load_view(key)
+        if spec is not None:
+            with self._lock:
+                self._remember(key, spec, None)
+        return spec
+
+    def expire(self):
+        return self.db.expire_views(time.time() - self.spec_ttl)
+
+    # `saved_at` is when this process last saved the spec, None if it only loaded it
+    def _remember(self, key, spec, saved_at):
+        self._specs[key] = (spec, saved_at)
+        self._specs.move_to_end(key)
+        while len(self._specs) > MAX_SPECS:
+            self._specs.popitem(last=False)